@@ -0,0 +1,512 @@
+import asyncio
+import contextlib
+import json
+import math
+import os
+import threading
+import time
+from collections import deque
+
+"""
+Admission control and per-upstream limits.
+
+A turn first passes the chat admission gate (at most CHAT_MAX_CONCURRENT_TURNS
+at once, a bounded queue behind them), then each upstream call takes a slot of
+that upstream's limiter: a concurrency limit plus an optional rate budget
+(OpenAI requests per second per model, ElevenLabs characters per second,
+DynamoDB capacity units per second).
+
+Callers wait at most the limiter's `max_wait`; past that, or when its queue is
+full, `Saturated` is raised with a `retry_after` estimate, which main.py turns
+into a 503 (the service is full) or 429 (an upstream budget is spent) with a
+`Retry-After` header. Audio is skipped, not failed, when ElevenLabs is saturated.
+
+Rate budgets are token buckets that may go into debt: a call is let through
+once the bucket is not negative and then pays its full cost, so a long text
+isn't starved by a small burst size, and the average rate still holds.
+"""
+
+
+def _rates(value: str) -> dict:
+    """Parse "gpt-4=2,*=20" into {"gpt-4": 2.0, "*": 20.0}."""
+    rates = {}
+    for entry in filter(None, (part.strip() for part in value.split(","))):
+        name, _, rate = entry.rpartition("=")
+        rates[name or "*"] = float(rate)
+    return rates
+
+
+# /chat turns (HTTP and WebSocket) processed at once, and queued behind them
+CHAT_MAX_CONCURRENT_TURNS = int(os.getenv("CHAT_MAX_CONCURRENT_TURNS", "256"))
+CHAT_ADMISSION_QUEUE = int(os.getenv("CHAT_ADMISSION_QUEUE", "512"))
+# Longest a turn waits for admission before a 503
+CHAT_ADMISSION_MAX_WAIT = float(os.getenv("CHAT_ADMISSION_MAX_WAIT", "2"))
+# OpenAI calls in flight per model, and requests per second per model ("*" for
+# the other models), e.g. "gpt-4=2,*=20". Unset means no rate limit.
+OPENAI_MAX_CONCURRENCY = int(os.getenv("OPENAI_MAX_CONCURRENCY", "128"))
+OPENAI_REQUESTS_PER_SECOND = _rates(os.getenv("OPENAI_REQUESTS_PER_SECOND", ""))
+# Models with a limiter of their own (and those given a rate above); calls to
+# any other model name share the "*" limiter
+OPENAI_MODELS = {
+    name.strip()
+    for name in os.getenv(
+        "OPENAI_MODELS", "gpt-3.5-turbo,gpt-4,gpt-4-turbo,gpt-4o,gpt-4o-mini"
+    ).split(",")
+    if name.strip()
+}
+# Longest an LLM call waits for its slot before a 429
+OPENAI_MAX_WAIT = float(os.getenv("OPENAI_MAX_WAIT", "5"))
+# ElevenLabs requests in flight, and characters per second (0: no budget)
+ELEVENLABS_MAX_CONCURRENCY = int(os.getenv("ELEVENLABS_MAX_CONCURRENCY", "16"))
+ELEVENLABS_CHARACTERS_PER_SECOND = float(os.getenv("ELEVENLABS_CHARACTERS_PER_SECOND", "0"))
+# Longest a synthesis waits for its slot before its audio is skipped
+ELEVENLABS_MAX_WAIT = float(os.getenv("ELEVENLABS_MAX_WAIT", "2"))
+# S3 requests in flight
+S3_MAX_CONCURRENCY = int(os.getenv("S3_MAX_CONCURRENCY", "32"))
+# Provisioned DynamoDB capacity units per second to stay under (0: unlimited)
+DYNAMODB_READ_UNITS_PER_SECOND = float(os.getenv("DYNAMODB_READ_UNITS_PER_SECOND", "0"))
+DYNAMODB_WRITE_UNITS_PER_SECOND = float(os.getenv("DYNAMODB_WRITE_UNITS_PER_SECOND", "0"))
+# Longest a DynamoDB read waits for capacity before a 429 (writes always wait)
+DYNAMODB_MAX_WAIT = float(os.getenv("DYNAMODB_MAX_WAIT", "2"))
+
+DYNAMODB_WRITES = {"PutItem", "UpdateItem", "DeleteItem", "BatchWriteItem"}
+
+
+class Saturated(Exception):
+    """
+    A limiter can't admit a call within its max wait.
+
+    Attributes
+    ----------
+    limiter (str): The limiter's name, e.g. "openai:gpt-4".
+    retry_after (int): Seconds after which a retry is likely to be admitted.
+    status_code (int): 503 for the chat admission gate, 429 for upstreams.
+    """
+
+    def __init__(self, limiter: str, retry_after: float, status_code: int = 429):
+        self.limiter = limiter
+        self.retry_after = max(1, math.ceil(retry_after))
+        self.status_code = status_code
+        super().__init__(f"{limiter} is saturated, retry in {self.retry_after}s")
+
+
+class TokenBucket:
+    """
+    A thread-safe token bucket refilled at `rate` per second up to `burst`.
+    """
+
+    def __init__(self, rate: float, burst: float = None):
+        self.rate = rate
+        self.burst = burst or rate
+        self.tokens = self.burst
+        self.updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def reserve(self, cost: float, max_wait: float = None) -> float:
+        """
+        Take `cost` tokens, possibly into debt.
+
+        Returns
+        -------
+        The seconds to wait before using them. Raises `Saturated` instead of
+        reserving when that is longer than `max_wait`.
+        """
+        with self._lock:
+            self._refill()
+            wait = max(0.0, -self.tokens / self.rate)
+            if max_wait is not None and wait > max_wait:
+                raise Saturated("rate", wait)
+            self.tokens -= cost
+            return wait
+
+    def refund(self, cost: float):
+        """
+        Give back tokens reserved for a call that was not made.
+        """
+        with self._lock:
+            self._refill()
+            self.tokens = min(self.burst, self.tokens + cost)
+
+    def available(self) -> float:
+        with self._lock:
+            self._refill()
+            return self.tokens
+
+
+class _Stats:
+    def __init__(self):
+        self.admitted = 0
+        self.rejected = 0
+        self.in_flight = 0
+        self.waiting = 0
+        self.peak_waiting = 0
+        self.wait_seconds = 0.0
+
+    def to_dict(self, bucket: TokenBucket = None) -> dict:
+        stats = {
+            "admitted": self.admitted,
+            "rejected": self.rejected,
+            "in_flight": self.in_flight,
+            "waiting": self.waiting,
+            "peak_waiting": self.peak_waiting,
+            "wait_seconds": round(self.wait_seconds, 3),
+        }
+        if bucket is not None:
+            stats["budget_available"] = round(bucket.available(), 1)
+        return stats
+
+
+class AsyncLimiter:
+    """
+    Concurrency limit, bounded wait queue and optional rate budget for async
+    callers: `async with limiter.slot(cost): ...`.
+    """
+
+    def __init__(
+        self,
+        name: str,
+        concurrency: int,
+        rate: float = None,
+        burst: float = None,
+        max_queue: int = None,
+        max_wait: float = 5.0,
+        status_code: int = 429,
+    ):
+        self.name = name
+        self.concurrency = concurrency
+        self.bucket = TokenBucket(rate, burst) if rate else None
+        self.max_queue = max_queue
+        self.max_wait = max_wait
+        self.status_code = status_code
+        self.stats = _Stats()
+        self._waiters = deque()
+        # Moving average of how long a slot is held, for Retry-After estimates
+        self._hold_seconds = 1.0
+
+    @contextlib.asynccontextmanager
+    async def slot(self, cost: float = 1):
+        # `acquire` gives the slot back itself when it fails or is cancelled
+        await self.acquire(cost)
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            self._hold_seconds = 0.9 * self._hold_seconds + 0.1 * (time.monotonic() - start)
+            self.release()
+
+    async def acquire(self, cost: float = 1):
+        """
+        Wait for a slot (and `cost` of the rate budget), or raise `Saturated`.
+        Every successful `acquire` must be paired with a `release`; when it
+        fails or is cancelled, the slot and the budget are given back.
+        """
+        start = time.monotonic()
+        if self.stats.in_flight < self.concurrency and not self._waiters:
+            self.stats.in_flight += 1
+        else:
+            await self._wait_for_slot()
+
+        reserved = 0
+        try:
+            if self.bucket is not None:
+                try:
+                    max_wait = max(0.0, self.max_wait - (time.monotonic() - start))
+                    wait = self.bucket.reserve(cost, max_wait)
+                except Saturated as e:
+                    self._reject(e.retry_after)
+                reserved = cost
+                if wait:
+                    await asyncio.sleep(wait)
+        except BaseException:
+            if reserved:
+                self.bucket.refund(reserved)
+            self.release()
+            raise
+        self.stats.admitted += 1
+        self.stats.wait_seconds += time.monotonic() - start
+
+    def release(self):
+        self.stats.in_flight -= 1
+        while self._waiters:
+            waiter = self._waiters.popleft()
+            if not waiter.done():
+                # The slot is handed over, in_flight stays the same
+                self.stats.in_flight += 1
+                waiter.set_result(None)
+                return
+
+    def has_capacity(self) -> bool:
+        """
+        Whether a call would be admitted right now, without waiting.
+        """
+        if self.bucket is not None and self.bucket.available() < 0:
+            return False
+        return self.stats.in_flight < self.concurrency or (
+            self.max_queue is None or len(self._waiters) < self.max_queue
+        )
+
+    def metrics(self) -> dict:
+        return {
+            **self.stats.to_dict(self.bucket),
+            "concurrency": self.concurrency,
+            "waiting": len(self._waiters),
+        }
+
+    async def _wait_for_slot(self):
+        if self.max_queue is not None and len(self._waiters) >= self.max_queue:
+            self._reject(self._hold_seconds * len(self._waiters) / self.concurrency)
+        waiter = asyncio.get_running_loop().create_future()
+        self._waiters.append(waiter)
+        self.stats.peak_waiting = max(self.stats.peak_waiting, len(self._waiters))
+        try:
+            await asyncio.wait_for(waiter, self.max_wait)
+        except asyncio.TimeoutError:
+            with contextlib.suppress(ValueError):
+                self._waiters.remove(waiter)
+            self._reject(self._hold_seconds * (len(self._waiters) + 1) / self.concurrency)
+        except BaseException:
+            # Cancelled: pass on a slot handed over in the meantime
+            if waiter.done() and not waiter.cancelled():
+                self.release()
+            else:
+                with contextlib.suppress(ValueError):
+                    self._waiters.remove(waiter)
+            raise
+
+    def _reject(self, retry_after: float):
+        self.stats.rejected += 1
+        raise Saturated(self.name, retry_after, self.status_code)
+
+
+class BlockingLimiter:
+    """
+    Concurrency limit and optional rate budget for calls made on threads
+    (boto3), enforced by botocore event hooks, see `register_boto3`.
+    """
+
+    def __init__(
+        self,
+        name: str,
+        concurrency: int = None,
+        rate: float = None,
+        max_wait: float = None,
+    ):
+        self.name = name
+        self.concurrency = concurrency
+        self.bucket = TokenBucket(rate) if rate else None
+        self.max_wait = max_wait
+        self.stats = _Stats()
+        self._semaphore = threading.BoundedSemaphore(concurrency) if concurrency else None
+        self._lock = threading.Lock()
+
+    def acquire(self, cost: float = 1, max_wait: float = None):
+        """
+        Take a slot (and `cost` of the rate budget), or raise `Saturated`.
+        Every successful `acquire` must be paired with a `release`.
+        """
+        max_wait = self.max_wait if max_wait is None else max_wait
+        start = time.monotonic()
+        with self._lock:
+            self.stats.waiting += 1
+            self.stats.peak_waiting = max(self.stats.peak_waiting, self.stats.waiting)
+        try:
+            semaphore = self._semaphore
+            if semaphore is not None and not semaphore.acquire(timeout=max_wait):
+                self._reject(max_wait or 1)
+            if self.bucket is not None:
+                try:
+                    self._pay(cost, max_wait)
+                except Saturated:
+                    if semaphore is not None:
+                        semaphore.release()
+                    raise
+        finally:
+            with self._lock:
+                self.stats.waiting -= 1
+        with self._lock:
+            self.stats.in_flight += 1
+            self.stats.admitted += 1
+            self.stats.wait_seconds += time.monotonic() - start
+
+    def charge(self, cost: float, max_wait: float = None):
+        """
+        Take `cost` of the rate budget without a slot, sleeping until it is
+        available, or raise `Saturated` when that is longer than `max_wait`.
+        """
+        wait = self._pay(cost, max_wait)
+        with self._lock:
+            self.stats.admitted += 1
+            self.stats.wait_seconds += wait
+
+    def _pay(self, cost: float, max_wait: float = None) -> float:
+        try:
+            wait = self.bucket.reserve(cost, max_wait)
+        except Saturated as e:
+            self._reject(e.retry_after)
+        if wait:
+            time.sleep(wait)
+        return wait
+
+    def release(self):
+        with self._lock:
+            self.stats.in_flight -= 1
+        if self._semaphore is not None:
+            self._semaphore.release()
+
+    def metrics(self) -> dict:
+        with self._lock:
+            return {**self.stats.to_dict(self.bucket), "concurrency": self.concurrency}
+
+    def _reject(self, retry_after: float):
+        with self._lock:
+            self.stats.rejected += 1
+        raise Saturated(self.name, retry_after)
+
+
+def _item_units(item: dict, unit_bytes: int) -> int:
+    # Close enough to DynamoDB's item size for budgeting
+    size = len(json.dumps(item, default=repr))
+    return max(1, math.ceil(size / unit_bytes))
+
+
+def dynamodb_write_units(operation: str, params: dict) -> int:
+    """
+    Estimated write capacity units of a DynamoDB call (1 per started KB per item).
+    """
+    if operation == "BatchWriteItem":
+        return sum(
+            _item_units(request.get("PutRequest", {}).get("Item", request), 1024)
+            for requests in params.get("RequestItems", {}).values()
+            for request in requests
+        )
+    return _item_units(params.get("Item") or params.get("Key") or {}, 1024)
+
+
+def dynamodb_read_units(parsed: dict) -> float:
+    """
+    Read capacity units of a DynamoDB response: its consumed capacity when
+    returned, else an estimate (eventually consistent, 4 KB per unit).
+    """
+    consumed = parsed.get("ConsumedCapacity")
+    if isinstance(consumed, dict) and "CapacityUnits" in consumed:
+        return consumed["CapacityUnits"]
+    items = parsed.get("Items")
+    if items is None:
+        items = [parsed["Item"]] if parsed.get("Item") else []
+    size = sum(len(json.dumps(item, default=repr)) for item in items)
+    return max(0.5, math.ceil(size / 4096) / 2)
+
+
+class UpstreamLimits:
+    """
+    The admission gate and the limiters of every upstream.
+    """
+
+    def __init__(self):
+        self.chat = AsyncLimiter(
+            "chat",
+            concurrency=CHAT_MAX_CONCURRENT_TURNS,
+            max_queue=CHAT_ADMISSION_QUEUE,
+            max_wait=CHAT_ADMISSION_MAX_WAIT,
+            status_code=503,
+        )
+        self.elevenlabs = AsyncLimiter(
+            "elevenlabs",
+            concurrency=ELEVENLABS_MAX_CONCURRENCY,
+            rate=ELEVENLABS_CHARACTERS_PER_SECOND,
+            # A minute of characters may be spent at once
+            burst=ELEVENLABS_CHARACTERS_PER_SECOND * 60,
+            max_wait=ELEVENLABS_MAX_WAIT,
+        )
+        self.s3 = BlockingLimiter("s3", concurrency=S3_MAX_CONCURRENCY)
+        self.dynamodb_read = BlockingLimiter(
+            "dynamodb_read", rate=DYNAMODB_READ_UNITS_PER_SECOND, max_wait=DYNAMODB_MAX_WAIT
+        )
+        self.dynamodb_write = BlockingLimiter(
+            "dynamodb_write", rate=DYNAMODB_WRITE_UNITS_PER_SECOND
+        )
+        self._openai = {}
+
+    def openai(self, model_name: str) -> AsyncLimiter:
+        """
+        The limiter of one OpenAI model, created on first use. Model names
+        come from clients: those not in OPENAI_MODELS (or given a rate) share
+        the "*" limiter, so there is a bounded number of limiters.
+        """
+        if model_name not in OPENAI_MODELS and model_name not in OPENAI_REQUESTS_PER_SECOND:
+            model_name = "*"
+        limiter = self._openai.get(model_name)
+        if limiter is None:
+            rate = OPENAI_REQUESTS_PER_SECOND.get(
+                model_name, OPENAI_REQUESTS_PER_SECOND.get("*")
+            )
+            limiter = self._openai[model_name] = AsyncLimiter(
+                f"openai:{model_name}",
+                concurrency=OPENAI_MAX_CONCURRENCY,
+                rate=rate,
+                max_wait=OPENAI_MAX_WAIT,
+            )
+        return limiter
+
+    def register_boto3(self, service: str, events):
+        """
+        Limit the calls of a boto3 client ("s3" or "dynamodb") through its
+        `meta.events`. Hooks run on the calling thread, so waits block it.
+        """
+        if service == "s3":
+            events.register("before-call.s3", self._before_s3_call)
+            events.register("after-call.s3", self._after_s3_call)
+            events.register("after-call-error.s3", self._after_s3_call)
+        elif service == "dynamodb":
+            events.register("before-call.dynamodb", self._before_dynamodb_call)
+            events.register("after-call.dynamodb", self._after_dynamodb_call)
+
+    # An earlier before-call handler can answer a call itself (e.g. a
+    # botocore Stubber), and then ours never ran: only calls marked in their
+    # request `context` are released / charged afterwards.
+
+    def _before_s3_call(self, context, **kwargs):
+        self.s3.acquire()
+        context["admitted"] = True
+
+    def _after_s3_call(self, context, **kwargs):
+        if context.pop("admitted", False):
+            self.s3.release()
+
+    def _before_dynamodb_call(self, model, params, context, **kwargs):
+        context["admitted"] = True
+        if model.name in DYNAMODB_WRITES:
+            if self.dynamodb_write.bucket is not None:
+                # `params` is the serialized request by now, its body the
+                # call's parameters as JSON. Writes wait as long as it takes,
+                # the write-behind queue applies the backpressure
+                body = json.loads(params.get("body") or "{}")
+                self.dynamodb_write.charge(dynamodb_write_units(model.name, body))
+        elif self.dynamodb_read.bucket is not None:
+            # Reads pay after the fact (see `_after_dynamodb_call`), but not
+            # while the budget is in debt
+            self.dynamodb_read.charge(0, self.dynamodb_read.max_wait)
+
+    def _after_dynamodb_call(self, model, parsed, context, **kwargs):
+        if not context.pop("admitted", False):
+            return
+        if model.name not in DYNAMODB_WRITES and self.dynamodb_read.bucket is not None:
+            self.dynamodb_read.bucket.reserve(dynamodb_read_units(parsed))
+
+    def metrics(self) -> dict:
+        return {
+            "chat": self.chat.metrics(),
+            **{limiter.name: limiter.metrics() for limiter in self._openai.values()},
+            "elevenlabs": self.elevenlabs.metrics(),
+            "s3": self.s3.metrics(),
+            "dynamodb_read": self.dynamodb_read.metrics(),
+            "dynamodb_write": self.dynamodb_write.metrics(),
+        }
+
+
+upstream_limits = UpstreamLimits()
@@ -0,0 +1,101 @@
+import asyncio
+import contextvars
+import functools
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+"""
+Helpers for calling blocking clients (boto3, requests) from async FastAPI handlers.
+
+boto3 has no native asyncio support, so its calls run on a dedicated, bounded
+thread pool instead of Starlette's shared threadpool. A turn that is waiting on
+DynamoDB or S3 only holds a pool thread for the duration of that one call, and
+the event loop stays free to serve other turns.
+"""
+
+# Size of the pool used for blocking upstream calls (DynamoDB, S3, presigning)
+BLOCKING_IO_WORKERS = int(os.getenv("BLOCKING_IO_WORKERS", "64"))
+
+_executor = None
+# The event loop that last called `run_blocking`, i.e. the app's
+_loop = None
+# A loop of our own for `run_on_loop` outside the app (scripts)
+_background_loop = None
+_background_lock = threading.Lock()
+
+
+def get_executor() -> ThreadPoolExecutor:
+    """
+    Return the shared thread pool for blocking I/O, creating it on first use.
+    """
+    global _executor
+    if _executor is None:
+        _executor = ThreadPoolExecutor(
+            max_workers=BLOCKING_IO_WORKERS, thread_name_prefix="blocking-io"
+        )
+    return _executor
+
+
+async def run_blocking(func, *args, **kwargs):
+    """
+    Run a blocking function on the shared I/O pool and await its result.
+
+    Parameters
+    ----------
+    func: The blocking callable, e.g. `table.put_item`.
+    *args, **kwargs: Passed through to `func`.
+
+    Returns
+    -------
+    Whatever `func` returns.
+    """
+    global _loop
+    loop = _loop = asyncio.get_running_loop()
+    # Like asyncio.to_thread, so the call sees the caller's context (e.g. its trace)
+    context = contextvars.copy_context()
+    return await loop.run_in_executor(
+        get_executor(), functools.partial(context.run, func, *args, **kwargs)
+    )
+
+
+def shutdown_executor(wait: bool = True):
+    """
+    Stop the shared I/O pool. A new pool is created if `run_blocking` is used again.
+    """
+    global _executor
+    if _executor is not None:
+        _executor.shutdown(wait=wait)
+        _executor = None
+
+
+def run_on_loop(coroutine):
+    """
+    Run a coroutine from blocking code (e.g. a function on the I/O pool) and
+    wait for its result.
+
+    The coroutine runs on the app's event loop, so it shares its loop-bound
+    limiters and async clients, and sees the caller's context (e.g. its
+    deadline). Outside the app, it runs on a background loop of its own.
+    Raises RuntimeError when called from an event loop, which it would block.
+    """
+    try:
+        asyncio.get_running_loop()
+    except RuntimeError:
+        pass
+    else:
+        coroutine.close()
+        raise RuntimeError("run_on_loop would block the event loop, await the coroutine")
+    loop = _loop if _loop is not None and _loop.is_running() else _get_background_loop()
+    return asyncio.run_coroutine_threadsafe(coroutine, loop).result()
+
+
+def _get_background_loop():
+    global _background_loop
+    with _background_lock:
+        if _background_loop is None:
+            _background_loop = asyncio.new_event_loop()
+            threading.Thread(
+                target=_background_loop.run_forever, name="background-loop", daemon=True
+            ).start()
+        return _background_loop
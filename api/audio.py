@@ -1,11 +1,24 @@
 from datetime import date
+import asyncio
 import os
-import requests
+import re
 from dotenv import find_dotenv, load_dotenv
-import boto3
-from botocore.exceptions import NoCredentialsError
 import io
+import logging
 import uuid
+import httpx
+
+from api.admission import Saturated, upstream_limits
+from api.aio import run_blocking, run_on_loop
+from api.clients import get_clients, ELEVENLABS_TIMEOUTS
+from api.logs import log_event
+from api.presign import PRESIGN_EXPIRATION, presigned_urls, sign
+from api.resilience import (
+    DeadlineExceeded,
+    call_timeout,
+    elevenlabs_policy,
+)
+from api.tracing import stage
 
 
 load_dotenv(find_dotenv())
@@ -14,6 +27,22 @@ load_dotenv(find_dotenv())
 Helper funtions for ElevenLabs (audio) and Amazon S3 (file storage)
 """
 
+ELEVENLABS_API_URL = os.getenv("ELEVENLABS_API_URL", "https://api.elevenlabs.io")
+ELEVENLABS_VOICE_ID = "21m00Tcm4TlvDq8ikWAM"
+ELEVENLABS_MODEL_ID = "eleven_monolingual_v1"
+ELEVENLABS_VOICE_SETTINGS = {"stability": 0, "similarity_boost": 0}
+ELEVENLABS_OUTPUT_FORMAT = "mp3_44100_128"
+AUDIO_BUCKET = "hippo-ai-audio"
+# Most characters ElevenLabs synthesizes in one request
+ELEVENLABS_CHARACTER_LIMIT = 5000
+# Longer texts are split into chunks of at most this many characters,
+# synthesized in parallel and concatenated
+TTS_CHUNK_CHARS = int(os.getenv("TTS_CHUNK_CHARS", "1500"))
+# Chunks of one text synthesized at once
+TTS_CHUNK_CONCURRENCY = int(os.getenv("TTS_CHUNK_CONCURRENCY", "8"))
+# S3 multipart parts must be at least 5 MiB, except the last
+S3_MIN_PART_BYTES = 5 * 1024**2
+
 
 def generate_mp3_file_name():
     """
@@ -28,67 +57,248 @@ def generate_mp3_file_name():
     return str(uuid.uuid4()) + ".mp3"
 
 
+def split_for_synthesis(text: str, max_chars: int = TTS_CHUNK_CHARS):
+    """
+    Split a text into chunks of at most `max_chars` characters, at paragraph
+    boundaries, then sentence boundaries, then spaces.
+
+    Returns
+    -------
+    The chunks in order. Short texts are returned as a single chunk.
+    """
+    if len(text) <= max_chars:
+        return [text]
+
+    pieces = []
+    for paragraph in re.split(r"\n\s*\n", text):
+        if len(paragraph) <= max_chars:
+            pieces.append(paragraph)
+            continue
+        for sentence in re.split(r"(?<=[.!?])\s+", paragraph):
+            while len(sentence) > max_chars:
+                cut = sentence.rfind(" ", 0, max_chars)
+                if cut <= 0:
+                    cut = max_chars
+                pieces.append(sentence[:cut])
+                sentence = sentence[cut:].lstrip()
+            pieces.append(sentence)
+
+    # Pack consecutive pieces, fewer requests for the same parallelism
+    chunks = []
+    current = ""
+    for piece in pieces:
+        piece = piece.strip()
+        if not piece:
+            continue
+        if current and len(current) + 1 + len(piece) > max_chars:
+            chunks.append(current)
+            current = piece
+        else:
+            current = f"{current} {piece}" if current else piece
+    if current:
+        chunks.append(current)
+    return chunks
+
+
 def get_elevenlabs_audio(message: str) -> bytes:
     """
     Convert a message into an audio file using the Labs API.
 
+    Blocking variant of `aget_elevenlabs_audio`, run on the event loop (see
+    `run_on_loop`) so it goes through the same ElevenLabs limiter, breaker
+    and retries. Don't call it from the event loop itself.
+
     Parameters
     ----------
     message (str): The message to be converted to audio format.
 
     Returns
     -------
-    The byte stream to the audio.
+    The byte stream to the audio, or None if ElevenLabs failed. Raises
+    `Saturated` (also when the breaker is open), like `aget_elevenlabs_audio`.
 
     Pre-Requisite:
     ---------------
     (1) ElevenLabs API Key is added to the `.env`
     """
-    # Limit usage for testing
-    CHARACTER_LIMIT = 5000
+    return run_on_loop(aget_elevenlabs_audio(message))
+
+
+async def aget_elevenlabs_audio(message: str) -> bytes:
+    """
+    Async variant of `get_elevenlabs_audio`.
+
+    Uses a non-blocking HTTP client, so waiting on ElevenLabs does not hold a thread.
+    """
+    if len(message) <= TTS_CHUNK_CHARS:
+        return await _asynthesize(message)
+
+    try:
+        return b"".join([clip async for clip in aiter_elevenlabs_audio_chunks(message)])
+    except RuntimeError as e:
+        logging.warning(f"No audio for a {len(message)} character reply: {str(e)}")
+        return None
+
+
+async def aiter_elevenlabs_audio_chunks(
+    message: str, concurrency: int = TTS_CHUNK_CONCURRENCY
+):
+    """
+    Synthesize a message in chunks (see `split_for_synthesis`), `concurrency`
+    at a time.
+
+    Yields
+    ------
+    The MP3 bytes of each chunk in order, as soon as it and the chunks before it
+    are done, so the total time approaches that of the slowest chunk. Raises
+    RuntimeError if a chunk still fails after its retries.
+    """
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def synthesize(chunk):
+        async with semaphore:
+            audio = await _asynthesize(chunk)
+        if not audio:
+            raise RuntimeError(f"No audio for a {len(chunk)} character chunk")
+        return audio
+
+    tasks = [
+        asyncio.ensure_future(synthesize(chunk)) for chunk in split_for_synthesis(message)
+    ]
+    try:
+        for task in tasks:
+            yield await task
+    finally:
+        for task in tasks:
+            task.cancel()
+
+
+async def _asynthesize(message: str) -> bytes:
+    """
+    Synthesize one request's worth of text, with the deadline, retries, hedging
+    and circuit breaker of `elevenlabs_policy`.
 
-    if len(message) > CHARACTER_LIMIT:
+    Returns
+    -------
+    The MP3 bytes, or None if ElevenLabs failed. Raises `Saturated` (also when
+    the breaker is open) so the caller skips the audio rather than failing it.
+    """
+    url, payload, headers = _build_elevenlabs_request(message)
+
+    async def post():
+        async with upstream_limits.elevenlabs.slot(len(message)):
+            with stage("tts", characters=len(message)) as span:
+                response = await get_clients().elevenlabs_async.post(
+                    url,
+                    json=payload,
+                    headers=headers,
+                    timeout=call_timeout(ELEVENLABS_TIMEOUTS),
+                )
+                span.add(bytes=len(response.content))
+        response.raise_for_status()
+        if not response.content:
+            raise httpx.HTTPError("ElevenLabs returned no audio")
+        return response.content
+
+    try:
+        return await elevenlabs_policy.call(post)
+    except Saturated:
+        # No budget left: the caller skips the audio rather than failing it
+        raise
+    except httpx.HTTPStatusError as e:
+        logging.warning(
+            f"ElevenLabs answered {e.response.status_code}: {e.response.text[:200]}"
+        )
+        return None
+    except (httpx.HTTPError, DeadlineExceeded) as e:
+        logging.warning(f"ElevenLabs request failed: {str(e)}")
+        return None
+
+    except Exception as e:
+        logging.error(f"Unexpected error synthesizing audio: {str(e)}")
+        return None
+
+
+async def aget_elevenlabs_audio_stream(message: str, optimize_streaming_latency: int = 3):
+    """
+    Stream the audio for a message from the ElevenLabs streaming endpoint.
+
+    Parameters
+    ----------
+    message (str): The message to be converted to audio format.
+    optimize_streaming_latency (int): 0 (default quality) to 4 (fastest first byte).
+
+    Yields
+    ------
+    MP3 bytes as they arrive. Raises `httpx.HTTPError` on a failed request, and
+    `Saturated` when the ElevenLabs budget is spent or its breaker is open.
+    Streams are not retried (their bytes may already be played), but count
+    towards the breaker.
+    """
+    url, payload, headers = _build_elevenlabs_request(
+        message, optimize_streaming_latency=optimize_streaming_latency, stream=True
+    )
+    elevenlabs_policy.breaker.check()
+    try:
+        async with upstream_limits.elevenlabs.slot(len(message)):
+            with stage("tts_stream", characters=len(message), bytes=0) as span:
+                async with get_clients().elevenlabs_async.stream(
+                    "POST",
+                    url,
+                    json=payload,
+                    headers=headers,
+                    timeout=call_timeout(ELEVENLABS_TIMEOUTS),
+                ) as response:
+                    response.raise_for_status()
+                    async for chunk in response.aiter_bytes():
+                        span.sizes["bytes"] += len(chunk)
+                        yield chunk
+    except (httpx.HTTPError, DeadlineExceeded) as e:
+        elevenlabs_policy.failed(e)
+        raise
+    except BaseException:
+        # Saturated, or the listener went away: says nothing of ElevenLabs
+        elevenlabs_policy.breaker.cancel_probe()
+        raise
+    elevenlabs_policy.breaker.success()
+
+
+def _build_elevenlabs_request(
+    message: str, optimize_streaming_latency: int = 0, stream: bool = False
+):
+    """
+    Build the (url, payload, headers) for a text-to-speech request.
+
+    Messages over the per-request limit are shortened, split longer texts with
+    `split_for_synthesis` first.
+    """
+    if len(message) > ELEVENLABS_CHARACTER_LIMIT:
         print(
-            f"🎤 Text received surpasses free limit, shortening to {CHARACTER_LIMIT} char."
+            f"🎤 Text received surpasses request limit, shortening to {ELEVENLABS_CHARACTER_LIMIT} char."
         )
-        message = message[0:CHARACTER_LIMIT]
+        message = message[0:ELEVENLABS_CHARACTER_LIMIT]
 
     print("🎤 Generating audio! Waiting for Eleven Labs...")
 
     payload = {
         "text": message,
-        "model_id": "eleven_monolingual_v1",
-        "voice_settings": {"stability": 0, "similarity_boost": 0},
+        "model_id": ELEVENLABS_MODEL_ID,
+        "voice_settings": ELEVENLABS_VOICE_SETTINGS,
     }
 
     headers = {
         "accept": "audio/mpeg",
-        "xi-api-key": os.getenv("ELEVEN_LABS_API_KEY"),
+        "xi-api-key": os.getenv("ELEVEN_LABS_API_KEY", ""),
         "Content-Type": "application/json",
     }
-    # You might get a 401 error if you run out of characters (10,000 for free)
-    try:
-        response = requests.post(
-            f"https://api.elevenlabs.io/v1/text-to-speech/21m00Tcm4TlvDq8ikWAM?optimize_streaming_latency=0",
-            json=payload,
-            headers=headers,
-        )
-        print(f"ElevenLabs Response: {response}")
-
-        if response.status_code == 200 and response.content:
-            return response.content
-        else:
-            print(f"Error? {response.status_code}: {response.content}")
-            return None
-    except requests.RequestException as e:
-        print(f"Error Block 1: {e}")
-        print(f"Error during request: {e}")
-        return None
-
-    except Exception as e:
-        print(f"Error: {e}")
-        print(f"Unexpected error: {e}")
-        return None
+    url = f"{ELEVENLABS_API_URL}/v1/text-to-speech/{ELEVENLABS_VOICE_ID}"
+    if stream:
+        url += "/stream"
+    url += (
+        f"?optimize_streaming_latency={optimize_streaming_latency}"
+        f"&output_format={ELEVENLABS_OUTPUT_FORMAT}"
+    )
+    return url, payload, headers
 
 
 def upload_audio_bytes_to_s3(audio_content, bucket, object_name, metadata=None):
@@ -100,13 +310,14 @@ def upload_audio_bytes_to_s3(audio_content, bucket, object_name, metadata=None):
         return False
 
     try:
-        s3_client = boto3.client("s3")
+        s3_client = get_clients().s3
         audio_file = io.BytesIO(audio_content)
         print(f"Converted to io.BytesIO: {type(audio_file)}")
         extra_args = {"ContentType": "audio/mpeg"}
         if metadata:
             extra_args["Metadata"] = metadata
-        s3_client.upload_fileobj(audio_file, bucket, object_name, ExtraArgs=extra_args)
+        with stage("s3_upload", bytes=len(audio_content)):
+            s3_client.upload_fileobj(audio_file, bucket, object_name, ExtraArgs=extra_args)
         print(f"✅ Audio upload to {bucket} (bucket) as '{object_name}'")
         return True
     except Exception as e:
@@ -114,10 +325,13 @@ def upload_audio_bytes_to_s3(audio_content, bucket, object_name, metadata=None):
         return False
 
 
-def get_s3_link(file_name, bucket_name, expiration=604800):
+def get_s3_link(file_name, bucket_name, expiration=PRESIGN_EXPIRATION):
     """
     Generate a pre-signed URL to access a private S3 object.
 
+    Links of the default expiration are served from the presigned URL cache
+    (see api/presign.py) while they stay valid long enough.
+
     Parameters:
     - file_name: The key/name of the file in the S3 bucket.
     - bucket_name: The name of the S3 bucket.
@@ -126,14 +340,15 @@ def get_s3_link(file_name, bucket_name, expiration=604800):
     Returns:
     - The pre-signed URL string or None if an error occurs.
     """
-    # Create a boto3 S3 client
-    s3_client = boto3.client("s3")
+    if expiration == presigned_urls.expiration:
+        return presigned_urls.get_link(file_name, bucket_name)
+
+    from botocore.exceptions import NoCredentialsError
+
+    s3_client = get_clients().s3
     try:
-        response = s3_client.generate_presigned_url(
-            "get_object",
-            Params={"Bucket": bucket_name, "Key": file_name},
-            ExpiresIn=expiration,
-        )
+        with stage("presign"):
+            response = sign(s3_client, bucket_name, file_name, expiration)
     except NoCredentialsError:
         print("Credentials not available for AWS S3")
         return None
@@ -142,3 +357,110 @@ def get_s3_link(file_name, bucket_name, expiration=604800):
         return None
     print(f"Got the presigned S3 URL, expires in {expiration} sec: {response}")
     return response
+
+
+async def aupload_audio_bytes_to_s3(audio_content, bucket, object_name, metadata=None):
+    """
+    Async variant of `upload_audio_bytes_to_s3`, run on the blocking I/O pool.
+    """
+    return await run_blocking(
+        upload_audio_bytes_to_s3, audio_content, bucket, object_name, metadata
+    )
+
+
+async def aupload_audio_chunks_to_s3(chunks, bucket, object_name, metadata=None):
+    """
+    Upload audio to S3 as it is produced, without buffering all of it.
+
+    Parts are sent with an S3 multipart upload as soon as S3_MIN_PART_BYTES
+    have arrived; audio smaller than one part is uploaded in one request.
+
+    Parameters
+    ----------
+    chunks: An async iterator of MP3 bytes, e.g. `aiter_elevenlabs_audio_chunks`.
+
+    Returns
+    -------
+    True if the whole object was uploaded. A failed multipart upload is aborted;
+    `Saturated` from the chunks is re-raised after that.
+    """
+    s3_client = get_clients().s3
+    buffer = bytearray()
+    upload_id = None
+    parts = []
+
+    async def upload_part():
+        with stage("s3_upload_part", bytes=len(buffer)):
+            response = await run_blocking(
+                s3_client.upload_part,
+                Bucket=bucket,
+                Key=object_name,
+                UploadId=upload_id,
+                PartNumber=len(parts) + 1,
+                Body=bytes(buffer),
+            )
+        parts.append({"PartNumber": len(parts) + 1, "ETag": response["ETag"]})
+        buffer.clear()
+
+    try:
+        async for chunk in chunks:
+            buffer.extend(chunk)
+            if len(buffer) < S3_MIN_PART_BYTES:
+                continue
+            if upload_id is None:
+                extra_args = {"Metadata": metadata} if metadata else {}
+                response = await run_blocking(
+                    s3_client.create_multipart_upload,
+                    Bucket=bucket,
+                    Key=object_name,
+                    ContentType="audio/mpeg",
+                    **extra_args,
+                )
+                upload_id = response["UploadId"]
+            await upload_part()
+
+        if upload_id is None:
+            return await aupload_audio_bytes_to_s3(
+                bytes(buffer), bucket, object_name, metadata
+            )
+        if buffer:
+            await upload_part()
+        await run_blocking(
+            s3_client.complete_multipart_upload,
+            Bucket=bucket,
+            Key=object_name,
+            UploadId=upload_id,
+            MultipartUpload={"Parts": parts},
+        )
+        log_event(
+            logging.INFO, "audio_uploaded", bucket=bucket, key=object_name, parts=len(parts)
+        )
+        return True
+    except Exception as e:
+        if not isinstance(e, Saturated):
+            logging.error(f"Upload of {object_name} to {bucket} failed: {str(e)}")
+        if upload_id is not None:
+            try:
+                await run_blocking(
+                    s3_client.abort_multipart_upload,
+                    Bucket=bucket,
+                    Key=object_name,
+                    UploadId=upload_id,
+                )
+            except Exception as abort_error:
+                logging.warning(
+                    f"Could not abort the multipart upload of {object_name}: {str(abort_error)}"
+                )
+        if isinstance(e, Saturated):
+            raise
+        return False
+
+
+async def aget_s3_link(file_name, bucket_name, expiration=PRESIGN_EXPIRATION):
+    """
+    Async variant of `get_s3_link`. Cached links are returned without leaving
+    the event loop, others are signed on the blocking I/O pool.
+    """
+    if expiration == presigned_urls.expiration:
+        return await presigned_urls.aget_link(file_name, bucket_name)
+    return await run_blocking(get_s3_link, file_name, bucket_name, expiration)
@@ -0,0 +1,217 @@
+import asyncio
+import logging
+import os
+from collections import OrderedDict
+
+from api.admission import Saturated
+from api.audio import (
+    AUDIO_BUCKET,
+    aget_s3_link,
+    aupload_audio_bytes_to_s3,
+    generate_mp3_file_name,
+)
+from api.resilience import AUDIO_JOB_DEADLINE, start_deadline
+from api.tts_cache import tts_cache
+from update_table import aset_audio_file_url
+
+"""
+Background audio pipeline: text-to-speech, S3 upload and presigning run on an
+in-process job queue so /chat can respond as soon as the text reply is stored.
+
+Clients poll `GET /chat/audio/{chat_id}/{timestamp}` for the job's status.
+Replies whose audio already exists reuse it (see api/tts_cache.py).
+"""
+
+# Number of jobs synthesized at once
+AUDIO_WORKERS = int(os.getenv("AUDIO_WORKERS", "8"))
+# Jobs waiting for a worker; new jobs fail fast once this is reached
+AUDIO_QUEUE_SIZE = int(os.getenv("AUDIO_QUEUE_SIZE", "1000"))
+# Finished jobs kept in memory for status lookups
+AUDIO_JOBS_TRACKED = 10000
+
+PENDING = "pending"
+READY = "ready"
+FAILED = "failed"
+# No audio because the ElevenLabs budget was spent (see api/admission.py)
+SKIPPED = "skipped"
+
+
+class AudioJob:
+    """
+    Audio for one stored AI message, identified by (chat_id, timestamp).
+    """
+
+    def __init__(self, chat_id: str, timestamp: int, message: str):
+        self.chat_id = chat_id
+        self.timestamp = timestamp
+        self.message = message
+        self.status = PENDING
+        self.audio_link = None
+        self.audio_file_name = None
+        self.error = None
+        self.done = asyncio.Event()
+
+    def finish(self, status: str, error: str = None):
+        self.status = status
+        self.error = error
+        self.done.set()
+
+    def to_dict(self) -> dict:
+        return {
+            "chat_id": self.chat_id,
+            "timestamp": self.timestamp,
+            "status": self.status,
+            "audio_link": self.audio_link,
+            "audio_file_name": self.audio_file_name,
+            "error": self.error,
+        }
+
+
+async def attach_audio(chat_id: str, timestamp: int, s3_file_name: str):
+    """
+    Presign a link to a message's audio and record its S3 key on the DynamoDB
+    item as `AudioFileURL`.
+
+    Returns
+    -------
+    The presigned link.
+    """
+    audio_link = await aget_s3_link(file_name=s3_file_name, bucket_name=AUDIO_BUCKET)
+    await aset_audio_file_url(chat_id, timestamp, s3_file_name)
+    return audio_link
+
+
+async def save_audio(chat_id: str, timestamp: int, audio: bytes):
+    """
+    Upload a message's audio to S3 under a new random name and attach it with
+    `attach_audio`.
+
+    Returns
+    -------
+    (s3_file_name, audio_link), or None if the upload failed.
+    """
+    s3_file_name = generate_mp3_file_name()
+    upload_status = await aupload_audio_bytes_to_s3(
+        audio_content=audio,
+        bucket=AUDIO_BUCKET,
+        object_name=s3_file_name,
+        metadata={
+            "ContentType": "audio/mpeg",
+            "x-amz-meta-chatid": chat_id,
+            # TROUBLESHOOTING: this has to be a string
+            "x-amz-meta-timestamp": str(timestamp),
+        },
+    )
+    if not upload_status:
+        return None
+
+    audio_link = await attach_audio(chat_id, timestamp, s3_file_name)
+    return s3_file_name, audio_link
+
+
+async def generate_audio(job: AudioJob):
+    """
+    Get the job's audio from the TTS cache, synthesizing it on a miss, and
+    attach it to the message. Skipped when ElevenLabs is saturated or its
+    circuit breaker is open.
+    """
+    start_deadline(AUDIO_JOB_DEADLINE)
+    try:
+        s3_file_name = await tts_cache.get_object_name(job.message)
+    except Saturated as e:
+        job.finish(SKIPPED, str(e))
+        return
+    if not s3_file_name:
+        job.finish(FAILED, "No audio returned by ElevenLabs or upload to S3 failed")
+        return
+
+    job.audio_file_name = s3_file_name
+    job.audio_link = await attach_audio(job.chat_id, job.timestamp, s3_file_name)
+    job.finish(READY)
+
+
+class AudioJobQueue:
+    """
+    A bounded queue of `AudioJob`s drained by a fixed number of worker tasks.
+
+    Workers start on the first `submit` (or `start`) in the running event loop.
+    """
+
+    def __init__(
+        self,
+        workers: int = AUDIO_WORKERS,
+        maxsize: int = AUDIO_QUEUE_SIZE,
+        max_tracked: int = AUDIO_JOBS_TRACKED,
+    ):
+        self.workers = workers
+        self.maxsize = maxsize
+        self.max_tracked = max_tracked
+        self.jobs = OrderedDict()
+        self._queue = None
+        self._tasks = []
+        self._loop = None
+
+    def start(self):
+        loop = asyncio.get_running_loop()
+        if self._tasks and self._loop is loop:
+            return
+        # (Re)start in this loop, e.g. the workers of a previous loop are gone
+        self._loop = loop
+        self._queue = asyncio.Queue(maxsize=self.maxsize)
+        self._tasks = [
+            asyncio.create_task(self._worker()) for _ in range(self.workers)
+        ]
+
+    async def stop(self):
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+        self._queue = None
+        self._loop = None
+
+    def submit(self, chat_id: str, timestamp: int, message: str) -> AudioJob:
+        """
+        Queue audio generation for a stored message and return its job.
+        """
+        self.start()
+        job = AudioJob(chat_id, timestamp, message)
+        self._track(job)
+        try:
+            self._queue.put_nowait(job)
+        except asyncio.QueueFull:
+            logging.warning(f"Audio queue full, skipping audio for {chat_id}")
+            job.finish(FAILED, "Audio queue is full")
+        return job
+
+    def get(self, chat_id: str, timestamp: int):
+        return self.jobs.get((chat_id, int(timestamp)))
+
+    async def wait(self, job: AudioJob, timeout: float) -> AudioJob:
+        """
+        Wait up to `timeout` seconds for the job to finish (long-polling).
+        """
+        try:
+            await asyncio.wait_for(job.done.wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
+        return job
+
+    def _track(self, job: AudioJob):
+        self.jobs[(job.chat_id, int(job.timestamp))] = job
+        while len(self.jobs) > self.max_tracked:
+            self.jobs.popitem(last=False)
+
+    async def _worker(self):
+        while True:
+            job = await self._queue.get()
+            try:
+                await generate_audio(job)
+            except Exception as e:
+                logging.error(f"Audio job failed for {job.chat_id}: {str(e)}")
+                job.finish(FAILED, str(e))
+            finally:
+                self._queue.task_done()
+
+
+audio_jobs = AudioJobQueue()
@@ -0,0 +1,314 @@
+"""
+WebSocket chat sessions: the chat's history is loaded and its chain built once
+per connection, then kept warm in memory for every turn of the session.
+
+Protocol (JSON text frames):
+- client, first frame: {"chat_id", "model", "prompt_template", "temperature"?}
+- server: {"event": "ready", "chat_id", "history": <messages loaded>}
+- client, per turn: {"message", "timestamp", "audio"?: true}
+- server: {"event": "token", "token"}* then {"event": "done", "response",
+  "timestamp"}, and later {"event": "audio", "timestamp", "audio_status",
+  "audio_link", "audio_file_name"} once the reply's audio is ready
+- server, on a bad frame or failed turn: {"event": "error", "error"}, with
+  "retry_after" (seconds) when the turn wasn't admitted (see api/admission.py)
+  or its message couldn't be stored
+
+Messages are stored like those of /chat: queued for a batched write unless
+MESSAGE_WRITES is "sync" (see update_table.py). Sessions are closed after
+CHAT_SESSION_IDLE_TIMEOUT seconds without a frame, and a worker holds at most
+CHAT_SESSIONS_MAX.
+"""
+
+import asyncio
+import json
+import logging
+import os
+
+from starlette.websockets import WebSocket, WebSocketDisconnect
+
+from api.admission import Saturated, upstream_limits
+from api.audio_jobs import audio_jobs
+from api.resilience import CHAT_DEADLINE, start_deadline
+from api.tokens import count_message_tokens
+from chatbot import astream_response, convert_to_langchain_messages, initialize_chatbot
+from update_table import (
+    HISTORY_TOKEN_BUDGET,
+    MessageNotStored,
+    aconfirm_stored,
+    aget_recent_messages_for_chat,
+    astore_message,
+    current_epoch_time,
+)
+
+
+# Seconds without a client frame before a session is closed
+CHAT_SESSION_IDLE_TIMEOUT = float(os.getenv("CHAT_SESSION_IDLE_TIMEOUT", "300"))
+# Live sessions per worker; more connections are refused with 1013 (try again later)
+CHAT_SESSIONS_MAX = int(os.getenv("CHAT_SESSIONS_MAX", "1000"))
+# Longest a session waits for a reply's audio before giving up on the notification
+CHAT_SESSION_AUDIO_WAIT = 120
+
+# WebSocket close codes
+CLOSE_NORMAL = 1000
+CLOSE_GOING_AWAY = 1001
+CLOSE_POLICY = 1008
+CLOSE_TRY_AGAIN_LATER = 1013
+CLOSE_REPLACED = 4000
+
+
+class ChatSession:
+    """
+    One connected chat: its socket, its warm chain and its history.
+    """
+
+    def __init__(
+        self,
+        websocket: WebSocket,
+        chat_id: str,
+        model: str,
+        temperature: float,
+        prompt_template: str,
+    ):
+        self.websocket = websocket
+        self.chat_id = chat_id
+        self.model = model
+        self.temperature = temperature
+        self.prompt_template = prompt_template
+        self.conversation = None
+        self.last_timestamp = 0
+        self.turns = 0
+        self._send_lock = asyncio.Lock()
+        self._audio_tasks = set()
+
+    @property
+    def history(self):
+        return self.conversation.memory.chat_memory
+
+    async def load(self):
+        """
+        Load the chat's recent history and build its chain.
+        """
+        messages = await aget_recent_messages_for_chat(
+            self.chat_id, model_name=self.model
+        )
+        self.conversation = initialize_chatbot(
+            model_name=self.model,
+            temperature=self.temperature,
+            prompt_template=self.prompt_template,
+            message_history=convert_to_langchain_messages(messages),
+        )
+        if messages:
+            self.last_timestamp = int(messages[-1]["timestamp"])
+        return len(messages)
+
+    async def send(self, event: str, **data):
+        async with self._send_lock:
+            await self.websocket.send_text(json.dumps({"event": event, **data}))
+
+    async def turn(self, message: str, timestamp: int, audio: bool = True):
+        """
+        Answer one message: stream the reply, store both messages and queue the
+        reply's audio, whose notification is sent when it is ready.
+
+        The user's message joins the warm history once it is written, whether
+        or not the LLM answered, so the history stays in line with the table.
+        When it couldn't be written, the turn fails with `MessageNotStored`.
+        """
+        stored = await astore_message(self.chat_id, timestamp, message, "user")
+
+        tokens = []
+        try:
+            async for token in astream_response(self.conversation, message):
+                tokens.append(token)
+                await self.send("token", token=token)
+        finally:
+            # Written while the LLM ran, so this rarely waits
+            await aconfirm_stored(stored)
+            self.history.add_user_message(message)
+        response = "".join(tokens)
+
+        # Replies within the same second would overwrite each other
+        bot_timestamp = max(
+            current_epoch_time(), int(timestamp) + 1, self.last_timestamp + 1
+        )
+        self.last_timestamp = bot_timestamp
+        if response:
+            await astore_message(self.chat_id, bot_timestamp, response, "ai")
+            self.history.add_ai_message(response)
+        self._trim_history()
+        self.turns += 1
+        await self.send("done", response=response, timestamp=bot_timestamp)
+
+        if response and audio:
+            job = audio_jobs.submit(self.chat_id, bot_timestamp, response)
+            task = asyncio.create_task(self._notify_audio(job))
+            self._audio_tasks.add(task)
+            task.add_done_callback(self._audio_tasks.discard)
+
+    async def _notify_audio(self, job):
+        await audio_jobs.wait(job, timeout=CHAT_SESSION_AUDIO_WAIT)
+        try:
+            await self.send(
+                "audio",
+                timestamp=job.timestamp,
+                audio_status=job.status,
+                audio_link=job.audio_link,
+                audio_file_name=job.audio_file_name,
+            )
+        except Exception:
+            # The socket closed in the meantime, the client can poll /chat/audio
+            pass
+
+    def _trim_history(self):
+        """
+        Drop the oldest messages past HISTORY_TOKEN_BUDGET, like a fresh load would.
+        """
+        messages = self.history.messages
+        tokens = [count_message_tokens(m.content, self.model) for m in messages]
+        total = sum(tokens)
+        drop = 0
+        while total > HISTORY_TOKEN_BUDGET and drop < len(messages) - 1:
+            total -= tokens[drop]
+            drop += 1
+        if drop:
+            del messages[:drop]
+
+    def cancel(self):
+        for task in self._audio_tasks:
+            task.cancel()
+
+
+class ChatSessionRegistry:
+    """
+    The live sessions of this worker, at most one per chat.
+    """
+
+    def __init__(
+        self,
+        max_sessions: int = CHAT_SESSIONS_MAX,
+        idle_timeout: float = CHAT_SESSION_IDLE_TIMEOUT,
+    ):
+        self.max_sessions = max_sessions
+        self.idle_timeout = idle_timeout
+        self.sessions = {}
+        self.stats = {
+            "opened": 0,
+            "closed": 0,
+            "idle_closed": 0,
+            "replaced": 0,
+            "rejected": 0,
+            "turns": 0,
+        }
+
+    async def serve(self, websocket: WebSocket):
+        """
+        Accept a WebSocket and run its session until it closes.
+        """
+        await websocket.accept()
+        session = None
+        try:
+            hello = await self._receive(websocket)
+            if hello is None:
+                return
+            if not hello.get("chat_id"):
+                await _send_error(websocket, "chat_id is required")
+                await websocket.close(code=CLOSE_POLICY)
+                return
+
+            chat_id = str(hello["chat_id"])
+            if chat_id not in self.sessions and len(self.sessions) >= self.max_sessions:
+                self.stats["rejected"] += 1
+                await _send_error(websocket, "Too many sessions")
+                await websocket.close(code=CLOSE_TRY_AGAIN_LATER)
+                return
+
+            session = ChatSession(
+                websocket,
+                chat_id,
+                model=hello.get("model", "gpt-3.5-turbo"),
+                temperature=hello.get("temperature", 0.2),
+                prompt_template=hello.get("prompt_template", "girlfriend"),
+            )
+            await self._register(session)
+            history = await session.load()
+            await session.send("ready", chat_id=chat_id, history=history)
+
+            while True:
+                frame = await self._receive(websocket)
+                if frame is None:
+                    return
+                if not isinstance(frame.get("message"), str) or "timestamp" not in frame:
+                    await session.send("error", error="message and timestamp are required")
+                    continue
+                try:
+                    start_deadline(CHAT_DEADLINE)
+                    async with upstream_limits.chat.slot():
+                        await session.turn(
+                            frame["message"],
+                            int(frame["timestamp"]),
+                            frame.get("audio", True),
+                        )
+                    self.stats["turns"] += 1
+                except WebSocketDisconnect:
+                    raise
+                except (Saturated, MessageNotStored) as e:
+                    await session.send("error", error=str(e), retry_after=e.retry_after)
+                except Exception as e:
+                    logging.error(f"Session turn failed for {chat_id}: {str(e)}")
+                    await session.send("error", error=str(e))
+        except WebSocketDisconnect:
+            pass
+        finally:
+            if session is not None:
+                self._unregister(session)
+
+    async def close_all(self):
+        for session in list(self.sessions.values()):
+            await self._close(session, CLOSE_GOING_AWAY)
+
+    def metrics(self) -> dict:
+        return {**self.stats, "live": len(self.sessions), "max_sessions": self.max_sessions}
+
+    async def _receive(self, websocket: WebSocket):
+        """
+        Return the next frame, or None once the session was closed for idling.
+        """
+        try:
+            text = await asyncio.wait_for(websocket.receive_text(), self.idle_timeout)
+        except asyncio.TimeoutError:
+            self.stats["idle_closed"] += 1
+            await websocket.close(code=CLOSE_NORMAL, reason="idle")
+            return None
+        try:
+            frame = json.loads(text)
+        except ValueError:
+            frame = None
+        return frame if isinstance(frame, dict) else {}
+
+    async def _register(self, session: ChatSession):
+        previous = self.sessions.get(session.chat_id)
+        self.sessions[session.chat_id] = session
+        self.stats["opened"] += 1
+        if previous is not None:
+            # A newer connection of the same chat takes over its state
+            self.stats["replaced"] += 1
+            await self._close(previous, CLOSE_REPLACED)
+
+    def _unregister(self, session: ChatSession):
+        session.cancel()
+        if self.sessions.get(session.chat_id) is session:
+            del self.sessions[session.chat_id]
+        self.stats["closed"] += 1
+
+    async def _close(self, session: ChatSession, code: int):
+        try:
+            await session.websocket.close(code=code)
+        except Exception:
+            pass
+
+
+async def _send_error(websocket: WebSocket, error: str):
+    await websocket.send_text(json.dumps({"event": "error", "error": error}))
+
+
+chat_sessions = ChatSessionRegistry()
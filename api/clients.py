@@ -0,0 +1,403 @@
+import inspect
+import logging
+import os
+import threading
+import time
+
+import httpx
+import requests
+from requests.adapters import HTTPAdapter
+
+from api.admission import upstream_limits
+
+"""
+Shared, pooled clients for every upstream (DynamoDB, S3, ElevenLabs, OpenAI).
+
+Building a boto3 client resolves credentials and endpoints and opens a new
+connection pool, so each client is built once per process (on first use, or
+up front by `ClientRegistry.warm` on FastAPI startup) and reused by every
+request. boto3 clients, `requests.Session` and the httpx clients are safe to
+share between threads.
+"""
+
+AWS_REGION = os.getenv("AWS_REGION", "us-west-2")
+# Connections per client, keep this >= BLOCKING_IO_WORKERS so no thread waits on the pool
+MAX_POOL_CONNECTIONS = int(os.getenv("MAX_POOL_CONNECTIONS", "64"))
+
+# Timeouts in seconds: (connect, read)
+AWS_TIMEOUTS = (3, 10)
+ELEVENLABS_TIMEOUTS = (3, 60)
+OPENAI_TIMEOUTS = (3, 60)
+# Retries of the OpenAI client itself (exponential backoff with jitter, honours
+# Retry-After), within the request's deadline, see api/resilience.py
+OPENAI_MAX_RETRIES = int(os.getenv("OPENAI_MAX_RETRIES", "2"))
+
+CLIENT_NAMES = ("s3", "dynamodb", "elevenlabs", "elevenlabs_async", "openai", "openai_async")
+
+
+class PoolStats:
+    """
+    Request counters for one client: total, in flight, peak in flight, errors.
+    """
+
+    def __init__(self):
+        self.requests = 0
+        self.in_flight = 0
+        self.peak_in_flight = 0
+        self.errors = 0
+        self._lock = threading.Lock()
+
+    def started(self, *args, **kwargs):
+        with self._lock:
+            self.requests += 1
+            self.in_flight += 1
+            self.peak_in_flight = max(self.peak_in_flight, self.in_flight)
+
+    def finished(self, *args, **kwargs):
+        with self._lock:
+            self.in_flight -= 1
+
+    def failed(self, *args, **kwargs):
+        with self._lock:
+            self.in_flight -= 1
+            self.errors += 1
+
+    def to_dict(self) -> dict:
+        return {
+            "requests": self.requests,
+            "in_flight": self.in_flight,
+            "peak_in_flight": self.peak_in_flight,
+            "errors": self.errors,
+        }
+
+
+class TrackedAdapter(HTTPAdapter):
+    """`requests` adapter that records each request in a `PoolStats`."""
+
+    def __init__(self, stats: PoolStats, **kwargs):
+        self.stats = stats
+        super().__init__(**kwargs)
+
+    def send(self, request, **kwargs):
+        self.stats.started()
+        try:
+            response = super().send(request, **kwargs)
+        except Exception:
+            self.stats.failed()
+            raise
+        if response.status_code >= 400:
+            self.stats.failed()
+        else:
+            self.stats.finished()
+        return response
+
+
+class TrackedTransport(httpx.BaseTransport):
+    """httpx transport that records each request in a `PoolStats`."""
+
+    def __init__(self, stats: PoolStats, **kwargs):
+        self.stats = stats
+        self.transport = httpx.HTTPTransport(**kwargs)
+
+    def handle_request(self, request):
+        self.stats.started()
+        try:
+            response = self.transport.handle_request(request)
+        except Exception:
+            self.stats.failed()
+            raise
+        if response.status_code >= 400:
+            self.stats.failed()
+        else:
+            self.stats.finished()
+        return response
+
+    def close(self):
+        self.transport.close()
+
+
+class TrackedAsyncTransport(httpx.AsyncBaseTransport):
+    """Async httpx transport that records each request in a `PoolStats`."""
+
+    def __init__(self, stats: PoolStats, **kwargs):
+        self.stats = stats
+        self.transport = httpx.AsyncHTTPTransport(**kwargs)
+
+    async def handle_async_request(self, request):
+        self.stats.started()
+        try:
+            response = await self.transport.handle_async_request(request)
+        except Exception:
+            self.stats.failed()
+            raise
+        if response.status_code >= 400:
+            self.stats.failed()
+        else:
+            self.stats.finished()
+        return response
+
+    async def aclose(self):
+        await self.transport.aclose()
+
+
+def _httpx_timeout(timeouts):
+    connect, read = timeouts
+    return httpx.Timeout(read, connect=connect)
+
+
+def _httpx_limits():
+    return httpx.Limits(
+        max_connections=MAX_POOL_CONNECTIONS,
+        max_keepalive_connections=MAX_POOL_CONNECTIONS,
+    )
+
+
+def _httpx_connections(client) -> dict:
+    """Open / idle connections of an httpx client's pool (best effort)."""
+    transport = getattr(client, "_transport", None)
+    transport = getattr(transport, "transport", transport)
+    pool = getattr(transport, "_pool", None)
+    connections = getattr(pool, "connections", None)
+    if connections is None:
+        return {}
+    return {
+        "open_connections": len(connections),
+        "idle_connections": sum(c.is_idle() for c in connections),
+    }
+
+
+def _requests_connections(session) -> dict:
+    """Open / idle connections of a `requests.Session`'s pools (best effort)."""
+    adapter = session.get_adapter("https://")
+    pools = [adapter.poolmanager.pools[key] for key in adapter.poolmanager.pools.keys()]
+    return {
+        "open_connections": sum(pool.num_connections for pool in pools),
+        "idle_connections": sum(pool.pool.qsize() for pool in pools if pool.pool),
+    }
+
+
+class ClientRegistry:
+    """
+    Lazily built, process-wide upstream clients with their pool metrics.
+
+    Use `override` to swap in stand-ins (see `demos/fakes.py`).
+    """
+
+    def __init__(self, max_pool_connections: int = MAX_POOL_CONNECTIONS):
+        self.max_pool_connections = max_pool_connections
+        self.stats = {}
+        self.build_seconds = {}
+        self._clients = {}
+        self._overrides = {}
+        self._lock = threading.RLock()
+        # Called when clients are replaced or closed, to drop what holds them
+        self._reset_callbacks = []
+
+    def on_reset(self, callback):
+        """
+        Call `callback()` whenever clients are overridden or closed, e.g. to
+        drop cached objects built with the previous clients.
+        """
+        self._reset_callbacks.append(callback)
+
+    def _reset(self):
+        for callback in self._reset_callbacks:
+            callback()
+
+    def _get(self, name, factory):
+        client = self._overrides.get(name) or self._clients.get(name)
+        if client is None:
+            with self._lock:
+                client = self._clients.get(name)
+                if client is None:
+                    start = time.perf_counter()
+                    self.stats.setdefault(name, PoolStats())
+                    client = self._clients[name] = factory()
+                    self.build_seconds[name] = time.perf_counter() - start
+        return client
+
+    def override(self, **clients):
+        """
+        Replace clients by name, e.g. `override(s3=FakeS3Client())`.
+
+        Overrides are kept (and not closed) by `aclose`.
+        """
+        with self._lock:
+            for name, client in clients.items():
+                self.stats.setdefault(name, PoolStats())
+                self._overrides[name] = client
+        self._reset()
+
+    def _boto3_config(self):
+        # boto3 and botocore are imported on first use, they take a while
+        from botocore.config import Config
+
+        connect, read = AWS_TIMEOUTS
+        return Config(
+            region_name=AWS_REGION,
+            max_pool_connections=self.max_pool_connections,
+            connect_timeout=connect,
+            read_timeout=read,
+            retries={"mode": "standard"},
+        )
+
+    def _track_boto3(self, name, client):
+        stats = self.stats[name]
+        events = client.meta.events
+        events.register("before-call", stats.started)
+        events.register("after-call", stats.finished)
+        events.register("after-call-error", stats.failed)
+        # Concurrency and capacity limits, see api/admission.py
+        upstream_limits.register_boto3(name, events)
+
+    @property
+    def s3(self):
+        def create():
+            import boto3
+
+            client = boto3.client("s3", config=self._boto3_config())
+            self._track_boto3("s3", client)
+            return client
+
+        return self._get("s3", create)
+
+    @property
+    def dynamodb(self):
+        """
+        The DynamoDB resource. Table operations delegate to its thread-safe
+        low-level client, so one resource is shared across threads.
+        """
+
+        def create():
+            import boto3
+
+            resource = boto3.resource("dynamodb", config=self._boto3_config())
+            self._track_boto3("dynamodb", resource.meta.client)
+            return resource
+
+        return self._get("dynamodb", create)
+
+    def table(self, table_name: str):
+        return self._get(f"table:{table_name}", lambda: self.dynamodb.Table(table_name))
+
+    @property
+    def elevenlabs(self) -> requests.Session:
+        """Keep-alive session for the blocking ElevenLabs calls."""
+
+        def create():
+            session = requests.Session()
+            adapter = TrackedAdapter(
+                self.stats["elevenlabs"],
+                pool_connections=1,
+                pool_maxsize=self.max_pool_connections,
+            )
+            session.mount("https://", adapter)
+            session.mount("http://", adapter)
+            return session
+
+        return self._get("elevenlabs", create)
+
+    @property
+    def elevenlabs_async(self) -> httpx.AsyncClient:
+        """Keep-alive async client for ElevenLabs."""
+        return self._get(
+            "elevenlabs_async",
+            lambda: httpx.AsyncClient(
+                timeout=_httpx_timeout(ELEVENLABS_TIMEOUTS),
+                transport=TrackedAsyncTransport(
+                    self.stats["elevenlabs_async"], limits=_httpx_limits()
+                ),
+            ),
+        )
+
+    @property
+    def openai(self):
+        def create():
+            # Imported on first use, it takes a while
+            import openai
+
+            return openai.OpenAI(
+                max_retries=OPENAI_MAX_RETRIES,
+                http_client=httpx.Client(
+                    timeout=_httpx_timeout(OPENAI_TIMEOUTS),
+                    transport=TrackedTransport(
+                        self.stats["openai"], limits=_httpx_limits()
+                    ),
+                ),
+            )
+
+        return self._get("openai", create)
+
+    @property
+    def openai_async(self):
+        def create():
+            import openai
+
+            return openai.AsyncOpenAI(
+                max_retries=OPENAI_MAX_RETRIES,
+                http_client=httpx.AsyncClient(
+                    timeout=_httpx_timeout(OPENAI_TIMEOUTS),
+                    transport=TrackedAsyncTransport(
+                        self.stats["openai_async"], limits=_httpx_limits()
+                    ),
+                ),
+            )
+
+        return self._get("openai_async", create)
+
+    def warm(self):
+        """
+        Build every client up front, e.g. on FastAPI startup.
+        """
+        for name in CLIENT_NAMES:
+            try:
+                getattr(self, name)
+            except Exception as e:
+                logging.warning(f"Could not build the {name} client: {str(e)}")
+
+    def metrics(self) -> dict:
+        """
+        Per-client request counters, pool size and open/idle connections.
+        """
+        metrics = {}
+        for name, client in list({**self._clients, **self._overrides}.items()):
+            if name.startswith("table:"):
+                continue
+            entry = {"max_pool_connections": self.max_pool_connections}
+            if name in self.build_seconds:
+                entry["build_seconds"] = round(self.build_seconds[name], 4)
+            entry.update(self.stats[name].to_dict())
+            if isinstance(client, requests.Session):
+                entry.update(_requests_connections(client))
+            elif isinstance(client, (httpx.Client, httpx.AsyncClient)):
+                entry.update(_httpx_connections(client))
+            elif isinstance(getattr(client, "_client", None), (httpx.Client, httpx.AsyncClient)):
+                # openai.OpenAI / AsyncOpenAI, wrapping an httpx client
+                entry.update(_httpx_connections(client._client))
+            metrics[name] = entry
+        return metrics
+
+    async def aclose(self):
+        """
+        Close every client's connections. Clients are rebuilt if used again.
+        """
+        with self._lock:
+            clients, self._clients = self._clients, {}
+        self._reset()
+        for name, client in clients.items():
+            if name.startswith("table:"):
+                continue
+            client = getattr(getattr(client, "meta", None), "client", client)
+            close = getattr(client, "aclose", None) or getattr(client, "close", None)
+            if close is None:
+                continue
+            result = close()
+            if inspect.isawaitable(result):
+                await result
+
+
+_registry = ClientRegistry()
+
+
+def get_clients() -> ClientRegistry:
+    return _registry
@@ -0,0 +1,171 @@
+import os
+import threading
+import time
+from collections import OrderedDict
+
+"""
+In-process, write-through cache of recent chat messages keyed by ChatID.
+
+`store_message` adds every message it writes to the cached chat, so the next
+turn's history is served from memory instead of re-querying the partition.
+A chat is cached as its newest messages (a suffix of the chat); `complete`
+marks chats whose full history is cached.
+
+Another worker may write to a cached chat, so update_table checks a hit
+against the table with a consistent Query of the chat's newest key (one small
+read instead of the history) and drops the chat when that key isn't cached,
+see `update_table._cached_chat`. Deployments routing each chat to a single
+worker can skip the check with CONVERSATION_CACHE_VERIFY=0.
+"""
+
+# Total size of cached messages before least recently used chats are evicted
+CONVERSATION_CACHE_BYTES = int(os.getenv("CONVERSATION_CACHE_BYTES", str(64 * 1024**2)))
+# Seconds a chat stays cached after it was loaded from DynamoDB
+CONVERSATION_CACHE_TTL = int(os.getenv("CONVERSATION_CACHE_TTL", "600"))
+# Check a cached chat's newest message against the table on every hit
+CONVERSATION_CACHE_VERIFY = os.getenv("CONVERSATION_CACHE_VERIFY", "1") == "1"
+# Approximate memory of an item besides its message text
+ITEM_OVERHEAD_BYTES = 200
+
+
+def item_size(item) -> int:
+    message = item.get("message", "")
+    return ITEM_OVERHEAD_BYTES + (len(message) if isinstance(message, (str, bytes)) else 0)
+
+
+class CachedChat:
+    def __init__(self, items, complete, expires_at):
+        # timestamp -> item, in chronological order
+        self.items = OrderedDict((item["timestamp"], item) for item in items)
+        self.complete = complete
+        self.expires_at = expires_at
+        self.size = sum(item_size(item) for item in items)
+
+    def add(self, item):
+        timestamp = item["timestamp"]
+        old = self.items.get(timestamp)
+        if old is not None:
+            self.size -= item_size(old)
+        self.items[timestamp] = item
+        self.size += item_size(item)
+        # Out of order writes (e.g. client timestamps) are rare, re-sort then
+        if next(reversed(self.items)) != timestamp:
+            self.items = OrderedDict(sorted(self.items.items()))
+
+
+class ConversationCache:
+    """
+    LRU of `CachedChat`s bounded by total bytes, with a TTL and eviction stats.
+    """
+
+    def __init__(
+        self,
+        max_bytes: int = CONVERSATION_CACHE_BYTES,
+        ttl: float = CONVERSATION_CACHE_TTL,
+    ):
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.size = 0
+        self.stats = {"hits": 0, "misses": 0, "evictions": 0, "expirations": 0, "stale": 0}
+        self._chats = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, chat_id: str):
+        """
+        Return (messages in chronological order, complete), or None on a miss.
+        """
+        with self._lock:
+            chat = self._chats.get(chat_id)
+            if chat is not None and chat.expires_at <= time.monotonic():
+                self._remove(chat_id)
+                self.stats["expirations"] += 1
+                chat = None
+            if chat is None:
+                self.stats["misses"] += 1
+                return None
+            self._chats.move_to_end(chat_id)
+            self.stats["hits"] += 1
+            return list(chat.items.values()), chat.complete
+
+    def put(self, chat_id: str, items, complete: bool):
+        """
+        Cache the newest `items` of a chat (chronological), as read from DynamoDB.
+        """
+        chat = CachedChat(items, complete, time.monotonic() + self.ttl)
+        with self._lock:
+            self._remove(chat_id)
+            self._chats[chat_id] = chat
+            self.size += chat.size
+            self._evict()
+
+    def add_message(self, chat_id: str, item):
+        """
+        Write-through: add a message that was just stored, if its chat is cached.
+        """
+        with self._lock:
+            chat = self._chats.get(chat_id)
+            if chat is None:
+                return
+            self.size -= chat.size
+            chat.add(item)
+            self.size += chat.size
+            self._evict()
+
+    def update_message(self, chat_id: str, timestamp, **attributes):
+        """
+        Write-through for an update to a stored message, if it is cached.
+        """
+        with self._lock:
+            chat = self._chats.get(chat_id)
+            item = chat.items.get(timestamp) if chat else None
+            if item is not None:
+                updated = chat.items[timestamp] = {**item, **attributes}
+                delta = item_size(updated) - item_size(item)
+                chat.size += delta
+                self.size += delta
+                self._evict()
+
+    def drop_stale(self, chat_id: str):
+        """
+        Drop a chat found out of date (written by another worker).
+        """
+        with self._lock:
+            if chat_id in self._chats:
+                self._remove(chat_id)
+                self.stats["stale"] += 1
+
+    def invalidate(self, chat_id: str = None):
+        """
+        Drop one chat, or every chat if `chat_id` is None.
+        """
+        with self._lock:
+            if chat_id is None:
+                self._chats.clear()
+                self.size = 0
+            else:
+                self._remove(chat_id)
+
+    def metrics(self) -> dict:
+        with self._lock:
+            lookups = self.stats["hits"] + self.stats["misses"]
+            return {
+                **self.stats,
+                "hit_rate": self.stats["hits"] / lookups if lookups else 0.0,
+                "chats": len(self._chats),
+                "bytes": self.size,
+                "max_bytes": self.max_bytes,
+            }
+
+    def _remove(self, chat_id):
+        chat = self._chats.pop(chat_id, None)
+        if chat is not None:
+            self.size -= chat.size
+
+    def _evict(self):
+        while self.size > self.max_bytes and self._chats:
+            _, chat = self._chats.popitem(last=False)
+            self.size -= chat.size
+            self.stats["evictions"] += 1
+
+
+conversation_cache = ConversationCache()
@@ -0,0 +1,272 @@
+import asyncio
+import hashlib
+import logging
+import os
+import time
+from collections import OrderedDict
+
+from api.aio import run_blocking
+from api.clients import get_clients
+
+"""
+Idempotent /chat turns.
+
+Mobile clients retry /chat when a response is slow. A turn is identified by
+(chat_id, timestamp, hash of the message) and:
+- a duplicate arriving while the turn runs attaches to it (single flight) and
+  gets the same response, without a second OpenAI / ElevenLabs / S3 round trip;
+- a retry arriving after it finished gets the stored response replayed, for
+  IDEMPOTENCY_TTL seconds.
+
+Responses are stored in memory, per worker. With IDEMPOTENCY_BACKEND=dynamodb
+turns are also claimed in the IDEMPOTENCY_TABLE with a conditional PutItem, so
+a retry routed to another worker waits for (or replays) the first worker's
+response instead of running the turn again. Only successful responses are
+stored; a failed turn can be retried for real.
+"""
+
+# Seconds a completed response is replayed to retries
+IDEMPOTENCY_TTL = int(os.getenv("IDEMPOTENCY_TTL", "600"))
+# Completed responses kept in memory
+IDEMPOTENCY_MAX_ENTRIES = int(os.getenv("IDEMPOTENCY_MAX_ENTRIES", "10000"))
+# "memory", or "dynamodb" to share turns between workers
+IDEMPOTENCY_BACKEND = os.getenv("IDEMPOTENCY_BACKEND", "memory")
+IDEMPOTENCY_TABLE = os.getenv("IDEMPOTENCY_TABLE", "ChatIdempotency")
+# Seconds a worker's claim on a running turn holds, past it (e.g. the worker
+# died) another worker may run the turn
+IDEMPOTENCY_CLAIM_SECONDS = int(os.getenv("IDEMPOTENCY_CLAIM_SECONDS", "60"))
+# Longest a retry waits for the turn running on another worker before a 409
+IDEMPOTENCY_WAIT = float(os.getenv("IDEMPOTENCY_WAIT", "10"))
+# Seconds between reads of a turn running on another worker
+IDEMPOTENCY_POLL_INTERVAL = 0.25
+
+IN_PROGRESS = "in_progress"
+COMPLETED = "completed"
+
+
+def turn_key(chat_id: str, timestamp: int, message: str) -> str:
+    """
+    Idempotency key of a turn: the chat, the message timestamp and a hash of
+    the message (a different message at the same timestamp is a new turn).
+    """
+    digest = hashlib.sha256(message.encode("utf-8")).hexdigest()[:32]
+    return f"{chat_id}#{int(timestamp)}#{digest}"
+
+
+class StoredResponse:
+    """
+    A response to replay: status code, body and content type.
+    """
+
+    __slots__ = ("status_code", "body", "media_type", "expires_at")
+
+    def __init__(self, status_code: int, body: bytes, media_type: str, expires_at: float):
+        self.status_code = status_code
+        self.body = body
+        self.media_type = media_type
+        self.expires_at = expires_at
+
+
+class TurnInProgress(Exception):
+    """
+    The turn is running on another worker and didn't finish in time.
+    """
+
+    def __init__(self, retry_after: int = 1):
+        self.retry_after = retry_after
+        super().__init__("This turn is still being processed, retry shortly")
+
+
+class IdempotentTurns:
+    """
+    Single flight and replay of /chat turns by `turn_key`, see the module docs.
+    """
+
+    def __init__(
+        self,
+        ttl: int = IDEMPOTENCY_TTL,
+        max_entries: int = IDEMPOTENCY_MAX_ENTRIES,
+        backend: str = IDEMPOTENCY_BACKEND,
+        table_name: str = IDEMPOTENCY_TABLE,
+    ):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.backend = backend
+        self.table_name = table_name
+        self._inflight = {}
+        self._completed = OrderedDict()
+        self.stats = {
+            "computed": 0,
+            "coalesced": 0,
+            "replayed": 0,
+            "remote_replayed": 0,
+            "remote_conflicts": 0,
+        }
+
+    async def run(self, key: str, compute):
+        """
+        Return the response of the turn `key`, computing it with `compute()`
+        (a coroutine function returning a Starlette response) only if no
+        response is running or stored.
+
+        Returns
+        -------
+        (response, replayed): `response` is what `compute` returned, or a
+        `StoredResponse`; `replayed` is False only for the caller that ran the
+        turn. Raises `TurnInProgress` when another worker holds the turn past
+        IDEMPOTENCY_WAIT.
+        """
+        stored = self._get_completed(key)
+        if stored is not None:
+            self.stats["replayed"] += 1
+            return stored, True
+
+        task = self._inflight.get(key)
+        coalesced = task is not None
+        if coalesced:
+            self.stats["coalesced"] += 1
+        else:
+            task = self._inflight[key] = asyncio.ensure_future(self._run(key, compute))
+            task.add_done_callback(lambda _: self._inflight.pop(key, None))
+        # Shielded, a caller going away doesn't cancel the turn of the others
+        response, replayed = await asyncio.shield(task)
+        return response, replayed or coalesced
+
+    async def _run(self, key: str, compute):
+        if self.backend == "dynamodb":
+            stored = await self._claim_remote(key)
+            if stored is not None:
+                self.stats["remote_replayed"] += 1
+                self._put_completed(key, stored)
+                return stored, True
+
+        self.stats["computed"] += 1
+        try:
+            response = await compute()
+        except BaseException:
+            await self._release_remote(key)
+            raise
+        if response.status_code == 200:
+            stored = StoredResponse(
+                response.status_code,
+                bytes(response.body),
+                response.media_type,
+                time.time() + self.ttl,
+            )
+            self._put_completed(key, stored)
+            await self._complete_remote(key, stored)
+        else:
+            await self._release_remote(key)
+        return response, False
+
+    def metrics(self) -> dict:
+        return {
+            **self.stats,
+            "in_flight": len(self._inflight),
+            "stored": len(self._completed),
+            "backend": self.backend,
+        }
+
+    def _get_completed(self, key: str):
+        stored = self._completed.get(key)
+        if stored is None:
+            return None
+        if stored.expires_at < time.time():
+            del self._completed[key]
+            return None
+        return stored
+
+    def _put_completed(self, key: str, stored: StoredResponse):
+        self._completed[key] = stored
+        self._completed.move_to_end(key)
+        while len(self._completed) > self.max_entries:
+            self._completed.popitem(last=False)
+
+    # DynamoDB records: {"IdempotencyKey", "status", "expires_at" (epoch
+    # seconds, also the table's TTL attribute), and once completed
+    # "status_code", "body", "media_type"}
+
+    def _table(self):
+        return get_clients().table(self.table_name)
+
+    async def _claim_remote(self, key: str):
+        """
+        Claim the turn for this worker, or return the stored response of the
+        worker that ran it (waiting up to IDEMPOTENCY_WAIT if it still runs).
+        """
+        deadline = time.monotonic() + IDEMPOTENCY_WAIT
+        while True:
+            if await run_blocking(self._try_claim, key):
+                return None
+            record = await run_blocking(self._read, key)
+            if record is not None and record.get("status") == COMPLETED:
+                return StoredResponse(
+                    int(record["status_code"]),
+                    bytes(record["body"]),
+                    record.get("media_type"),
+                    float(record["expires_at"]),
+                )
+            if time.monotonic() >= deadline:
+                self.stats["remote_conflicts"] += 1
+                raise TurnInProgress()
+            # Still running elsewhere (or released: the next claim succeeds)
+            await asyncio.sleep(IDEMPOTENCY_POLL_INTERVAL)
+
+    def _try_claim(self, key: str) -> bool:
+        from botocore.exceptions import ClientError
+
+        now = int(time.time())
+        try:
+            self._table().put_item(
+                Item={
+                    "IdempotencyKey": key,
+                    "status": IN_PROGRESS,
+                    "expires_at": now + IDEMPOTENCY_CLAIM_SECONDS,
+                },
+                # Free, or an expired record DynamoDB's TTL didn't delete yet
+                ConditionExpression="attribute_not_exists(IdempotencyKey) OR expires_at < :now",
+                ExpressionAttributeValues={":now": now},
+            )
+            return True
+        except ClientError as e:
+            if e.response.get("Error", {}).get("Code") == "ConditionalCheckFailedException":
+                return False
+            raise
+
+    def _read(self, key: str):
+        item = self._table().get_item(
+            Key={"IdempotencyKey": key}, ConsistentRead=True
+        ).get("Item")
+        if item is None or int(item["expires_at"]) < time.time():
+            return None
+        return item
+
+    async def _complete_remote(self, key: str, stored: StoredResponse):
+        if self.backend != "dynamodb":
+            return
+        try:
+            await run_blocking(
+                self._table().put_item,
+                Item={
+                    "IdempotencyKey": key,
+                    "status": COMPLETED,
+                    "expires_at": int(stored.expires_at),
+                    "status_code": stored.status_code,
+                    "body": stored.body,
+                    "media_type": stored.media_type,
+                },
+            )
+        except Exception as e:
+            # Retries on other workers will run the turn again, nothing worse
+            logging.warning(f"Could not store the response of turn {key}: {str(e)}")
+
+    async def _release_remote(self, key: str):
+        if self.backend != "dynamodb":
+            return
+        try:
+            await run_blocking(self._table().delete_item, Key={"IdempotencyKey": key})
+        except Exception as e:
+            logging.warning(f"Could not release turn {key}: {str(e)}")
+
+
+idempotent_turns = IdempotentTurns()
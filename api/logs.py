@@ -0,0 +1,196 @@
+import atexit
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import random
+
+"""
+Logging setup, and cheap structured events for the chat hot path.
+
+`log_event(level, event, **fields)` logs an event with named fields. Nothing
+is formatted unless the level is enabled; fields may be callables, rendered
+only when the record is written (e.g. `history=lambda: messages`), and every
+rendered field is cut to LOG_FIELD_MAX_CHARS. Verbose events pass `sample=` to
+be logged for that share of the calls only.
+
+With LOG_FORMAT=json each record is one compact JSON object; the default
+"text" format is the one the app always used, with the fields appended. With
+LOG_QUEUE=1 (the default) records are put on a queue and formatted and
+written by a listener thread, so the request path only pays for creating
+the record. Fields are rendered on that thread: pass values that aren't
+mutated afterwards, or callables returning small summaries.
+"""
+
+# "text" or "json"
+LOG_FORMAT = os.getenv("LOG_FORMAT", "text")
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
+# Longest rendered field (and message) in characters, longer ones are cut
+LOG_FIELD_MAX_CHARS = int(os.getenv("LOG_FIELD_MAX_CHARS", "512"))
+# Share of the verbose (DEBUG) payload events logged when DEBUG is enabled
+LOG_DEBUG_SAMPLE_RATE = float(os.getenv("LOG_DEBUG_SAMPLE_RATE", "0.01"))
+# Format and write records on a background thread
+LOG_QUEUE = os.getenv("LOG_QUEUE", "1") == "1"
+# Records waiting to be written; past this new records are dropped
+LOG_QUEUE_SIZE = int(os.getenv("LOG_QUEUE_SIZE", "10000"))
+
+TEXT_FORMAT = "%(asctime)s - %(name)s - %(levelname)s - %(message)s - %(funcName)s - Line: %(lineno)d"
+DATE_FORMAT = "%Y-%m-%d %H:%M:%S"
+
+logger = logging.getLogger("chat")
+
+
+def truncate(text: str, max_chars: int = LOG_FIELD_MAX_CHARS) -> str:
+    if len(text) <= max_chars:
+        return text
+    return f"{text[:max_chars]}... ({len(text)} chars)"
+
+
+def render_field(value):
+    """
+    The value to write of a field: called if callable, numbers and booleans
+    as they are, anything else as a truncated string.
+    """
+    if callable(value):
+        value = value()
+    if value is None or isinstance(value, (bool, int, float)):
+        return value
+    return truncate(value if isinstance(value, str) else str(value))
+
+
+def log_event(level: int, event: str, sample: float = None, **fields):
+    """
+    Log `event` with `fields` on the "chat" logger, see the module docs.
+
+    Parameters
+    ----------
+    level (int): e.g. logging.INFO.
+    event (str): Short, constant event name, e.g. "chat_request".
+    sample (float): Share of the calls actually logged, all if None.
+    """
+    if not logger.isEnabledFor(level):
+        return
+    if sample is not None and random.random() >= sample:
+        return
+    # stacklevel: the record points at the caller, not at log_event
+    logger.log(level, event, extra={"fields": fields}, stacklevel=2)
+
+
+class TextFormatter(logging.Formatter):
+    """
+    The app's text format, the message truncated and the event's fields
+    appended as key=value.
+    """
+
+    def format(self, record: logging.LogRecord) -> str:
+        fields = getattr(record, "fields", None) or {}
+        record = logging.makeLogRecord(record.__dict__)
+        record.msg = " ".join(
+            [truncate(record.getMessage())]
+            + [f"{name}={render_field(value)}" for name, value in fields.items()]
+        )
+        record.args = None
+        return super().format(record)
+
+
+class JsonFormatter(logging.Formatter):
+    """
+    One compact JSON object per record: time, level, logger, message (the
+    event), source, the event's fields and the exception if any.
+    """
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            "time": round(record.created, 3),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": truncate(record.getMessage()),
+            "source": f"{record.funcName}:{record.lineno}",
+        }
+        for name, value in (getattr(record, "fields", None) or {}).items():
+            entry[name] = render_field(value)
+        if record.exc_text or record.exc_info:
+            entry["exception"] = record.exc_text or self.formatException(record.exc_info)
+        return json.dumps(entry, separators=(",", ":"), default=str)
+
+
+class DroppingQueueHandler(logging.handlers.QueueHandler):
+    """
+    Puts records on the queue as they are: the listener thread formats them
+    (the standard QueueHandler formats on the caller's thread). Records are
+    dropped, and counted, while the queue is full.
+    """
+
+    def __init__(self, queue):
+        super().__init__(queue)
+        self.dropped = 0
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        # Exception info can't outlive the `except` block, render it now
+        if record.exc_info and not record.exc_text:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+        return record
+
+    def enqueue(self, record: logging.LogRecord):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+_listener = None
+
+
+def configure_logging(
+    format: str = LOG_FORMAT, level: str = LOG_LEVEL, use_queue: bool = LOG_QUEUE, stream=None
+):
+    """
+    Set up the root logger: `format` ("text" or "json") records to `stream`
+    (stderr by default), through a queue and a listener thread if `use_queue`.
+    Replaces handlers set up before, so it can be called again.
+    """
+    global _listener
+    stop_logging()
+    handler = logging.StreamHandler(stream)
+    if format == "json":
+        handler.setFormatter(JsonFormatter())
+    else:
+        handler.setFormatter(TextFormatter(TEXT_FORMAT, datefmt=DATE_FORMAT))
+
+    root = logging.getLogger()
+    for existing in list(root.handlers):
+        root.removeHandler(existing)
+    root.setLevel(level)
+    if use_queue:
+        records = queue.Queue(LOG_QUEUE_SIZE)
+        root.addHandler(DroppingQueueHandler(records))
+        _listener = logging.handlers.QueueListener(
+            records, handler, respect_handler_level=True
+        )
+        _listener.start()
+    else:
+        root.addHandler(handler)
+
+
+def stop_logging():
+    """
+    Write the queued records and stop the listener thread.
+    """
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
+
+
+def metrics() -> dict:
+    dropped = sum(
+        handler.dropped
+        for handler in logging.getLogger().handlers
+        if isinstance(handler, DroppingQueueHandler)
+    )
+    queued = _listener.queue.qsize() if _listener is not None else 0
+    return {"queued": queued, "dropped": dropped}
+
+
+atexit.register(stop_logging)
@@ -0,0 +1,119 @@
+import functools
+import logging
+import os
+import zlib
+
+try:
+    import zstandard
+except ImportError:  # optional, `pip install zstandard`
+    zstandard = None
+
+"""
+Storage format of message bodies in the `ChatMessages` table.
+
+Messages are stored as plain String attributes unless MESSAGE_CODEC is set;
+then bodies of at least MESSAGE_COMPRESS_MIN_BYTES are compressed into a Binary
+`message` attribute. DynamoDB charges capacity per 1 KB written and 4 KB read,
+and long AI replies are several KB of very compressible text.
+
+Binary bodies start with a 2-byte header, (format version, codec id), so the
+format can evolve and old items stay readable. Reads decode both forms, so
+the codec can be switched on (or off, see migrate_messages.py) at any time.
+"""
+
+# "none" (plain strings), "zlib" or "zstd" for messages written from now on
+MESSAGE_CODEC = os.getenv("MESSAGE_CODEC", "none")
+# Smaller messages (UTF-8 bytes) are stored as plain strings
+MESSAGE_COMPRESS_MIN_BYTES = int(os.getenv("MESSAGE_COMPRESS_MIN_BYTES", "1024"))
+ZLIB_LEVEL = 6
+ZSTD_LEVEL = 3
+
+FORMAT_VERSION = 1
+CODEC_IDS = {"zlib": 1, "zstd": 2}
+CODEC_NAMES = {codec_id: name for name, codec_id in CODEC_IDS.items()}
+
+
+@functools.lru_cache(maxsize=None)
+def available_codec(codec: str) -> str:
+    """
+    Return `codec`, or "zlib" if it is "zstd" and zstandard isn't installed.
+    """
+    if codec == "zstd" and zstandard is None:
+        logging.warning("zstandard is not installed, compressing messages with zlib")
+        return "zlib"
+    if codec not in CODEC_IDS and codec != "none":
+        raise ValueError(f"Unknown message codec: {codec}")
+    return codec
+
+
+def _compress(data: bytes, codec: str) -> bytes:
+    if codec == "zstd":
+        return zstandard.ZstdCompressor(level=ZSTD_LEVEL).compress(data)
+    return zlib.compress(data, ZLIB_LEVEL)
+
+
+def _decompress(data: bytes, codec: str) -> bytes:
+    if codec == "zstd":
+        if zstandard is None:
+            raise RuntimeError("Reading zstd-compressed messages needs `pip install zstandard`")
+        return zstandard.ZstdDecompressor().decompress(data)
+    return zlib.decompress(data)
+
+
+def encode_message(text, codec=None, min_bytes=MESSAGE_COMPRESS_MIN_BYTES):
+    """
+    Return the value to store for a message body.
+
+    Parameters
+    ----------
+    text (str): The message.
+    codec (str): "none", "zlib" or "zstd", MESSAGE_CODEC by default.
+    min_bytes (int): Smaller messages are stored as they are.
+
+    Returns
+    -------
+    `text`, or the compressed bytes (with their header) when compression pays off.
+    """
+    codec = available_codec(codec or MESSAGE_CODEC)
+    if codec == "none" or not isinstance(text, str):
+        return text
+    data = text.encode("utf-8")
+    if len(data) < min_bytes:
+        return text
+    compressed = bytes([FORMAT_VERSION, CODEC_IDS[codec]]) + _compress(data, codec)
+    return compressed if len(compressed) < len(data) else text
+
+
+def decode_message(value) -> str:
+    """
+    Return the text of a stored message body, compressed or not.
+    """
+    # boto3 hands binary attributes back wrapped in a `Binary`
+    value = getattr(value, "value", value)
+    if not isinstance(value, (bytes, bytearray)):
+        return value
+    version, codec_id = value[0], value[1]
+    if version != FORMAT_VERSION or codec_id not in CODEC_NAMES:
+        raise ValueError(f"Unknown message format: version {version}, codec {codec_id}")
+    return _decompress(bytes(value[2:]), CODEC_NAMES[codec_id]).decode("utf-8")
+
+
+def encode_item(item, codec=None):
+    """
+    Return the item to write, with its message encoded by `encode_message`.
+    """
+    message = item.get("message")
+    encoded = encode_message(message, codec)
+    return item if encoded is message else {**item, "message": encoded}
+
+
+def decode_item(item):
+    """
+    Return an item read from the table, with its message as a string.
+    """
+    if item is None:
+        return None
+    message = item.get("message")
+    if message is None or isinstance(message, str):
+        return item
+    return {**item, "message": decode_message(message)}
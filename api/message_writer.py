@@ -0,0 +1,281 @@
+import logging
+import os
+import random
+import threading
+import time
+from collections import Counter, OrderedDict
+from concurrent.futures import Future
+
+from api.clients import get_clients
+
+"""
+Batched, write-behind persistence of chat messages.
+
+With MESSAGE_WRITES="write-behind" (see update_table.py), `store_message` hands
+items to a `WriteBehindQueue` and returns without waiting on DynamoDB. A
+background thread coalesces the items queued by concurrent requests into
+`BatchWriteItem` calls of up to 25 items, retrying unprocessed items with
+exponential backoff and jitter.
+
+Readers that need read-after-write call `flush(chat_id)`, which waits for that
+chat's queued items only and returns at once when it has none. It returns
+False when some of them could not be written. `put` also returns a future of
+the item's write, so a request can check its own message was stored before
+acknowledging it, without waiting for the rest of the queue.
+"""
+
+# Most put requests DynamoDB accepts in one BatchWriteItem call
+BATCH_WRITE_MAX_ITEMS = 25
+# Seconds the writer waits for more items before sending a partial batch
+WRITE_BEHIND_LINGER = float(os.getenv("WRITE_BEHIND_LINGER", "0.005"))
+# Items queued before `put` blocks, so a DynamoDB outage can't exhaust memory
+WRITE_BEHIND_MAX_PENDING = int(os.getenv("WRITE_BEHIND_MAX_PENDING", "10000"))
+# BatchWriteItem attempts for unprocessed items, and the backoff between them
+BATCH_WRITE_ATTEMPTS = 8
+BATCH_WRITE_BACKOFF = 0.05
+BATCH_WRITE_MAX_BACKOFF = 2.0
+
+
+def _item_key(item):
+    return item["ChatID"], item["timestamp"]
+
+
+def batch_write_items(table_name: str, items):
+    """
+    Put `items` with BatchWriteItem calls of up to 25 items.
+
+    Unprocessed items (throttling) are retried with full-jitter exponential
+    backoff, up to BATCH_WRITE_ATTEMPTS calls per batch. Items with the same key
+    are coalesced, the last one wins (a batch can't contain duplicate keys).
+
+    Returns
+    -------
+    The items that could not be written.
+    """
+    items = list(OrderedDict((_item_key(item), item) for item in items).values())
+    failed = []
+    for start in range(0, len(items), BATCH_WRITE_MAX_ITEMS):
+        batch = items[start : start + BATCH_WRITE_MAX_ITEMS]
+        failed.extend(_write_batch(table_name, batch))
+    return failed
+
+
+def batch_delete_items(table_name: str, keys):
+    """
+    Delete the items of `keys` ({"ChatID", "timestamp"}) with BatchWriteItem
+    calls of up to 25 deletes, retried like `batch_write_items`.
+
+    Returns
+    -------
+    The keys that could not be deleted.
+    """
+    keys = list(OrderedDict((_item_key(key), key) for key in keys).values())
+    failed = []
+    for start in range(0, len(keys), BATCH_WRITE_MAX_ITEMS):
+        requests = [
+            {"DeleteRequest": {"Key": key}}
+            for key in keys[start : start + BATCH_WRITE_MAX_ITEMS]
+        ]
+        failed.extend(
+            request["DeleteRequest"]["Key"] for request in _send_batch(table_name, requests)
+        )
+    return failed
+
+
+def _write_batch(table_name, items):
+    requests = [{"PutRequest": {"Item": item}} for item in items]
+    return [request["PutRequest"]["Item"] for request in _send_batch(table_name, requests)]
+
+
+def _send_batch(table_name, requests):
+    # Returns the requests still unprocessed after BATCH_WRITE_ATTEMPTS calls
+    for attempt in range(BATCH_WRITE_ATTEMPTS):
+        if attempt:
+            backoff = min(BATCH_WRITE_MAX_BACKOFF, BATCH_WRITE_BACKOFF * 2**attempt)
+            time.sleep(random.uniform(0, backoff))
+        try:
+            response = get_clients().dynamodb.batch_write_item(
+                RequestItems={table_name: requests}
+            )
+        except Exception as e:
+            # e.g. every item throttled, retried like unprocessed items
+            logging.warning(f"BatchWriteItem of {len(requests)} items failed: {str(e)}")
+            continue
+        requests = response.get("UnprocessedItems", {}).get(table_name, [])
+        if not requests:
+            return []
+    return requests
+
+
+class WriteBehindQueue:
+    """
+    Items waiting to be written to one table, drained by a background thread.
+    """
+
+    def __init__(
+        self,
+        table_name: str,
+        linger: float = WRITE_BEHIND_LINGER,
+        max_pending: int = WRITE_BEHIND_MAX_PENDING,
+        on_failure=None,
+    ):
+        self.table_name = table_name
+        self.linger = linger
+        self.max_pending = max_pending
+        # Called (on the writer thread) with the items that could not be written
+        self.on_failure = on_failure
+        self.stats = {"items": 0, "batches": 0, "coalesced": 0, "failed": 0}
+        # (ChatID, timestamp) -> item, rewrites of a queued item replace it
+        self._pending = OrderedDict()
+        # (ChatID, timestamp) -> futures of the queued item's write
+        self._futures = {}
+        # ChatID -> items queued or being written
+        self._outstanding = Counter()
+        # ChatID -> items that could not be written, until a flush reports them
+        self._failed = Counter()
+        self._flushing = 0
+        self._closed = False
+        self._condition = threading.Condition()
+        self._thread = None
+
+    def put(self, item):
+        """
+        Queue an item for writing. Blocks while the queue is full.
+
+        Returns
+        -------
+        A `concurrent.futures.Future` set to True once the item is written
+        (or replaced by a later write of the same key that is), False if it
+        could not be written.
+        """
+        key = _item_key(item)
+        with self._condition:
+            if self._closed:
+                raise RuntimeError("The write-behind queue is closed")
+            self._start()
+            self._condition.wait_for(lambda: len(self._pending) < self.max_pending)
+            if key in self._pending:
+                self.stats["coalesced"] += 1
+            else:
+                self._outstanding[item["ChatID"]] += 1
+            self._pending[key] = item
+            future = Future()
+            self._futures.setdefault(key, []).append(future)
+            self._condition.notify_all()
+        return future
+
+    def flush(self, chat_id: str = None, timeout: float = None) -> bool:
+        """
+        Wait until the items of `chat_id` (or every item) queued so far are written.
+
+        Returns
+        -------
+        False if `timeout` seconds passed first, or if some of the items could
+        not be written. Each failure is reported by one flush only.
+        """
+        with self._condition:
+            if self._has_outstanding(chat_id):
+                self._flushing += 1
+                self._condition.notify_all()
+                try:
+                    if not self._condition.wait_for(
+                        lambda: not self._has_outstanding(chat_id), timeout
+                    ):
+                        return False
+                finally:
+                    self._flushing -= 1
+            return not self._pop_failed(chat_id)
+
+    def close(self, timeout: float = None):
+        """
+        Write every queued item and stop the background thread.
+        """
+        with self._condition:
+            self._closed = True
+            self._condition.notify_all()
+            thread = self._thread
+        if thread:
+            thread.join(timeout)
+
+    def metrics(self) -> dict:
+        with self._condition:
+            return {
+                **self.stats,
+                "pending": len(self._pending),
+                "outstanding": sum(self._outstanding.values()),
+                "unreported_failures": sum(self._failed.values()),
+            }
+
+    def _pop_failed(self, chat_id):
+        if chat_id is None:
+            failed = sum(self._failed.values())
+            self._failed.clear()
+            return failed
+        return self._failed.pop(chat_id, 0)
+
+    def _has_outstanding(self, chat_id):
+        if chat_id is None:
+            return bool(self._outstanding)
+        return self._outstanding[chat_id] > 0
+
+    def _start(self):
+        if self._thread is None or not self._thread.is_alive():
+            self._thread = threading.Thread(
+                target=self._run, name="write-behind", daemon=True
+            )
+            self._thread.start()
+
+    def _run(self):
+        while True:
+            with self._condition:
+                self._condition.wait_for(lambda: self._pending or self._closed)
+                if not self._pending:
+                    self._thread = None
+                    return
+                # Give concurrent requests a moment to fill the batch, unless
+                # someone is waiting for it
+                if (
+                    len(self._pending) < BATCH_WRITE_MAX_ITEMS
+                    and not self._flushing
+                    and not self._closed
+                ):
+                    self._condition.wait(self.linger)
+                batch = [
+                    self._pending.popitem(last=False)[1]
+                    for _ in range(min(BATCH_WRITE_MAX_ITEMS, len(self._pending)))
+                ]
+                # A rewrite queued from now on gets futures of its own
+                futures = {
+                    _item_key(item): self._futures.pop(_item_key(item), [])
+                    for item in batch
+                }
+                self._condition.notify_all()
+
+            failed = _write_batch(self.table_name, batch)
+            if failed:
+                logging.error(
+                    f"Dropped {len(failed)} chat messages after {BATCH_WRITE_ATTEMPTS} "
+                    f"BatchWriteItem attempts: {[_item_key(item) for item in failed]}"
+                )
+                if self.on_failure:
+                    try:
+                        self.on_failure(failed)
+                    except Exception as e:
+                        logging.error(f"Write-behind failure callback failed: {str(e)}")
+
+            with self._condition:
+                self.stats["items"] += len(batch)
+                self.stats["batches"] += 1
+                self.stats["failed"] += len(failed)
+                for item in failed:
+                    self._failed[item["ChatID"]] += 1
+                for item in batch:
+                    self._outstanding[item["ChatID"]] -= 1
+                    if self._outstanding[item["ChatID"]] <= 0:
+                        del self._outstanding[item["ChatID"]]
+                self._condition.notify_all()
+
+            failed_keys = {_item_key(item) for item in failed}
+            for key, waiting in futures.items():
+                for future in waiting:
+                    future.set_result(key not in failed_keys)
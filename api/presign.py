@@ -0,0 +1,227 @@
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+
+from api.aio import run_blocking
+from api.clients import get_clients
+from api.tracing import stage
+
+"""
+Cache of presigned S3 links to audio files.
+
+Signing a link takes a fraction of a millisecond of CPU (SigV4 over the
+request, on the shared S3 client), and a page of messages needs one link per
+message with audio. Links are cached per (bucket, key) and served as long as
+they stay valid for at least PRESIGN_MIN_VALIDITY seconds, so a client always
+gets a link it can still use for a while; older ones are signed again.
+
+A link dies with the credentials that signed it: with temporary credentials
+(an IAM role on ECS/EC2/Lambda, STS) its expiry is capped at theirs, and it is
+signed again once half of that time has passed, with the credentials boto3
+has refreshed by then.
+
+`aget_links` signs the misses of a whole page in one pass on the blocking I/O
+pool, instead of one thread hop per link; cached links never leave the event
+loop.
+"""
+
+# Seconds a presigned link is valid (7 days, the most SigV4 allows)
+PRESIGN_EXPIRATION = int(os.getenv("PRESIGN_EXPIRATION", "604800"))
+# Cached links are signed again once they have less than this left
+PRESIGN_MIN_VALIDITY = int(os.getenv("PRESIGN_MIN_VALIDITY", "86400"))
+# Validity assumed for temporary credentials (a session token) whose expiry
+# boto3 doesn't know
+PRESIGN_TEMPORARY_CREDENTIALS_TTL = int(os.getenv("PRESIGN_TEMPORARY_CREDENTIALS_TTL", "900"))
+# Links kept in memory, least recently used are dropped first
+PRESIGN_CACHE_SIZE = int(os.getenv("PRESIGN_CACHE_SIZE", "50000"))
+
+
+def sign(s3_client, bucket: str, key: str, expiration: int = PRESIGN_EXPIRATION) -> str:
+    """
+    Presign a GET of `key` in `bucket`, valid for `expiration` seconds.
+    """
+    return s3_client.generate_presigned_url(
+        "get_object",
+        Params={"Bucket": bucket, "Key": key},
+        ExpiresIn=expiration,
+    )
+
+
+def credentials_expiry(s3_client):
+    """
+    When the credentials `s3_client` signs with expire (epoch seconds), or
+    None for long-term credentials.
+    """
+    credentials = getattr(getattr(s3_client, "_request_signer", None), "_credentials", None)
+    if credentials is None:
+        return None
+    # Refreshable credentials (instance / task roles, assumed roles) know theirs
+    expiry_time = getattr(credentials, "_expiry_time", None)
+    if expiry_time is not None:
+        return expiry_time.timestamp()
+    if getattr(credentials, "token", None):
+        return time.time() + PRESIGN_TEMPORARY_CREDENTIALS_TTL
+    return None
+
+
+class PresignedURLCache:
+    """
+    LRU of presigned links by (bucket, key), with the time they are to be
+    signed again.
+    """
+
+    def __init__(
+        self,
+        max_entries: int = PRESIGN_CACHE_SIZE,
+        expiration: int = PRESIGN_EXPIRATION,
+        min_validity: int = PRESIGN_MIN_VALIDITY,
+    ):
+        self.max_entries = max_entries
+        self.expiration = expiration
+        self.min_validity = min(min_validity, expiration // 2)
+        self._links = OrderedDict()
+        self._lock = threading.Lock()
+        self.stats = {"hits": 0, "misses": 0, "refreshed": 0, "errors": 0, "batches": 0}
+
+    def cached(self, bucket: str, key: str):
+        """
+        The cached link of a key if it is still valid long enough, else None.
+        """
+        with self._lock:
+            entry = self._links.get((bucket, key))
+            if entry is None:
+                return None
+            link, refresh_at = entry
+            if time.time() >= refresh_at:
+                del self._links[(bucket, key)]
+                self.stats["refreshed"] += 1
+                return None
+            self._links.move_to_end((bucket, key))
+            self.stats["hits"] += 1
+            return link
+
+    def get_link(self, key: str, bucket: str):
+        """
+        The presigned link of a key, signed on a miss.
+
+        Returns
+        -------
+        The link, or None if it could not be signed.
+        """
+        return self.cached(bucket, key) or self.get_links([key], bucket).get(key)
+
+    def get_links(self, keys, bucket: str) -> dict:
+        """
+        The presigned links of many keys, the misses signed in one pass.
+
+        Returns
+        -------
+        {key: link} of the keys that could be signed.
+        """
+        links = {}
+        misses = []
+        for key in dict.fromkeys(keys):
+            link = self.cached(bucket, key)
+            if link:
+                links[key] = link
+            else:
+                misses.append(key)
+        if misses:
+            links.update(self._sign(misses, bucket))
+        return links
+
+    async def aget_link(self, key: str, bucket: str):
+        """
+        Async variant of `get_link`, signing on the blocking I/O pool.
+        """
+        link = self.cached(bucket, key)
+        if link:
+            return link
+        return (await self.aget_links([key], bucket)).get(key)
+
+    async def aget_links(self, keys, bucket: str) -> dict:
+        """
+        Async variant of `get_links`: hits are served on the event loop, the
+        misses signed in one `run_blocking` call.
+        """
+        links = {}
+        misses = []
+        for key in dict.fromkeys(keys):
+            link = self.cached(bucket, key)
+            if link:
+                links[key] = link
+            else:
+                misses.append(key)
+        if misses:
+            links.update(await run_blocking(self._sign, misses, bucket))
+        return links
+
+    def refresh_period(self) -> int:
+        """
+        Seconds after which links handed out should be fetched again (e.g. the
+        period of an ETag over them): min_validity, shorter with temporary
+        credentials.
+        """
+        if credentials_expiry(get_clients().s3) is None:
+            return self.min_validity
+        return max(1, min(self.min_validity, PRESIGN_TEMPORARY_CREDENTIALS_TTL // 3))
+
+    def invalidate(self, key: str, bucket: str):
+        with self._lock:
+            self._links.pop((bucket, key), None)
+
+    def clear(self):
+        with self._lock:
+            self._links.clear()
+
+    def metrics(self) -> dict:
+        lookups = self.stats["hits"] + self.stats["misses"]
+        return {
+            **self.stats,
+            "hit_rate": self.stats["hits"] / lookups if lookups else 0.0,
+            "links": len(self._links),
+        }
+
+    def _sign(self, keys, bucket: str) -> dict:
+        from botocore.exceptions import NoCredentialsError
+
+        s3_client = get_clients().s3
+        links = {}
+        with stage("presign", links=len(keys)):
+            # Noted before signing: links signed after a refresh last longer
+            credentials_expire = credentials_expiry(s3_client)
+            for key in keys:
+                # Valid from now, so the expiry is noted before signing
+                expires_at = time.time() + self.expiration
+                if credentials_expire is not None:
+                    expires_at = min(expires_at, credentials_expire)
+                try:
+                    links[key] = sign(s3_client, bucket, key, self.expiration)
+                except NoCredentialsError:
+                    logging.error("Credentials not available for AWS S3")
+                    self.stats["errors"] += 1
+                    break
+                except Exception as e:
+                    logging.warning(f"Could not presign {key}: {str(e)}")
+                    self.stats["errors"] += 1
+                    continue
+                self._store(bucket, key, links[key], expires_at)
+        with self._lock:
+            self.stats["misses"] += len(keys)
+            self.stats["batches"] += 1
+        return links
+
+    def _store(self, bucket: str, key: str, link: str, expires_at: float):
+        # Served while it has min_validity left, or half of a shorter validity
+        valid_for = expires_at - time.time()
+        refresh_at = expires_at - min(self.min_validity, valid_for / 2)
+        with self._lock:
+            self._links[(bucket, key)] = (link, refresh_at)
+            self._links.move_to_end((bucket, key))
+            while len(self._links) > self.max_entries:
+                self._links.popitem(last=False)
+
+
+presigned_urls = PresignedURLCache()
@@ -0,0 +1,440 @@
+import asyncio
+import contextlib
+import contextvars
+import os
+import random
+import threading
+import time
+from collections import deque
+
+import httpx
+
+from api.admission import Saturated
+
+"""
+Deadlines, retries, hedging and circuit breaking for the ElevenLabs and OpenAI
+calls, the direct causes of our tail latency.
+
+- Deadlines: a request (or background job) starts a budget with
+  `start_deadline`; each upstream call gets what is left of it, capped by the
+  client's own timeout (`call_timeout`), and `DeadlineExceeded` is raised once
+  it is spent.
+- Retries: `retry` re-runs a call on retryable failures (connection errors,
+  timeouts, RETRYABLE_STATUSES), with exponential backoff and full jitter, as
+  long as the backoff fits in the deadline.
+- Hedging: `hedge` sends a second copy of a call that is slower than the
+  recent p95 of that call, and takes whichever answers first. At most
+  HEDGE_MAX_RATIO of the calls are hedged, so a slow upstream isn't doubled.
+- Circuit breaking: after BREAKER_FAILURE_THRESHOLD failures in a row calls
+  fail fast with `CircuitOpen` (a `Saturated`, so audio is skipped and
+  /chat answers 503 with Retry-After) until one probe call succeeds after
+  BREAKER_RESET_SECONDS.
+
+`UpstreamPolicy.call` combines the four for one upstream.
+"""
+
+# Seconds a chat turn may take end to end; its upstream calls get what is left
+CHAT_DEADLINE = float(os.getenv("CHAT_DEADLINE", "30"))
+# Seconds a background audio job (synthesis and upload) may take
+AUDIO_JOB_DEADLINE = float(os.getenv("AUDIO_JOB_DEADLINE", "90"))
+# Attempts per call, and the backoff before the first retry (doubled after each,
+# up to RETRY_MAX_DELAY, then jittered)
+RETRY_ATTEMPTS = int(os.getenv("RETRY_ATTEMPTS", "3"))
+RETRY_BASE_DELAY = 0.25
+RETRY_MAX_DELAY = 4.0
+# HTTP statuses worth retrying
+RETRYABLE_STATUSES = {408, 425, 429, 500, 502, 503, 504}
+# Set to "1" to hedge ElevenLabs syntheses / OpenAI completions
+ELEVENLABS_HEDGE = os.getenv("ELEVENLABS_HEDGE", "0") == "1"
+OPENAI_HEDGE = os.getenv("OPENAI_HEDGE", "0") == "1"
+# Largest share of calls that get a hedge, and the samples needed before the
+# first one (the p95 of fewer is noise)
+HEDGE_MAX_RATIO = float(os.getenv("HEDGE_MAX_RATIO", "0.1"))
+HEDGE_MIN_SAMPLES = 20
+# Recent latencies kept per upstream for the hedge delay
+LATENCY_WINDOW = 500
+# Failures in a row that open a breaker, and seconds before it lets a probe through
+BREAKER_FAILURE_THRESHOLD = int(os.getenv("BREAKER_FAILURE_THRESHOLD", "5"))
+BREAKER_RESET_SECONDS = float(os.getenv("BREAKER_RESET_SECONDS", "30"))
+
+_deadline = contextvars.ContextVar("deadline", default=None)
+
+
+class DeadlineExceeded(TimeoutError):
+    """
+    The request's time budget is spent.
+    """
+
+
+class CircuitOpen(Saturated):
+    """
+    An upstream's circuit breaker is open: it failed too often lately.
+    """
+
+    def __init__(self, upstream: str, retry_after: float):
+        super().__init__(f"{upstream} circuit", retry_after, status_code=503)
+
+
+def start_deadline(seconds: float = None) -> float:
+    """
+    Give the current request (and the tasks and `run_blocking` calls it starts)
+    `seconds` to finish. None removes the deadline, e.g. in background work.
+
+    Returns
+    -------
+    The deadline, in `time.monotonic()` seconds (or None).
+    """
+    deadline = None if seconds is None else time.monotonic() + seconds
+    _deadline.set(deadline)
+    return deadline
+
+
+def remaining(default: float = None) -> float:
+    """
+    Seconds left before the current deadline, at most `default`.
+
+    Returns
+    -------
+    `default` when there is no deadline. Raises `DeadlineExceeded` once it passed.
+    """
+    deadline = _deadline.get()
+    if deadline is None:
+        return default
+    left = deadline - time.monotonic()
+    if left <= 0:
+        raise DeadlineExceeded("Request deadline exceeded")
+    return left if default is None else min(default, left)
+
+
+def call_timeout(timeouts) -> httpx.Timeout:
+    """
+    httpx timeout for one upstream call: the client's (connect, read) timeouts,
+    cut to what is left of the deadline.
+    """
+    connect, read = timeouts
+    read = remaining(read)
+    return httpx.Timeout(read, connect=min(connect, read))
+
+
+@contextlib.asynccontextmanager
+async def deadline_scope():
+    """
+    Cancel the block once the current deadline passes, raising `DeadlineExceeded`.
+    """
+    left = remaining()
+    try:
+        async with asyncio.timeout(left):
+            yield
+    except TimeoutError as e:
+        if isinstance(e, DeadlineExceeded):
+            raise
+        raise DeadlineExceeded("Request deadline exceeded") from e
+
+
+def status_code(e: Exception):
+    """The HTTP status of a failed call, if it got one."""
+    response = getattr(e, "response", None)
+    return getattr(e, "status_code", None) or getattr(response, "status_code", None)
+
+
+def is_retryable(e: Exception) -> bool:
+    """
+    Connection errors, timeouts and RETRYABLE_STATUSES are worth a retry; other
+    errors (bad requests, auth, our own limiters) are not.
+    """
+    if isinstance(e, (Saturated, DeadlineExceeded)):
+        return False
+    if isinstance(e, (httpx.TransportError, TimeoutError, ConnectionError)):
+        return True
+    return status_code(e) in RETRYABLE_STATUSES
+
+
+def backoff_delay(attempt: int) -> float:
+    """
+    Seconds to wait before retry number `attempt` (1 for the first retry):
+    exponential backoff with full jitter, so retries of many callers spread out.
+    """
+    return random.uniform(0, min(RETRY_MAX_DELAY, RETRY_BASE_DELAY * 2 ** (attempt - 1)))
+
+
+async def retry(call, attempts: int = RETRY_ATTEMPTS, retryable=is_retryable, on_retry=None):
+    """
+    Await `call()`, retrying retryable failures with `backoff_delay`.
+
+    Parameters
+    ----------
+    call: A function returning a new awaitable per attempt.
+    attempts (int): Attempts in total.
+    retryable: Whether an exception is worth another attempt.
+    on_retry: Called with the exception before each retry, e.g. for metrics.
+
+    Returns
+    -------
+    The result of the first successful attempt. The last error is raised when
+    attempts run out, or when the next backoff would pass the deadline.
+    """
+    for attempt in range(1, attempts + 1):
+        try:
+            return await call()
+        except Exception as e:
+            if attempt == attempts or not retryable(e):
+                raise
+            delay = backoff_delay(attempt)
+            deadline = _deadline.get()
+            if deadline is not None and time.monotonic() + delay >= deadline:
+                raise
+            if on_retry is not None:
+                on_retry(e)
+            await asyncio.sleep(delay)
+
+
+class LatencyTracker:
+    """
+    The latencies of an upstream's last `window` successful calls.
+    """
+
+    def __init__(self, window: int = LATENCY_WINDOW):
+        self._samples = deque(maxlen=window)
+
+    def add(self, seconds: float):
+        self._samples.append(seconds)
+
+    def __len__(self):
+        return len(self._samples)
+
+    def percentile(self, p: float) -> float:
+        """
+        Nearest-rank percentile of the window, or None without samples.
+        """
+        samples = sorted(self._samples)
+        if not samples:
+            return None
+        return samples[min(len(samples) - 1, int(len(samples) * p / 100))]
+
+
+class CircuitBreaker:
+    """
+    Closed: calls go through. Open (after `failure_threshold` failures in a
+    row): calls raise `CircuitOpen`. Half open (`reset_seconds` later): one
+    probe call goes through, closing the breaker on success and reopening it
+    on failure.
+    """
+
+    def __init__(
+        self,
+        name: str,
+        failure_threshold: int = BREAKER_FAILURE_THRESHOLD,
+        reset_seconds: float = BREAKER_RESET_SECONDS,
+    ):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_seconds = reset_seconds
+        self.failures = 0
+        self.opened_at = None
+        self.opened = 0
+        self.short_circuited = 0
+        self._probing = False
+        self._lock = threading.Lock()
+
+    @property
+    def state(self) -> str:
+        if self.opened_at is None:
+            return "closed"
+        if time.monotonic() - self.opened_at < self.reset_seconds:
+            return "open"
+        return "half_open"
+
+    def is_open(self) -> bool:
+        """Whether calls are currently refused (a probe may still be allowed)."""
+        return self.state == "open" or (self.state == "half_open" and self._probing)
+
+    def check(self):
+        """
+        Raise `CircuitOpen` unless a call may go through now.
+        """
+        with self._lock:
+            state = self.state
+            if state == "closed":
+                return
+            if state == "half_open" and not self._probing:
+                self._probing = True
+                return
+            self.short_circuited += 1
+            retry_after = self.opened_at + self.reset_seconds - time.monotonic()
+        raise CircuitOpen(self.name, retry_after)
+
+    def success(self):
+        with self._lock:
+            self.failures = 0
+            self.opened_at = None
+            self._probing = False
+
+    def failure(self):
+        with self._lock:
+            self.failures += 1
+            if self._probing or (
+                self.opened_at is None and self.failures >= self.failure_threshold
+            ):
+                self.opened_at = time.monotonic()
+                self.opened += 1
+            self._probing = False
+
+    def cancel_probe(self):
+        """
+        Let another call probe, this one ended without telling either way.
+        """
+        with self._lock:
+            self._probing = False
+
+    def metrics(self) -> dict:
+        return {
+            "state": self.state,
+            "open": int(self.is_open()),
+            "failures_in_a_row": self.failures,
+            "opened": self.opened,
+            "short_circuited": self.short_circuited,
+        }
+
+
+class UpstreamPolicy:
+    """
+    Breaker, retries and optional hedging for the calls to one upstream:
+    `await policy.call(lambda: client.post(...))`.
+    """
+
+    def __init__(
+        self,
+        name: str,
+        attempts: int = RETRY_ATTEMPTS,
+        hedging: bool = False,
+        breaker: CircuitBreaker = None,
+    ):
+        self.name = name
+        self.attempts = attempts
+        self.hedging = hedging
+        self.breaker = breaker or CircuitBreaker(name)
+        self.latencies = LatencyTracker()
+        # Calls are counted per attempt
+        self.stats = {
+            "calls": 0,
+            "failures": 0,
+            "retries": 0,
+            "hedges": 0,
+            "hedges_won": 0,
+            "deadline_exceeded": 0,
+        }
+
+    async def call(self, call):
+        """
+        Await `call()` (a function returning a new awaitable per attempt) under
+        the breaker, with retries and, if enabled, hedging.
+
+        Returns
+        -------
+        The call's result. Raises its last error, `CircuitOpen` while the
+        breaker is open, or `DeadlineExceeded`.
+        """
+        self.breaker.check()
+        try:
+            result = await retry(
+                lambda: self.attempt(call), self.attempts, on_retry=self._count_retry
+            )
+        except Saturated:
+            # Our own limiters refused the call, that says nothing of the upstream
+            self.breaker.cancel_probe()
+            raise
+        except Exception as e:
+            self.failed(e)
+            raise
+        except BaseException:
+            self.breaker.cancel_probe()
+            raise
+        self.breaker.success()
+        return result
+
+    def failed(self, e: Exception):
+        """
+        Count a failed call against the breaker.
+        """
+        self.stats["failures"] += 1
+        if isinstance(e, DeadlineExceeded):
+            self.stats["deadline_exceeded"] += 1
+        self.breaker.failure()
+
+    async def attempt(self, call):
+        """
+        Await one attempt of `call()`, hedged if enabled. The breaker is left to
+        the caller, see `call`.
+        """
+        self.stats["calls"] += 1
+        if self.hedging:
+            return await self.hedge(call)
+        return await self.timed(call)
+
+    async def timed(self, call):
+        start = time.monotonic()
+        result = await call()
+        self.latencies.add(time.monotonic() - start)
+        return result
+
+    async def hedge(self, call):
+        """
+        Await `call()`; if it is still running after the recent p95 latency,
+        start a second copy and return whichever succeeds first.
+        """
+        delay = self.hedge_delay()
+        if delay is None:
+            return await self.timed(call)
+
+        first = asyncio.ensure_future(self.timed(call))
+        tasks = {first}
+        try:
+            done, _ = await asyncio.wait(tasks, timeout=delay)
+            if not done:
+                self.stats["hedges"] += 1
+                tasks.add(asyncio.ensure_future(self.timed(call)))
+            while True:
+                done, pending = await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+                winner = next((task for task in done if not task.exception()), None)
+                if winner is not None:
+                    if winner is not first:
+                        self.stats["hedges_won"] += 1
+                    return winner.result()
+                if not pending:
+                    # Both failed, the first call's error is the one to report
+                    return first.result()
+                tasks = pending
+        finally:
+            for task in tasks:
+                task.cancel()
+
+    def hedge_delay(self) -> float:
+        """
+        The recent p95 latency, or None if this call shouldn't be hedged.
+        """
+        if len(self.latencies) < HEDGE_MIN_SAMPLES:
+            return None
+        if self.stats["hedges"] >= HEDGE_MAX_RATIO * self.stats["calls"]:
+            return None
+        return self.latencies.percentile(95)
+
+    def _count_retry(self, e: Exception):
+        self.stats["retries"] += 1
+
+    def metrics(self) -> dict:
+        p50, p95 = self.latencies.percentile(50), self.latencies.percentile(95)
+        return {
+            **self.stats,
+            "p50_seconds": round(p50, 4) if p50 is not None else None,
+            "p95_seconds": round(p95, 4) if p95 is not None else None,
+            "breaker": self.breaker.metrics(),
+        }
+
+
+elevenlabs_policy = UpstreamPolicy("elevenlabs", hedging=ELEVENLABS_HEDGE)
+# OpenAI's client retries by itself (see OPENAI_MAX_RETRIES in api/clients.py)
+openai_policy = UpstreamPolicy("openai", attempts=1, hedging=OPENAI_HEDGE)
+
+
+def metrics() -> dict:
+    return {"elevenlabs": elevenlabs_policy.metrics(), "openai": openai_policy.metrics()}
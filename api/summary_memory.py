@@ -0,0 +1,100 @@
+import asyncio
+import logging
+import os
+
+from api.resilience import start_deadline
+from chatbot import asummarize, convert_to_langchain_messages
+from update_table import aget_messages_after, aget_summary, astore_summary
+
+"""
+Rolling summary memory: the prompt gets the last SUMMARY_RECENT_MESSAGES
+messages verbatim plus a summary of everything older.
+
+The summary and the timestamp of the last message it covers (its high-water
+mark) are stored as a separate item in the `ChatMessages` table. Messages after
+the high-water mark are sent verbatim; once more than
+SUMMARY_RECENT_MESSAGES + SUMMARY_REFRESH_EVERY of them pile up, the summary
+is refreshed in the background, never on the request path.
+"""
+
+# Newest messages always sent verbatim
+SUMMARY_RECENT_MESSAGES = int(os.getenv("SUMMARY_RECENT_MESSAGES", "8"))
+# Unsummarized messages allowed on top of the verbatim ones before a refresh
+SUMMARY_REFRESH_EVERY = int(os.getenv("SUMMARY_REFRESH_EVERY", "6"))
+
+# Chats with a summary refresh running, so each is refreshed once at a time
+_refreshing = {}
+
+
+async def load_summary_history(chat_id: str, model_name: str):
+    """
+    Build the chat history for summary mode and schedule a refresh if due.
+
+    Returns
+    -------
+    A ChatMessageHistory: the summary as a system message, then the messages
+    after the summary's high-water mark.
+    """
+    summary_item = await aget_summary(chat_id)
+    summary = summary_item["message"] if summary_item else ""
+    summarized_until = summary_item["summarized_until"] if summary_item else 0
+
+    limit = SUMMARY_RECENT_MESSAGES + SUMMARY_REFRESH_EVERY
+    messages, truncated = await aget_messages_after(chat_id, summarized_until, limit)
+    if truncated or len(messages) >= limit:
+        schedule_summary_refresh(chat_id, model_name)
+
+    langchain_messages = convert_to_langchain_messages(messages)
+    if summary:
+        from langchain_core.messages import SystemMessage
+
+        langchain_messages.messages.insert(
+            0, SystemMessage(content=f"Summary of the earlier conversation: {summary}")
+        )
+    return langchain_messages
+
+
+def schedule_summary_refresh(chat_id: str, model_name: str):
+    """
+    Refresh the chat's summary in a background task, unless one is running.
+    """
+    if chat_id in _refreshing:
+        return
+    task = asyncio.create_task(refresh_summary(chat_id, model_name))
+    _refreshing[chat_id] = task
+    task.add_done_callback(lambda _: _refreshing.pop(chat_id, None))
+
+
+async def refresh_summary(chat_id: str, model_name: str):
+    """
+    Fold every message older than the verbatim window into the summary and
+    move the high-water mark forward.
+    """
+    # Runs past the turn that scheduled it, so not bound by its deadline
+    start_deadline(None)
+    try:
+        summary_item = await aget_summary(chat_id)
+        summary = summary_item["message"] if summary_item else ""
+        summarized_until = summary_item["summarized_until"] if summary_item else 0
+
+        # Oldest first and bounded, very long backlogs catch up over several refreshes
+        limit = 10 * (SUMMARY_RECENT_MESSAGES + SUMMARY_REFRESH_EVERY)
+        messages, _ = await aget_messages_after(
+            chat_id, summarized_until, limit, oldest_first=True
+        )
+        to_summarize = messages[:-SUMMARY_RECENT_MESSAGES]
+        if not to_summarize:
+            return
+
+        summary = await asummarize(summary, to_summarize, model_name)
+        await astore_summary(chat_id, summary, int(to_summarize[-1]["timestamp"]))
+        logging.info(f"Summarized {len(to_summarize)} messages of {chat_id}")
+    except Exception as e:
+        logging.error(f"Summary refresh failed for {chat_id}: {str(e)}")
+
+
+async def stop_summary_refreshes():
+    tasks = list(_refreshing.values())
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
@@ -0,0 +1,82 @@
+import logging
+import threading
+import time
+
+import tiktoken
+
+"""
+Token counting for chat history, using the model's own tokenizer.
+"""
+
+# Overhead of each message in the chat format (role, separators)
+TOKENS_PER_MESSAGE = 4
+DEFAULT_ENCODING = "cl100k_base"
+# Seconds before an encoding that failed to load (e.g. its BPE file couldn't
+# be downloaded) is tried again; counts are estimated meanwhile
+ENCODING_RETRY_SECONDS = 60
+
+# Loaded encodings by name: a handful, whatever model names clients send
+_encodings = {}
+# Encoding name -> monotonic time before which it isn't loaded again
+_failed_until = {}
+# Guards the per-encoding locks; loading can download the BPE file, so
+# concurrent first calls for an encoding wait on its own lock for one load
+_encoding_lock = threading.Lock()
+_load_locks = {}
+
+
+def encoding_name(model_name: str) -> str:
+    """
+    The tiktoken encoding of a model, DEFAULT_ENCODING for unknown models.
+    """
+    try:
+        return tiktoken.encoding_name_for_model(model_name)
+    except KeyError:
+        return DEFAULT_ENCODING
+
+
+def get_encoding(model_name: str):
+    """
+    Return the tiktoken encoding for a model, or None if it can't be loaded
+    (e.g. its BPE file can't be downloaded), in which case counts are estimated
+    until it is tried again ENCODING_RETRY_SECONDS later.
+    """
+    name = encoding_name(model_name)
+    encoding = _encodings.get(name)
+    if encoding is not None:
+        return encoding
+    if _failed_until.get(name, 0) > time.monotonic():
+        return None
+    with _encoding_lock:
+        load_lock = _load_locks.setdefault(name, threading.Lock())
+    with load_lock:
+        encoding = _encodings.get(name)
+        if encoding is None and _failed_until.get(name, 0) <= time.monotonic():
+            encoding = _load_encoding(name)
+        return encoding
+
+
+def _load_encoding(name: str):
+    try:
+        encoding = _encodings[name] = tiktoken.get_encoding(name)
+        _failed_until.pop(name, None)
+        return encoding
+    except Exception as e:
+        logging.warning(f"No tokenizer {name}, estimating tokens: {str(e)}")
+        _failed_until[name] = time.monotonic() + ENCODING_RETRY_SECONDS
+        return None
+
+
+def count_tokens(text: str, model_name: str) -> int:
+    encoding = get_encoding(model_name)
+    if encoding is None:
+        # Roughly 4 characters per token for English text
+        return len(text) // 4 + 1
+    return len(encoding.encode(text, disallowed_special=()))
+
+
+def count_message_tokens(text: str, model_name: str) -> int:
+    """
+    Tokens a message takes up in the prompt, including the per-message overhead.
+    """
+    return count_tokens(text, model_name) + TOKENS_PER_MESSAGE
@@ -0,0 +1,289 @@
+import bisect
+import contextvars
+import os
+import re
+import threading
+import time
+
+"""
+Per-stage latency tracing for chat turns.
+
+Code times a stage with `stage`, optionally noting its sizes (bytes, tokens,
+characters, ...):
+```
+with stage("tts", characters=len(message)) as span:
+    audio = synthesize(message)
+    span.add(bytes=len(audio))
+```
+Durations and sizes are aggregated into in-process histograms, rendered in the
+Prometheus text format by `render_prometheus` (served at /metrics). Inside a
+`Trace` (one per request, see `start_trace`) the stages are also collected for
+a `Server-Timing` header. Nothing here depends on FastAPI.
+"""
+
+# Set to "0" to turn stage timing off entirely
+TRACING = os.getenv("TRACING", "1") != "0"
+# Upper bounds (seconds) of the stage duration histogram buckets
+STAGE_SECONDS_BUCKETS = (
+    0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30,
+)
+# Upper bounds of the stage size histogram buckets (bytes, tokens, characters...)
+STAGE_SIZE_BUCKETS = tuple(4**i for i in range(2, 12))
+# Set to "1" to send a `Server-Timing` header with the stages of each response
+SERVER_TIMING = os.getenv("SERVER_TIMING", "0") == "1"
+# Prefix of the exported metric names
+METRICS_PREFIX = "hippo"
+
+_current_trace = contextvars.ContextVar("trace", default=None)
+
+
+class Histogram:
+    """
+    Cumulative histogram with fixed buckets, like a Prometheus histogram.
+    """
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0
+        self.count = 0
+        self._lock = threading.Lock()
+
+    def observe(self, value):
+        i = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            self.counts[i] += 1
+            self.sum += value
+            self.count += 1
+
+    def snapshot(self):
+        """
+        Return (cumulative bucket counts, sum, count); the last count is +Inf.
+        """
+        with self._lock:
+            counts, total, count = list(self.counts), self.sum, self.count
+        cumulative = []
+        running = 0
+        for n in counts:
+            running += n
+            cumulative.append(running)
+        return cumulative, total, count
+
+
+class Trace:
+    """
+    The stages of one request, in the order they finished.
+    """
+
+    def __init__(self):
+        self.stages = []
+
+    def add(self, name: str, seconds: float):
+        self.stages.append((name, seconds))
+
+    def server_timing(self) -> str:
+        """
+        Render the stages as a `Server-Timing` header value. Repeated stages are
+        summed.
+        """
+        totals = {}
+        for name, seconds in self.stages:
+            totals[name] = totals.get(name, 0) + seconds
+        return ", ".join(
+            f"{name};dur={seconds * 1000:.1f}" for name, seconds in totals.items()
+        )
+
+
+class Span:
+    """
+    One timed run of a stage, see `stage`.
+    """
+
+    __slots__ = ("name", "sizes", "start")
+
+    def __init__(self, name: str, sizes: dict):
+        self.name = name
+        self.sizes = sizes
+        self.start = 0.0
+
+    def add(self, **sizes):
+        """
+        Note sizes known once the stage ran, e.g. `span.add(bytes=len(audio))`.
+        """
+        self.sizes.update(sizes)
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        if TRACING:
+            tracer.record(self.name, time.perf_counter() - self.start, self.sizes)
+        return False
+
+
+class Tracer:
+    """
+    Histograms of stage durations and sizes, and collectors of other metrics.
+    """
+
+    def __init__(self):
+        self.seconds = {}
+        self.sizes = {}
+        self.collectors = {}
+        self._lock = threading.Lock()
+
+    def record(self, name: str, seconds: float, sizes: dict = None):
+        """
+        Record a finished stage, in the histograms and the current `Trace`.
+        """
+        self._histogram(self.seconds, name, STAGE_SECONDS_BUCKETS).observe(seconds)
+        if sizes:
+            for unit, value in sizes.items():
+                if value is not None:
+                    histograms = self.sizes.get(unit)
+                    if histograms is None:
+                        with self._lock:
+                            histograms = self.sizes.setdefault(unit, {})
+                    self._histogram(histograms, name, STAGE_SIZE_BUCKETS).observe(value)
+        trace = _current_trace.get()
+        if trace is not None:
+            trace.add(name, seconds)
+
+    def add_collector(self, name: str, collect):
+        """
+        Export the numbers of `collect()` (a dict, like the /metrics/* endpoints
+        return) as gauges named `<prefix>_<name>_<key>`.
+        """
+        self.collectors[name] = collect
+
+    def reset(self):
+        with self._lock:
+            self.seconds = {}
+            self.sizes = {}
+
+    def _histogram(self, histograms: dict, name: str, buckets) -> Histogram:
+        histogram = histograms.get(name)
+        if histogram is None:
+            with self._lock:
+                histogram = histograms.setdefault(name, Histogram(buckets))
+        return histogram
+
+
+def stage(name: str, **sizes) -> Span:
+    """
+    Time a stage of a turn: `with stage("history_query"): ...`.
+
+    Parameters
+    ----------
+    name (str): The stage, the `stage` label of the exported histograms.
+    **sizes: Sizes known up front, e.g. `characters=len(message)`. More can be
+        added with `Span.add`.
+    """
+    return Span(name, sizes)
+
+
+def observe(name: str, seconds: float, **sizes):
+    """
+    Record a stage timed by the caller, e.g. the time to an LLM's first token.
+    """
+    if TRACING:
+        tracer.record(name, seconds, sizes)
+
+
+def start_trace() -> Trace:
+    """
+    Start collecting the stages of the current request (and of the tasks and
+    `run_blocking` calls it starts) into a new `Trace`.
+    """
+    trace = Trace()
+    _current_trace.set(trace)
+    return trace
+
+
+class ServerTimingMiddleware:
+    """
+    ASGI middleware that traces each HTTP request and adds its stages to the
+    response as a `Server-Timing` header (plus `app`, the time until the
+    response started). Streamed responses only show the stages that finished
+    before their first chunk.
+    """
+
+    def __init__(self, app, enabled: bool = SERVER_TIMING):
+        self.app = app
+        self.enabled = enabled
+
+    async def __call__(self, scope, receive, send):
+        if not self.enabled or scope["type"] != "http":
+            return await self.app(scope, receive, send)
+
+        trace = start_trace()
+        start = time.perf_counter()
+
+        async def send_with_timing(message):
+            if message["type"] == "http.response.start":
+                trace.add("app", time.perf_counter() - start)
+                headers = list(message.get("headers", []))
+                headers.append((b"server-timing", trace.server_timing().encode("latin-1")))
+                message = {**message, "headers": headers}
+            await send(message)
+
+        await self.app(scope, receive, send_with_timing)
+
+
+def _labels(**labels) -> str:
+    return ",".join(f'{key}="{value}"' for key, value in labels.items())
+
+
+def _render_histograms(lines, metric, description, histograms):
+    if not histograms:
+        return
+    lines.append(f"# HELP {metric} {description}")
+    lines.append(f"# TYPE {metric} histogram")
+    for name, histogram in sorted(histograms.items()):
+        cumulative, total, count = histogram.snapshot()
+        bounds = [*histogram.buckets, "+Inf"]
+        for bound, n in zip(bounds, cumulative):
+            lines.append(f"{metric}_bucket{{{_labels(stage=name, le=bound)}}} {n}")
+        lines.append(f"{metric}_sum{{{_labels(stage=name)}}} {total}")
+        lines.append(f"{metric}_count{{{_labels(stage=name)}}} {count}")
+
+
+def _flatten(prefix, data, out):
+    for key, value in data.items():
+        key = re.sub(r"[^a-zA-Z0-9_]", "_", f"{prefix}_{key}")
+        if isinstance(value, dict):
+            _flatten(key, value, out)
+        elif isinstance(value, (int, float)) and not isinstance(value, bool):
+            out.append((key, value))
+
+
+def render_prometheus() -> str:
+    """
+    Render the stage histograms and collected gauges in the Prometheus text
+    exposition format.
+    """
+    lines = []
+    _render_histograms(
+        lines,
+        f"{METRICS_PREFIX}_stage_seconds",
+        "Time spent in each stage of a chat turn.",
+        tracer.seconds,
+    )
+    for unit, histograms in sorted(tracer.sizes.items()):
+        _render_histograms(
+            lines,
+            f"{METRICS_PREFIX}_stage_{unit}",
+            f"{unit.capitalize()} handled by each stage of a chat turn.",
+            histograms,
+        )
+    for name, collect in tracer.collectors.items():
+        gauges = []
+        _flatten(f"{METRICS_PREFIX}_{name}", collect(), gauges)
+        for metric, value in gauges:
+            lines.append(f"# TYPE {metric} gauge")
+            lines.append(f"{metric} {value}")
+    return "\n".join(lines) + "\n"
+
+
+tracer = Tracer()
@@ -0,0 +1,377 @@
+import asyncio
+import hashlib
+import json
+import logging
+import os
+import re
+import unicodedata
+from collections import OrderedDict
+
+from api.aio import run_blocking
+from api.audio import (
+    AUDIO_BUCKET,
+    ELEVENLABS_MODEL_ID,
+    ELEVENLABS_OUTPUT_FORMAT,
+    ELEVENLABS_VOICE_ID,
+    ELEVENLABS_VOICE_SETTINGS,
+    TTS_CHUNK_CHARS,
+    aget_elevenlabs_audio,
+    aget_elevenlabs_audio_stream,
+    aiter_elevenlabs_audio_chunks,
+    aupload_audio_bytes_to_s3,
+    aupload_audio_chunks_to_s3,
+)
+from api.clients import get_clients
+
+"""
+Content-addressed text-to-speech cache.
+
+Audio is stored in S3 under a hash of everything that determines it: the
+normalized text, voice, model, voice settings and output format. Identical
+replies (persona greetings, short acknowledgements...) then share one S3
+object and are synthesized once.
+
+Lookups go through three tiers before ElevenLabs is called:
+(1) an in-memory LRU of hot clips, and optionally an LRU directory on disk
+    (TTS_CACHE_DIR), both holding the MP3 bytes,
+(2) an index of S3 keys known to exist,
+(3) a HEAD request on the S3 key.
+"""
+
+# S3 key prefix of content-addressed clips
+TTS_CACHE_PREFIX = "tts-cache/"
+# Total size of clips kept in memory
+TTS_CACHE_MEMORY_BYTES = int(os.getenv("TTS_CACHE_MEMORY_BYTES", str(32 * 1024**2)))
+# Directory of the disk tier, disabled when unset
+TTS_CACHE_DIR = os.getenv("TTS_CACHE_DIR")
+# Total size of clips kept on disk
+TTS_CACHE_DISK_BYTES = int(os.getenv("TTS_CACHE_DISK_BYTES", str(1024**3)))
+# S3 keys remembered as existing, so repeated texts skip the HEAD request
+TTS_CACHE_KEYS_TRACKED = 100000
+
+
+def normalize_text(text: str) -> str:
+    """
+    Normalize text so that renderings of the same words share audio.
+
+    Case and punctuation are kept, they change how the text is spoken.
+    """
+    return re.sub(r"\s+", " ", unicodedata.normalize("NFC", text)).strip()
+
+
+def tts_cache_key(
+    text: str, optimize_streaming_latency: int = 0, segmented: bool = False
+) -> str:
+    """
+    Hash of a (normalized) text and the settings it is synthesized with.
+
+    Parameters
+    ----------
+    text (str): The normalized text.
+    optimize_streaming_latency (int): The latency level, it changes the audio.
+    segmented (bool): Whether the audio is the concatenation of per-sentence
+        clips (see api/tts_pipeline.py) rather than one synthesis.
+
+    Returns
+    -------
+    A hex SHA-256 digest.
+    """
+    key = {
+        "text": text,
+        "voice_id": ELEVENLABS_VOICE_ID,
+        "model_id": ELEVENLABS_MODEL_ID,
+        "voice_settings": ELEVENLABS_VOICE_SETTINGS,
+        "output_format": ELEVENLABS_OUTPUT_FORMAT,
+        "optimize_streaming_latency": optimize_streaming_latency,
+        "segmented": segmented,
+    }
+    return hashlib.sha256(json.dumps(key, sort_keys=True).encode()).hexdigest()
+
+
+def object_name(key: str) -> str:
+    return f"{TTS_CACHE_PREFIX}{key}.mp3"
+
+
+class TTSAudioCache:
+    """
+    The TTS cache of this worker. Use from the event loop only.
+    """
+
+    def __init__(
+        self,
+        bucket: str = AUDIO_BUCKET,
+        memory_bytes: int = TTS_CACHE_MEMORY_BYTES,
+        disk_dir: str = TTS_CACHE_DIR,
+        disk_bytes: int = TTS_CACHE_DISK_BYTES,
+        max_keys: int = TTS_CACHE_KEYS_TRACKED,
+    ):
+        self.bucket = bucket
+        self.memory_bytes = memory_bytes
+        self.disk_dir = disk_dir
+        self.disk_bytes = disk_bytes
+        self.max_keys = max_keys
+        self.stats = {
+            "memory_hits": 0,
+            "disk_hits": 0,
+            "s3_hits": 0,
+            "misses": 0,
+            "characters_saved": 0,
+            "characters_synthesized": 0,
+        }
+        # key -> MP3 bytes
+        self._memory = OrderedDict()
+        self._memory_size = 0
+        # key -> file size, None until the directory was scanned
+        self._disk = None
+        self._disk_size = 0
+        # keys whose S3 object exists
+        self._in_s3 = OrderedDict()
+        # key -> future of the S3 object name, so a text is synthesized once at a time
+        self._resolving = {}
+
+    async def get_object_name(self, text: str):
+        """
+        Return the S3 key of the text's audio, synthesizing and uploading it
+        only if no identical audio is stored yet.
+
+        Returns
+        -------
+        The S3 key in `bucket`, or None if synthesis or upload failed.
+        """
+        text = normalize_text(text)
+        if not text:
+            return None
+        key = tts_cache_key(text)
+        if key in self._in_s3:
+            self._in_s3.move_to_end(key)
+            self._hit("s3_hits", text)
+            return object_name(key)
+        if key not in self._resolving:
+            self._resolving[key] = asyncio.ensure_future(self._resolve(key, text))
+        try:
+            return await asyncio.shield(self._resolving[key])
+        finally:
+            self._resolving.pop(key, None)
+
+    async def _resolve(self, key: str, text: str):
+        name = object_name(key)
+        if await run_blocking(self._exists, name):
+            self._remember(key)
+            self._hit("s3_hits", text)
+            return name
+
+        if len(text) > TTS_CHUNK_CHARS:
+            # Long texts are uploaded part by part while their chunks are
+            # synthesized, and are too rare to keep locally
+            uploaded = await aupload_audio_chunks_to_s3(
+                aiter_elevenlabs_audio_chunks(text), self.bucket, name
+            )
+            if not uploaded:
+                return None
+            self._miss(text)
+            self._remember(key)
+            return name
+
+        audio = await self._get_local(key, text)
+        if audio is None:
+            audio = await aget_elevenlabs_audio(text)
+            if not (audio and isinstance(audio, bytes)):
+                return None
+            self._miss(text)
+            await self._put_local(key, audio)
+        if not await self._upload(name, key, audio):
+            return None
+        return name
+
+    async def astream(self, text: str, optimize_streaming_latency: int = 0):
+        """
+        Like `aget_elevenlabs_audio_stream`, served from the local tiers when
+        the clip is hot. Streamed clips are added to the local tiers only.
+
+        Yields
+        ------
+        MP3 bytes. Raises `httpx.HTTPError` on a failed request.
+        """
+        text = normalize_text(text)
+        if not text:
+            return
+        key = tts_cache_key(text, optimize_streaming_latency)
+        audio = await self._get_local(key, text)
+        if audio is not None:
+            yield audio
+            return
+
+        chunks = []
+        async for chunk in aget_elevenlabs_audio_stream(text, optimize_streaming_latency):
+            chunks.append(chunk)
+            yield chunk
+        self._miss(text)
+        await self._put_local(key, b"".join(chunks))
+
+    async def store(
+        self, text: str, audio: bytes, optimize_streaming_latency: int = 0, segmented=True
+    ):
+        """
+        Store already synthesized audio of a text (e.g. a streamed reply) under
+        its content key, skipping the upload if it is stored already.
+
+        Returns
+        -------
+        The S3 key in `bucket`, or None if the upload failed.
+        """
+        key = tts_cache_key(normalize_text(text), optimize_streaming_latency, segmented)
+        name = object_name(key)
+        if key in self._in_s3 or await run_blocking(self._exists, name):
+            self._remember(key)
+            return name
+        return name if await self._upload(name, key, audio) else None
+
+    def metrics(self) -> dict:
+        hits = self.stats["memory_hits"] + self.stats["disk_hits"] + self.stats["s3_hits"]
+        lookups = hits + self.stats["misses"]
+        return {
+            **self.stats,
+            "hit_rate": hits / lookups if lookups else 0.0,
+            "memory_clips": len(self._memory),
+            "memory_bytes": self._memory_size,
+            "disk_clips": len(self._disk or ()),
+            "disk_bytes": self._disk_size,
+            "s3_keys_indexed": len(self._in_s3),
+        }
+
+    def _hit(self, tier: str, text: str):
+        self.stats[tier] += 1
+        self.stats["characters_saved"] += len(text)
+
+    def _miss(self, text: str):
+        self.stats["misses"] += 1
+        self.stats["characters_synthesized"] += len(text)
+
+    def _remember(self, key: str):
+        self._in_s3[key] = None
+        self._in_s3.move_to_end(key)
+        while len(self._in_s3) > self.max_keys:
+            self._in_s3.popitem(last=False)
+
+    def _exists(self, name: str) -> bool:
+        from botocore.exceptions import ClientError
+
+        try:
+            get_clients().s3.head_object(Bucket=self.bucket, Key=name)
+            return True
+        except ClientError as e:
+            if e.response.get("Error", {}).get("Code") not in ("404", "NoSuchKey", "NotFound"):
+                logging.warning(f"HEAD {name} failed, synthesizing: {str(e)}")
+            return False
+
+    async def _upload(self, name: str, key: str, audio: bytes) -> bool:
+        uploaded = await aupload_audio_bytes_to_s3(
+            audio_content=audio, bucket=self.bucket, object_name=name
+        )
+        if uploaded:
+            self._remember(key)
+        return uploaded
+
+    async def _get_local(self, key: str, text: str):
+        audio = self._memory.get(key)
+        if audio is not None:
+            self._memory.move_to_end(key)
+            self._hit("memory_hits", text)
+            return audio
+        if not self.disk_dir:
+            return None
+        await self._scan_disk()
+        if key not in self._disk:
+            return None
+        try:
+            audio = await run_blocking(_read_file, self._disk_path(key))
+        except OSError:
+            self._disk_size -= self._disk.pop(key, 0)
+            return None
+        self._disk.move_to_end(key)
+        self._hit("disk_hits", text)
+        self._put_memory(key, audio)
+        return audio
+
+    async def _put_local(self, key: str, audio: bytes):
+        self._put_memory(key, audio)
+        if not self.disk_dir or len(audio) > self.disk_bytes:
+            return
+        await self._scan_disk()
+        try:
+            await run_blocking(_write_file, self._disk_path(key), audio)
+        except OSError as e:
+            logging.warning(f"Could not write TTS clip to {self.disk_dir}: {str(e)}")
+            return
+        self._disk_size += len(audio) - self._disk.pop(key, 0)
+        self._disk[key] = len(audio)
+        evicted = []
+        while self._disk_size > self.disk_bytes:
+            old_key, size = self._disk.popitem(last=False)
+            self._disk_size -= size
+            evicted.append(self._disk_path(old_key))
+        if evicted:
+            await run_blocking(_remove_files, evicted)
+
+    def _put_memory(self, key: str, audio: bytes):
+        if len(audio) > self.memory_bytes:
+            return
+        old = self._memory.pop(key, None)
+        self._memory_size += len(audio) - (len(old) if old else 0)
+        self._memory[key] = audio
+        while self._memory_size > self.memory_bytes:
+            _, evicted = self._memory.popitem(last=False)
+            self._memory_size -= len(evicted)
+
+    async def _scan_disk(self):
+        """
+        Index the clips already on disk (e.g. from before a restart), oldest first.
+        """
+        if self._disk is not None:
+            return
+        files = await run_blocking(_list_clips, self.disk_dir)
+        self._disk = OrderedDict()
+        for key, size in files:
+            self._disk[key] = size
+            self._disk_size += size
+
+    def _disk_path(self, key: str) -> str:
+        return os.path.join(self.disk_dir, f"{key}.mp3")
+
+
+def _read_file(path):
+    with open(path, "rb") as f:
+        return f.read()
+
+
+def _write_file(path, data):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path + ".tmp", "wb") as f:
+        f.write(data)
+    os.replace(path + ".tmp", path)
+
+
+def _remove_files(paths):
+    for path in paths:
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+
+def _list_clips(directory):
+    """
+    Return (key, size) of the clips in `directory`, least recently written first.
+    """
+    if not os.path.isdir(directory):
+        return []
+    entries = [
+        entry
+        for entry in os.scandir(directory)
+        if entry.is_file() and entry.name.endswith(".mp3")
+    ]
+    entries.sort(key=lambda entry: entry.stat().st_mtime)
+    return [(entry.name[: -len(".mp3")], entry.stat().st_size) for entry in entries]
+
+
+tts_cache = TTSAudioCache()
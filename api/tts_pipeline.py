@@ -0,0 +1,174 @@
+import asyncio
+import logging
+import os
+import re
+
+from api.tts_cache import tts_cache
+
+"""
+Sentence-pipelined text-to-speech: the LLM reply is split at sentence
+boundaries while it streams, and each sentence is sent to ElevenLabs as soon as
+it is complete. Audio comes back in sentence order, so the first sentence can be
+played while the rest of the reply is still being generated.
+"""
+
+# Sentences synthesized at once
+TTS_CONCURRENCY = int(os.getenv("TTS_CONCURRENCY", "3"))
+# ElevenLabs `optimize_streaming_latency`, 0 (best quality) to 4 (fastest)
+TTS_STREAMING_LATENCY = int(os.getenv("TTS_STREAMING_LATENCY", "3"))
+# Shorter sentences are merged into the next one, very short TTS requests sound choppy
+TTS_MIN_SENTENCE_CHARS = 10
+
+# End of sentence punctuation (plus closing quotes/brackets), followed by whitespace
+SENTENCE_END = re.compile(r"[.!?…]+[\"'”’)\]]*\s+|\n+")
+
+
+class SentenceSplitter:
+    """
+    Split streamed text into complete sentences.
+    """
+
+    def __init__(self, min_chars: int = TTS_MIN_SENTENCE_CHARS):
+        self.min_chars = min_chars
+        self._buffer = ""
+
+    def feed(self, text: str) -> list:
+        """
+        Add text and return the sentences it completed (possibly none).
+        """
+        self._buffer += text
+        sentences = []
+        start = 0
+        for match in SENTENCE_END.finditer(self._buffer):
+            sentence = self._buffer[start : match.end()]
+            if len(sentence.strip()) >= self.min_chars:
+                sentences.append(sentence.strip())
+                start = match.end()
+        self._buffer = self._buffer[start:]
+        return sentences
+
+    def flush(self) -> str:
+        """
+        Return whatever text is left once the stream has ended.
+        """
+        rest, self._buffer = self._buffer.strip(), ""
+        return rest
+
+
+class SentenceAudioPipeline:
+    """
+    Synthesize sentences concurrently and yield their audio in order.
+
+    Call `feed` with each LLM token and `close` at the end of the reply, while
+    consuming `audio_chunks()`. The full MP3 is collected in `audio`.
+    """
+
+    def __init__(
+        self,
+        concurrency: int = TTS_CONCURRENCY,
+        optimize_streaming_latency: int = TTS_STREAMING_LATENCY,
+        synthesize=None,
+    ):
+        self.optimize_streaming_latency = optimize_streaming_latency
+        # Hot sentences (greetings...) are served from the TTS cache
+        self.synthesize = synthesize or tts_cache.astream
+        self.audio = bytearray()
+        self.failed = False
+        self._splitter = SentenceSplitter()
+        self._semaphore = asyncio.Semaphore(concurrency)
+        # One chunk queue per sentence, in sentence order; None marks the end
+        self._sentences = asyncio.Queue()
+        self._tasks = []
+
+    def feed(self, token: str):
+        for sentence in self._splitter.feed(token):
+            self._start(sentence)
+
+    def close(self):
+        rest = self._splitter.flush()
+        if rest:
+            self._start(rest)
+        self._sentences.put_nowait(None)
+
+    def cancel(self):
+        for task in self._tasks:
+            task.cancel()
+
+    async def audio_chunks(self):
+        """
+        Yield MP3 bytes for each sentence in order, as they arrive.
+        """
+        while (chunks := await self._sentences.get()) is not None:
+            while (chunk := await chunks.get()) is not None:
+                self.audio.extend(chunk)
+                yield chunk
+
+    def _start(self, sentence: str):
+        chunks = asyncio.Queue()
+        self._sentences.put_nowait(chunks)
+        self._tasks.append(asyncio.create_task(self._synthesize(sentence, chunks)))
+
+    async def _synthesize(self, sentence: str, chunks: asyncio.Queue):
+        try:
+            async with self._semaphore:
+                async for chunk in self.synthesize(
+                    sentence, self.optimize_streaming_latency
+                ):
+                    chunks.put_nowait(chunk)
+        except Exception as e:
+            logging.error(f"Sentence audio failed, skipping it: {str(e)}")
+            self.failed = True
+        finally:
+            chunks.put_nowait(None)
+
+
+async def stream_text_and_audio(tokens, pipeline: SentenceAudioPipeline):
+    """
+    Run the LLM tokens through the pipeline and merge both outputs.
+
+    Yields
+    ------
+    ("token", str) as the LLM produces text and ("audio", bytes) as sentence
+    audio becomes available. Exceptions from the token stream are re-raised.
+    """
+    events = asyncio.Queue()
+    finished = object()
+
+    async def produce_tokens():
+        try:
+            async for token in tokens:
+                pipeline.feed(token)
+                events.put_nowait(("token", token))
+        finally:
+            pipeline.close()
+
+    async def produce_audio():
+        async for chunk in pipeline.audio_chunks():
+            events.put_nowait(("audio", chunk))
+
+    async def run(producer):
+        try:
+            await producer()
+        except Exception as e:
+            events.put_nowait(("error", e))
+        finally:
+            events.put_nowait(finished)
+
+    tasks = [
+        asyncio.create_task(run(produce_tokens)),
+        asyncio.create_task(run(produce_audio)),
+    ]
+    try:
+        running = len(tasks)
+        while running:
+            event = await events.get()
+            if event is finished:
+                running -= 1
+            elif event[0] == "error":
+                raise event[1]
+            else:
+                yield event
+    finally:
+        for task in tasks:
+            task.cancel()
+        pipeline.cancel()
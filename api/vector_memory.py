@@ -0,0 +1,386 @@
+import asyncio
+import hashlib
+import io
+import logging
+import os
+from collections import OrderedDict
+
+import numpy as np
+
+from api.aio import run_blocking
+from api.clients import get_clients
+from chatbot import convert_to_langchain_messages, get_embeddings
+from update_table import aget_messages_after
+
+"""
+Retrieval memory: every stored message is embedded once, and each turn's
+prompt gets the top-k past messages most relevant to the user's message plus
+the most recent messages, so prompt size stays constant however long a chat is.
+
+Each chat has its own NumPy index (a float16/float32 matrix of normalized
+embeddings). New vectors are appended to a pending list and compacted into the
+matrix every VECTOR_COMPACT_EVERY rows, which is also when the index is
+persisted: to VECTOR_INDEX_DIR, or to S3 when VECTOR_INDEX_BUCKET is set.
+
+Indexes are only changed on the event loop. To persist one, a snapshot of its
+arrays is taken there and serialized and written on the blocking I/O pool,
+while the index keeps taking rows.
+"""
+
+VECTOR_DTYPE = np.float16 if os.getenv("VECTOR_DTYPE", "float16") == "float16" else np.float32
+VECTOR_INDEX_DIR = os.getenv("VECTOR_INDEX_DIR", "vector_index")
+VECTOR_INDEX_BUCKET = os.getenv("VECTOR_INDEX_BUCKET")
+# Pending rows before they are merged into the matrix and persisted
+VECTOR_COMPACT_EVERY = 32
+# Chat indexes kept in memory
+VECTOR_CHATS_CACHED = int(os.getenv("VECTOR_CHATS_CACHED", "256"))
+# Messages embedded per OpenAI request
+EMBEDDING_BATCH_SIZE = 64
+
+# Relevant past messages added to the prompt
+RETRIEVAL_TOP_K = int(os.getenv("RETRIEVAL_TOP_K", "4"))
+# Newest messages always sent verbatim
+RETRIEVAL_RECENT_MESSAGES = int(os.getenv("RETRIEVAL_RECENT_MESSAGES", "6"))
+# Messages read per catch-up query when (re)building an index
+BACKFILL_PAGE_SIZE = 500
+
+
+def _normalize(vector) -> np.ndarray:
+    vector = np.asarray(vector, dtype=np.float32)
+    norm = np.linalg.norm(vector)
+    return vector / norm if norm else vector
+
+
+class ChatVectorIndex:
+    """
+    Embeddings of one chat's messages, with their timestamps, types and texts.
+    """
+
+    def __init__(self, timestamps=(), types=(), texts=(), vectors=None):
+        self.timestamps = np.asarray(timestamps, dtype=np.int64)
+        self.types = list(types)
+        self.texts = list(texts)
+        self.vectors = vectors
+        self.dirty = False
+        # Bumped by every compaction, to tell whether a saved snapshot is current
+        self.version = 0
+        self._known = set(int(t) for t in self.timestamps)
+        self._pending = []
+
+    def __len__(self):
+        return len(self._known)
+
+    def __contains__(self, timestamp):
+        return int(timestamp) in self._known
+
+    @property
+    def newest_timestamp(self) -> int:
+        return max(self._known, default=0)
+
+    def add(self, timestamp, message_type, text, vector):
+        """
+        Append a message's embedding, ignoring messages already indexed.
+        """
+        if timestamp in self:
+            return
+        self._known.add(int(timestamp))
+        self._pending.append((int(timestamp), message_type, text, _normalize(vector)))
+        if len(self._pending) >= VECTOR_COMPACT_EVERY:
+            self.compact()
+
+    def compact(self):
+        """
+        Merge the pending rows into the matrix.
+        """
+        if not self._pending:
+            return
+        timestamps, types, texts, vectors = zip(*self._pending)
+        self._pending = []
+        new_vectors = np.stack(vectors).astype(VECTOR_DTYPE)
+        if self.vectors is None or not len(self.vectors):
+            self.vectors = new_vectors
+        else:
+            self.vectors = np.concatenate([self.vectors, new_vectors])
+        self.timestamps = np.concatenate(
+            [self.timestamps, np.asarray(timestamps, dtype=np.int64)]
+        )
+        self.types.extend(types)
+        self.texts.extend(texts)
+        self.dirty = True
+        self.version += 1
+
+    def search(self, query_vector, k: int, exclude=()):
+        """
+        Return the `k` messages most similar to `query_vector` (cosine), in
+        chronological order, skipping timestamps in `exclude`.
+        """
+        self.compact()
+        if self.vectors is None or not len(self.vectors):
+            return []
+        scores = self.vectors.astype(np.float32) @ _normalize(query_vector)
+        if exclude:
+            scores[np.isin(self.timestamps, np.asarray(list(exclude), dtype=np.int64))] = -np.inf
+        k = min(k, int(np.isfinite(scores).sum()))
+        if k <= 0:
+            return []
+        top = np.argpartition(-scores, k - 1)[:k]
+        top = top[np.argsort(self.timestamps[top])]
+        return [
+            {
+                "timestamp": int(self.timestamps[i]),
+                "type": self.types[i],
+                "message": self.texts[i],
+            }
+            for i in top
+        ]
+
+    def snapshot(self):
+        """
+        Compact, and return (version, rows) where rows are the index's current
+        arrays, never changed in place afterwards (compaction replaces them).
+        """
+        self.compact()
+        return self.version, (self.timestamps, tuple(self.types), tuple(self.texts), self.vectors)
+
+    def to_bytes(self) -> bytes:
+        return serialize(*self.snapshot()[1])
+
+    @classmethod
+    def from_bytes(cls, data: bytes):
+        with np.load(io.BytesIO(data)) as arrays:
+            return cls(
+                timestamps=arrays["timestamps"],
+                types=arrays["types"].tolist(),
+                texts=arrays["texts"].tolist(),
+                vectors=arrays["vectors"].astype(VECTOR_DTYPE),
+            )
+
+
+def serialize(timestamps, types, texts, vectors) -> bytes:
+    buffer = io.BytesIO()
+    np.savez_compressed(
+        buffer,
+        timestamps=timestamps,
+        types=np.asarray(types, dtype=str),
+        texts=np.asarray(texts, dtype=str),
+        vectors=vectors if vectors is not None else np.zeros((0, 0), VECTOR_DTYPE),
+    )
+    return buffer.getvalue()
+
+
+def _index_name(chat_id: str) -> str:
+    return hashlib.sha256(chat_id.encode()).hexdigest()[:32] + ".npz"
+
+
+def load_index(chat_id: str):
+    """
+    Load a chat's persisted index, or None if it has none.
+    """
+    name = _index_name(chat_id)
+    try:
+        if VECTOR_INDEX_BUCKET:
+            response = get_clients().s3.get_object(
+                Bucket=VECTOR_INDEX_BUCKET, Key=f"vector-index/{name}"
+            )
+            return ChatVectorIndex.from_bytes(response["Body"].read())
+        with open(os.path.join(VECTOR_INDEX_DIR, name), "rb") as f:
+            return ChatVectorIndex.from_bytes(f.read())
+    except FileNotFoundError:
+        return None
+    except Exception as e:
+        # e.g. NoSuchKey, the index is rebuilt from the table
+        logging.info(f"No vector index loaded for {chat_id}: {str(e)}")
+        return None
+
+
+def save_index(chat_id: str, rows):
+    """
+    Persist a chat's index from the rows of `ChatVectorIndex.snapshot`.
+    Blocking, run it on the I/O pool.
+    """
+    data = serialize(*rows)
+    name = _index_name(chat_id)
+    if VECTOR_INDEX_BUCKET:
+        get_clients().s3.put_object(
+            Bucket=VECTOR_INDEX_BUCKET, Key=f"vector-index/{name}", Body=data
+        )
+    else:
+        os.makedirs(VECTOR_INDEX_DIR, exist_ok=True)
+        path = os.path.join(VECTOR_INDEX_DIR, name)
+        with open(path + ".tmp", "wb") as f:
+            f.write(data)
+        os.replace(path + ".tmp", path)
+
+
+class VectorMemory:
+    """
+    The per-chat indexes of this worker, with batched background embedding.
+    """
+
+    def __init__(self, max_chats: int = VECTOR_CHATS_CACHED):
+        self.max_chats = max_chats
+        self._indexes = OrderedDict()
+        self._loading = {}
+        self._queue = None
+        self._worker = None
+        self._loop = None
+        self._background = set()
+
+    async def get_index(self, chat_id: str) -> ChatVectorIndex:
+        """
+        Return a chat's index, loading it (and catching up on messages stored
+        since it was persisted) on first use.
+        """
+        index = self._indexes.get(chat_id)
+        if index is not None:
+            self._indexes.move_to_end(chat_id)
+            return index
+        if chat_id not in self._loading:
+            self._loading[chat_id] = asyncio.ensure_future(self._load(chat_id))
+        try:
+            return await asyncio.shield(self._loading[chat_id])
+        finally:
+            self._loading.pop(chat_id, None)
+
+    async def _load(self, chat_id):
+        index = await run_blocking(load_index, chat_id) or ChatVectorIndex()
+        self._indexes[chat_id] = index
+        while len(self._indexes) > self.max_chats:
+            evicted_id, evicted = self._indexes.popitem(last=False)
+            if evicted.dirty or evicted._pending:
+                self._spawn(self.save(evicted_id, evicted))
+        self._spawn(self._catch_up(chat_id, index))
+        return index
+
+    async def _catch_up(self, chat_id, index):
+        """
+        Embed the messages stored after the index's newest message.
+        """
+        try:
+            while True:
+                items, truncated = await aget_messages_after(
+                    chat_id, index.newest_timestamp, BACKFILL_PAGE_SIZE, oldest_first=True
+                )
+                await self.index_messages(chat_id, items)
+                if not truncated:
+                    return
+        except Exception as e:
+            logging.error(f"Vector index catch-up failed for {chat_id}: {str(e)}")
+
+    async def index_messages(self, chat_id: str, items):
+        """
+        Embed and add stored messages (dicts) that aren't indexed yet.
+        """
+        index = await self.get_index(chat_id)
+        items = [item for item in items if item["timestamp"] not in index]
+        for start in range(0, len(items), EMBEDDING_BATCH_SIZE):
+            batch = items[start : start + EMBEDDING_BATCH_SIZE]
+            vectors = await get_embeddings().aembed_documents(
+                [item["message"] for item in batch]
+            )
+            for item, vector in zip(batch, vectors):
+                index.add(item["timestamp"], item["type"], item["message"], vector)
+        if index.dirty:
+            await self.save(chat_id, index)
+
+    async def save(self, chat_id: str, index: ChatVectorIndex):
+        """
+        Persist an index: snapshot on the event loop, written on the I/O pool.
+        It stays dirty if it was compacted again in the meantime.
+        """
+        version, rows = index.snapshot()
+        await run_blocking(save_index, chat_id, rows)
+        if index.version == version:
+            index.dirty = False
+
+    def schedule_index(self, chat_id: str, timestamp, message_type: str, message: str):
+        """
+        Queue a stored message for embedding. Messages queued around the same
+        time are embedded in one request.
+        """
+        self._start()
+        self._queue.put_nowait(
+            (chat_id, {"timestamp": timestamp, "type": message_type, "message": message})
+        )
+
+    def _start(self):
+        loop = asyncio.get_running_loop()
+        if self._worker and self._loop is loop:
+            return
+        self._loop = loop
+        self._queue = asyncio.Queue()
+        self._worker = asyncio.create_task(self._embed_queued())
+
+    async def _embed_queued(self):
+        while True:
+            batch = [await self._queue.get()]
+            while not self._queue.empty() and len(batch) < EMBEDDING_BATCH_SIZE:
+                batch.append(self._queue.get_nowait())
+            try:
+                vectors = await get_embeddings().aembed_documents(
+                    [item["message"] for _, item in batch]
+                )
+                for (chat_id, item), vector in zip(batch, vectors):
+                    index = await self.get_index(chat_id)
+                    index.add(item["timestamp"], item["type"], item["message"], vector)
+                    if index.dirty:
+                        await self.save(chat_id, index)
+            except Exception as e:
+                logging.error(f"Embedding {len(batch)} messages failed: {str(e)}")
+
+    async def load_history(self, chat_id: str, message: str, timestamp, recent_messages):
+        """
+        Build the prompt history for retrieval mode.
+
+        Embeds the user's (already stored) message, indexes it, and looks up the
+        RETRIEVAL_TOP_K most relevant older messages.
+
+        Returns
+        -------
+        A ChatMessageHistory: the relevant messages as a system message, then
+        the last RETRIEVAL_RECENT_MESSAGES of `recent_messages`.
+        """
+        index = await self.get_index(chat_id)
+        query_vector = await get_embeddings().aembed_query(message)
+        index.add(timestamp, "user", message, query_vector)
+
+        recent = recent_messages[-RETRIEVAL_RECENT_MESSAGES:]
+        relevant = index.search(
+            query_vector,
+            RETRIEVAL_TOP_K,
+            exclude={int(item["timestamp"]) for item in recent} | {int(timestamp)},
+        )
+
+        langchain_messages = convert_to_langchain_messages(recent)
+        if relevant:
+            from langchain_core.messages import SystemMessage
+
+            lines = "\n".join(
+                f"{'Human' if item['type'] == 'user' else 'AI'}: {item['message']}"
+                for item in relevant
+            )
+            langchain_messages.messages.insert(
+                0, SystemMessage(content=f"Relevant earlier messages:\n{lines}")
+            )
+        return langchain_messages
+
+    def _spawn(self, coroutine):
+        task = asyncio.ensure_future(coroutine)
+        self._background.add(task)
+        task.add_done_callback(self._background.discard)
+
+    async def aclose(self):
+        """
+        Stop embedding and persist every index with unsaved rows.
+        """
+        if self._worker:
+            self._worker.cancel()
+            await asyncio.gather(self._worker, return_exceptions=True)
+            self._worker = None
+        await asyncio.gather(*self._background, return_exceptions=True)
+        for chat_id, index in list(self._indexes.items()):
+            if index.dirty or index._pending:
+                await self.save(chat_id, index)
+
+
+vector_memory = VectorMemory()
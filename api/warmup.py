@@ -0,0 +1,85 @@
+import asyncio
+import logging
+import os
+import time
+
+from api.aio import run_blocking
+
+"""
+Warm-up of a worker: everything slow to build on first use (upstream clients
+and their credentials, LangChain and the prompts, the tokenizer) is built
+right after startup, so the first turns don't pay for it.
+
+Imports of the heavy dependencies are deferred to their first use (see
+chatbot.py), so a worker starts serving quickly; warm-up then runs its steps
+in the background and `GET /ready` answers 503 until they are done, which
+load balancers and autoscalers use to route traffic to warm workers only.
+A step that fails is logged and skipped: what it builds is built on first
+use instead.
+"""
+
+# "background": start serving at once and warm up behind it, "blocking":
+# finish warming up before serving, "off": build everything on first use
+WARM_UP = os.getenv("WARM_UP", "background")
+
+
+class WarmUp:
+    """
+    Named warm-up steps (blocking functions), run in order on the I/O pool.
+    """
+
+    def __init__(self, mode: str = WARM_UP):
+        self.mode = mode
+        self.steps = []
+        self.ready = False
+        self.seconds = {}
+        self.errors = {}
+        self.started = None
+        self.finished = None
+        self._task = None
+
+    def add_step(self, name: str, function):
+        self.steps.append((name, function))
+
+    async def start(self):
+        """
+        Warm up according to `mode`, e.g. in a FastAPI startup hook.
+        """
+        if self.mode == "off":
+            self.ready = True
+        elif self.mode == "blocking":
+            await self.run()
+        else:
+            self._task = asyncio.ensure_future(self.run())
+
+    async def run(self):
+        self.started = time.monotonic()
+        for name, function in self.steps:
+            start = time.perf_counter()
+            try:
+                await run_blocking(function)
+            except Exception as e:
+                logging.warning(f"Warm-up step {name} failed: {str(e)}")
+                self.errors[name] = str(e)
+            self.seconds[name] = time.perf_counter() - start
+        self.finished = time.monotonic()
+        self.ready = True
+        logging.info(f"Warmed up in {self.finished - self.started:.2f}s: {self.seconds}")
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+    def metrics(self) -> dict:
+        return {
+            "ready": self.ready,
+            "mode": self.mode,
+            "seconds": round(self.finished - self.started, 3) if self.finished else None,
+            "steps": {name: round(seconds, 3) for name, seconds in self.seconds.items()},
+            "errors": dict(self.errors),
+        }
+
+
+warm_up = WarmUp()
@@ -1,31 +1,39 @@
+import contextlib
+import functools
 import os
-from langchain_openai import OpenAIEmbeddings
-from langchain_openai import ChatOpenAI
-from langchain.chains import ConversationChain
-from langchain.memory import ConversationBufferMemory
-from langchain_core.messages import HumanMessage, AIMessage
+import threading
+import time
+from collections import OrderedDict
 from dotenv import load_dotenv
 import logging
-from langchain.memory import ChatMessageHistory
-from langchain.prompts.prompt import PromptTemplate
+from api.admission import Saturated, upstream_limits
+from api.clients import get_clients, OPENAI_TIMEOUTS
+from api.logs import LOG_DEBUG_SAMPLE_RATE, log_event
+from api.resilience import DeadlineExceeded, call_timeout, openai_policy, remaining
+from api.tracing import observe, stage
+
+# LangChain and openai take seconds to import, so they are imported where
+# they are used: on first use, or up front by `warm` (see api/warmup.py)
 
 load_dotenv()
 
+# Personas with their own system prompt, see `fetch_system_prompt`
+PROMPT_TEMPLATES = ("girlfriend", "therapist", "trainer", "default")
+
 
 def convert_to_langchain_messages(messages):
     """ """
-    # To learn how this works, go to ChatMessageHistory > BaseChatMessageHistory
-    langchain_messages = ChatMessageHistory()
-
-    for msg in messages:
-        print(f"coverting {msg} with type: {msg['type']}")
+    from langchain.memory import ChatMessageHistory
 
-        if msg["type"] == "user":
-            langchain_messages.add_user_message(msg["message"])
-        elif msg["type"] == "ai":
-            langchain_messages.add_ai_message(msg["message"])
+    # To learn how this works, go to ChatMessageHistory > BaseChatMessageHistory
+    with stage("convert_messages", messages=len(messages)):
+        langchain_messages = ChatMessageHistory()
 
-    print(f"created langchain messages: {langchain_messages}")
+        for msg in messages:
+            if msg["type"] == "user":
+                langchain_messages.add_user_message(msg["message"])
+            elif msg["type"] == "ai":
+                langchain_messages.add_ai_message(msg["message"])
     return langchain_messages
 
 
@@ -95,6 +103,122 @@ def fetch_system_prompt(prompt_template):
         )
 
 
+def build_llm(model_name: str, temperature: float):
+    """
+    Build an LLM on the registry's shared, pooled OpenAI clients. It is immutable
+    and shared between chats, see `get_llm`.
+    """
+    from langchain_openai import ChatOpenAI
+
+    clients = get_clients()
+    return ChatOpenAI(
+        temperature=temperature,
+        model_name=model_name,
+        # Shared, pooled OpenAI clients instead of new ones per chatbot
+        client=clients.openai.chat.completions,
+        async_client=clients.openai_async.chat.completions,
+    )
+
+
+def build_llm_and_prompt(model_name: str, temperature: float, prompt_template: str):
+    """
+    Build the LLM and prompt for a chatbot. Both are immutable and shared between
+    chats, see `get_llm_and_prompt`.
+    """
+    openai = build_llm(model_name, temperature)
+    chain_template = build_prompt(prompt_template)
+
+    log_event(
+        logging.INFO,
+        "chatbot_initialized",
+        model=model_name,
+        temperature=temperature,
+        prompt_template=prompt_template,
+    )
+    # The prompt itself only for a sample of the turns, at DEBUG
+    log_event(
+        logging.DEBUG, "chatbot_prompt", sample=LOG_DEBUG_SAMPLE_RATE, prompt=chain_template
+    )
+    return openai, chain_template
+
+
+@functools.lru_cache(maxsize=None)
+def build_prompt(prompt_template: str):
+    """
+    Build (once) the prompt of a persona. Prompts are immutable and shared.
+    """
+    from langchain.prompts.prompt import PromptTemplate
+
+    return PromptTemplate(
+        input_variables=["history", "input"],
+        template=fetch_system_prompt(prompt_template=prompt_template),
+    )
+
+
+# Most (model, temperature, persona) combinations kept built at once
+CHATBOT_CACHE_SIZE = 64
+
+_chatbot_cache = OrderedDict()
+_chatbot_cache_lock = threading.Lock()
+# Bumped by `invalidate_chatbot_cache`, so a build started before it isn't cached
+_chatbot_generation = 0
+
+
+def _get_cached(key, build):
+    with _chatbot_cache_lock:
+        cached = _chatbot_cache.get(key)
+        if cached is not None:
+            _chatbot_cache.move_to_end(key)
+            return cached
+        generation = _chatbot_generation
+
+    cached = build()
+    with _chatbot_cache_lock:
+        if generation == _chatbot_generation:
+            _chatbot_cache[key] = cached
+            while len(_chatbot_cache) > CHATBOT_CACHE_SIZE:
+                _chatbot_cache.popitem(last=False)
+    return cached
+
+
+def get_llm_and_prompt(model_name: str, temperature: float, prompt_template: str):
+    """
+    Return the cached (LLM, prompt) for a (model, temperature, persona), building
+    it on a miss. The least recently used entry is evicted past CHATBOT_CACHE_SIZE.
+    """
+    return _get_cached(
+        (model_name, float(temperature), prompt_template),
+        lambda: build_llm_and_prompt(model_name, temperature, prompt_template),
+    )
+
+
+def get_llm(model_name: str, temperature: float):
+    """
+    Return the cached LLM for a (model, temperature), without a persona's
+    prompt (e.g. for summaries).
+    """
+    return _get_cached(
+        (model_name, float(temperature), None), lambda: build_llm(model_name, temperature)
+    )
+
+
+def invalidate_chatbot_cache(prompt_template: str = None):
+    """
+    Drop cached chatbots, e.g. after a persona's system prompt changed.
+
+    Parameters
+    ----------
+    prompt_template (str): Only drop this persona. Drops everything if None.
+    """
+    global _chatbot_generation
+    with _chatbot_cache_lock:
+        _chatbot_generation += 1
+        for key in list(_chatbot_cache):
+            if prompt_template is None or key[2] == prompt_template:
+                del _chatbot_cache[key]
+    build_prompt.cache_clear()
+
+
 def initialize_chatbot(
     model_name: str = "gpt-3.5-turbo",
     temperature: float = 0.5,
@@ -105,37 +229,204 @@ def initialize_chatbot(
     Initialize a chatbot:
     - temperature
     - prompt
+
+    The LLM and prompt are cached, only the chat's memory is created per call.
     """
+    from langchain.chains import ConversationChain
+    from langchain.memory import ChatMessageHistory, ConversationBufferMemory
 
-    openai = ChatOpenAI(temperature=temperature, model_name=model_name)
+    with stage("initialize_chatbot"):
+        openai, chain_template = get_llm_and_prompt(
+            model_name, temperature, prompt_template
+        )
 
-    buffer_memory = ConversationBufferMemory(
-        # memory_key should match the prompt template
-        memory_key="history",
-        chat_memory=message_history,
-        return_messages=False,
-    )
-    # Look into the ConversationChain to see how we can configure the LLM, memory, and prompt
+        buffer_memory = ConversationBufferMemory(
+            # memory_key should match the prompt template
+            memory_key="history",
+            chat_memory=message_history or ChatMessageHistory(),
+            return_messages=False,
+        )
+        # Look into the ConversationChain to see how we can configure the LLM, memory, and prompt
 
-    text_prompt = fetch_system_prompt(prompt_template=prompt_template)
+        conversation = ConversationChain(
+            llm=openai, memory=buffer_memory, prompt=chain_template
+        )
 
-    chain_template = PromptTemplate(
-        input_variables=["history", "input"], template=text_prompt
-    )
+    return conversation
 
-    logging.info(f"Initializing chatbot: {model_name} {temperature} {chain_template}")
 
-    conversation = ConversationChain(
-        llm=openai, memory=buffer_memory, prompt=chain_template
-    )
-    # default prompt
+_embeddings = None
 
-    print(conversation.prompt)
-    logging.info(
-        f"intialized chatbot: {conversation} with prompt {conversation.prompt}"
-    )
 
-    return conversation
+def get_embeddings():
+    """
+    Return the shared embeddings model (an `OpenAIEmbeddings`, used by the
+    retrieval memory).
+    """
+    global _embeddings
+    if _embeddings is None:
+        from langchain_openai import OpenAIEmbeddings
+
+        clients = get_clients()
+        _embeddings = OpenAIEmbeddings(
+            client=clients.openai.embeddings,
+            async_client=clients.openai_async.embeddings,
+        )
+    return _embeddings
+
+
+def _reset_clients():
+    """
+    Drop the LLMs and embeddings built on clients that were just overridden or
+    closed (`ClientRegistry.aclose` on shutdown), they are rebuilt on new ones.
+    """
+    global _embeddings
+    invalidate_chatbot_cache()
+    _embeddings = None
+
+
+get_clients().on_reset(_reset_clients)
+
+
+@contextlib.asynccontextmanager
+async def llm_slot(model_name: str):
+    """
+    Hold a slot of the model's OpenAI limiter (see api/admission.py) around an
+    LLM call. OpenAI's own 429s are raised as `Saturated` too.
+
+    Connection errors, 5xx and deadline overruns count towards the OpenAI
+    circuit breaker (see api/resilience.py); while it is open this raises
+    `CircuitOpen` right away.
+    """
+    import openai
+
+    try:
+        openai_policy.breaker.check()
+        async with upstream_limits.openai(model_name).slot():
+            yield
+    except openai.RateLimitError as e:
+        openai_policy.breaker.cancel_probe()
+        retry_after = e.response.headers.get("retry-after", "1")
+        try:
+            retry_after = float(retry_after)
+        except ValueError:
+            retry_after = 1
+        raise Saturated(f"openai:{model_name}", retry_after) from e
+    except (openai.APIConnectionError, openai.InternalServerError, DeadlineExceeded) as e:
+        openai_policy.failed(e)
+        raise
+    except BaseException:
+        openai_policy.breaker.cancel_probe()
+        raise
+    openai_policy.breaker.success()
+
+
+def with_call_timeout(llm):
+    """
+    Bind the OpenAI request timeout of one call to what is left of the
+    request's deadline. Other chat models (e.g. fakes) are returned as is.
+    """
+    from langchain_openai import ChatOpenAI
+
+    if isinstance(llm, ChatOpenAI):
+        return llm.bind(timeout=call_timeout(OPENAI_TIMEOUTS))
+    return llm
+
+
+async def asummarize(summary: str, messages, model_name: str) -> str:
+    """
+    Extend a rolling conversation summary with new messages.
+
+    Parameters
+    ----------
+    summary (str): The summary so far ("" for none).
+    messages: The stored messages (dicts) to fold into the summary.
+    model_name (str): The model used to write the summary.
+
+    Returns
+    -------
+    The new summary.
+    """
+    from langchain.memory.prompt import SUMMARY_PROMPT
+    from langchain_core.messages import get_buffer_string
+
+    llm = get_llm(model_name, 0.0)
+    new_lines = get_buffer_string(convert_to_langchain_messages(messages).messages)
+    async with llm_slot(model_name):
+        result = await (SUMMARY_PROMPT | with_call_timeout(llm)).ainvoke(
+            {"summary": summary, "new_lines": new_lines}
+        )
+    return result.content
+
+
+async def ainvoke_response(conversation, message: str) -> dict:
+    """
+    Run the chatbot's prompt and LLM on `message`, like `conversation.ainvoke`
+    but without touching its memory, so concurrent attempts (retries, hedges)
+    can't save duplicate turns. Save the reply that is kept with
+    `save_response`.
+
+    Returns
+    -------
+    {"input", "history", "response"}, like `ConversationChain`.
+    """
+    history = conversation.memory.load_memory_variables({})["history"]
+    llm_chain = conversation.prompt | with_call_timeout(conversation.llm)
+    result = await llm_chain.ainvoke({"history": history, "input": message})
+    return {"input": message, "history": history, "response": result.content}
+
+
+def save_response(conversation, message: str, response: str):
+    """
+    Add a turn to the chatbot's memory, once per turn.
+    """
+    conversation.memory.save_context({"input": message}, {"response": response})
+
+
+async def astream_response(conversation, message: str):
+    """
+    Stream the chatbot's reply to `message` token by token.
+
+    `ConversationChain` only yields the finished response, so this runs the
+    chain's prompt and LLM directly with the memory's history.
+
+    Parameters
+    ----------
+    conversation: A chain returned by `initialize_chatbot`.
+    message (str): The user's message.
+
+    Yields
+    ------
+    The reply, one token (string) at a time.
+    """
+    history = conversation.memory.load_memory_variables({})["history"]
+    # OpenAI streams one token per chunk
+    # Other chat models (e.g. fakes) have no model_name
+    async with llm_slot(getattr(conversation.llm, "model_name", "default")):
+        llm_chain = conversation.prompt | with_call_timeout(conversation.llm)
+        with stage("llm", tokens=0, characters=0) as span:
+            async for chunk in llm_chain.astream({"history": history, "input": message}):
+                # Stop a slow stream once the request's deadline passed
+                remaining()
+                if chunk.content:
+                    if not span.sizes["tokens"]:
+                        observe("llm_first_token", time.perf_counter() - span.start)
+                    span.sizes["tokens"] += 1
+                    span.sizes["characters"] += len(chunk.content)
+                    yield chunk.content
+
+
+def warm():
+    """
+    Import LangChain and the OpenAI integration, and build the prompt of every
+    persona, so the first turn doesn't pay for them.
+    """
+    import langchain.chains
+    import langchain.memory
+    import langchain_openai
+
+    for prompt_template in PROMPT_TEMPLATES:
+        build_prompt(prompt_template)
 
 
 if __name__ == "__main__":
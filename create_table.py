@@ -1,3 +1,5 @@
+import os
+
 import boto3
 
 
@@ -54,3 +56,28 @@ def create_chat_table(table_name):
 # Call the function to create the table
 # Takes 15-30 seconds.
 chat_table = create_chat_table("ChatMessages")
+
+
+# Create the table /chat retries are deduplicated with across workers
+# (IDEMPOTENCY_BACKEND=dynamodb), records expire through DynamoDB's TTL
+def create_idempotency_table(table_name):
+    table = dynamodb.create_table(
+        TableName=table_name,
+        KeySchema=[{"AttributeName": "IdempotencyKey", "KeyType": "HASH"}],
+        AttributeDefinitions=[{"AttributeName": "IdempotencyKey", "AttributeType": "S"}],
+        BillingMode="PAY_PER_REQUEST",
+    )
+    table.meta.client.get_waiter("table_exists").wait(TableName=table_name)
+    table.meta.client.update_time_to_live(
+        TableName=table_name,
+        TimeToLiveSpecification={"Enabled": True, "AttributeName": "expires_at"},
+    )
+
+    print(f"Table {table_name} created successfully.")
+    return table
+
+
+if os.getenv("IDEMPOTENCY_BACKEND", "memory") == "dynamodb":
+    idempotency_table = create_idempotency_table(
+        os.getenv("IDEMPOTENCY_TABLE", "ChatIdempotency")
+    )
@@ -0,0 +1,373 @@
+import argparse
+import asyncio
+import contextlib
+import io
+import json
+import logging
+import os
+import platform
+import subprocess
+import sys
+import time
+from decimal import Decimal
+
+import httpx
+import openai
+
+# ChatOpenAI insists on a key, the fake OpenAI transport ignores it
+os.environ.setdefault("OPENAI_API_KEY", "fake")
+
+import chatbot
+import main
+import update_table
+from api.audio_jobs import audio_jobs
+from api.clients import get_clients
+from api.tokens import get_encoding
+from api.tracing import start_trace
+from demos.fakes import (
+    FakeDynamoDB,
+    FakeS3Client,
+    FakeTable,
+    fake_elevenlabs_transport,
+    fake_openai_transport,
+)
+
+"""
+End-to-end benchmark of `main.app` with every upstream faked in-process, so
+it runs offline and without credentials.
+
+- DynamoDB: `FakeTable` with the `ChatMessages` schema of create_table.py
+  (ChatID HASH, timestamp RANGE), seeded with `--history` messages per chat
+- S3: `FakeS3Client`
+- OpenAI: the real `ChatOpenAI` over `fake_openai_transport` (first token
+  after `--llm-latency`, then `--tokens-per-second`)
+- ElevenLabs: `fake_elevenlabs_transport` (`--tts-latency`, `--tts-bytes`)
+
+`--concurrency` clients send `--turns` POST /chat turns to each of `--chats`
+chats (the turns of one chat in order), wait for the audio jobs, then read
+every chat with paged POST /chat/messages. The stages of each request are
+collected with api/tracing.py; those of the background audio jobs separately.
+
+Results (throughput, and p50/p95/p99 of every request kind and stage) are
+printed and, with `--output`, written as JSON (with the git commit) to track
+across commits; a `.jsonl` output gets one line appended per run:
+```
+python -m demos.bench_e2e --output bench.jsonl
+python -m demos.bench_e2e --concurrency 64 --history 500 --tokens-per-second 100
+```
+"""
+
+PERCENTILES = (50, 95, 99)
+
+
+def percentile(sorted_values, p):
+    """Nearest-rank percentile of an already sorted list."""
+    if not sorted_values:
+        return None
+    rank = max(1, -(-len(sorted_values) * p // 100))
+    return sorted_values[int(rank) - 1]
+
+
+def summarize(samples):
+    """
+    Return count, mean and percentiles (milliseconds) of durations in seconds.
+    """
+    samples = sorted(samples)
+    summary = {"count": len(samples)}
+    if samples:
+        summary["mean_ms"] = round(sum(samples) / len(samples) * 1000, 3)
+        for p in PERCENTILES:
+            summary[f"p{p}_ms"] = round(percentile(samples, p) * 1000, 3)
+    return summary
+
+
+def git_commit():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout.strip()
+    except Exception:
+        return None
+
+
+def install_fakes(args):
+    table = FakeTable(latency=args.dynamodb_latency)
+    dynamodb = FakeDynamoDB({update_table.TABLE_NAME: table}, latency=args.dynamodb_latency)
+    get_clients().override(
+        **{
+            "dynamodb": dynamodb,
+            f"table:{update_table.TABLE_NAME}": table,
+            "s3": FakeS3Client(latency=args.s3_latency),
+            "elevenlabs_async": httpx.AsyncClient(
+                transport=fake_elevenlabs_transport(
+                    latency=args.tts_latency, audio_bytes=args.tts_bytes
+                )
+            ),
+            # Only the async client sends requests, the sync one must exist
+            "openai": openai.OpenAI(api_key="fake"),
+            "openai_async": openai.AsyncOpenAI(
+                api_key="fake",
+                http_client=httpx.AsyncClient(
+                    transport=fake_openai_transport(
+                        latency=args.llm_latency,
+                        tokens_per_second=args.tokens_per_second,
+                        reply_tokens=args.reply_tokens,
+                        unique=not args.repeat_replies,
+                    )
+                ),
+            ),
+        }
+    )
+    return table
+
+
+def seed_history(table, chats, history):
+    """
+    Store `history` alternating user / AI messages in every chat.
+    """
+    start = 1_600_000_000
+    for chat in range(chats):
+        for i in range(history):
+            table._put(
+                {
+                    "ChatID": f"bench-{chat}",
+                    "timestamp": Decimal(start + i * 10),
+                    "message": f"Message {i} of the chat, about today's workout and plans.",
+                    "type": "user" if i % 2 == 0 else "ai",
+                }
+            )
+
+
+class Recorder:
+    """
+    Latencies of one kind of request, and of the stages they went through.
+    """
+
+    def __init__(self):
+        self.latencies = []
+        self.stages = {}
+        self.errors = 0
+        self.seconds = 0.0
+
+    async def request(self, send):
+        trace = start_trace()
+        start = time.perf_counter()
+        try:
+            response = await send()
+            ok = response.status_code < 400
+        except Exception:
+            ok = False
+        self.latencies.append(time.perf_counter() - start)
+        if not ok:
+            self.errors += 1
+        self.add_stages(trace)
+
+    def add_stages(self, trace):
+        for name, seconds in trace.stages:
+            self.stages.setdefault(name, []).append(seconds)
+
+    def results(self):
+        results = {
+            "requests": len(self.latencies),
+            "errors": self.errors,
+            "seconds": round(self.seconds, 3),
+            "throughput_rps": (
+                round(len(self.latencies) / self.seconds, 2) if self.seconds else None
+            ),
+            "latency": summarize(self.latencies),
+            "stages": {
+                name: summarize(samples) for name, samples in sorted(self.stages.items())
+            },
+        }
+        return results
+
+
+async def run_chat_turns(client, args, recorder):
+    queue = asyncio.Queue()
+    for chat in range(args.chats):
+        queue.put_nowait(chat)
+
+    async def worker():
+        # A chat's turns are sent in order, like one user typing
+        while not queue.empty():
+            chat = queue.get_nowait()
+            for turn in range(args.turns):
+                body = {
+                    "chat_id": f"bench-{chat}",
+                    "timestamp": 1_700_000_000 + turn * 10,
+                    "message": "Did a 5k run and some push-ups today, what's next?",
+                    "model": args.model,
+                    "prompt_template": "trainer",
+                }
+                await recorder.request(lambda: client.post("/chat", json=body))
+
+    start = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(args.concurrency)))
+    recorder.seconds = time.perf_counter() - start
+
+
+async def run_message_reads(client, args, recorder):
+    queue = asyncio.Queue()
+    for chat in range(args.chats):
+        queue.put_nowait(chat)
+
+    async def worker():
+        while not queue.empty():
+            chat = queue.get_nowait()
+            # Newest page first, then scroll back with `next_cursor`
+            cursor = {}
+            while True:
+                body = {"chat_id": f"bench-{chat}", "limit": args.page_size, **cursor}
+                cursors = []
+                await recorder.request(lambda: _read_page(client, body, cursors))
+                if not cursors or cursors[-1] is None:
+                    break
+                cursor = cursors[-1]
+
+    start = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(args.concurrency)))
+    recorder.seconds = time.perf_counter() - start
+
+
+async def _read_page(client, body, cursors):
+    response = await client.post("/chat/messages", json=body)
+    ok = response.status_code == 200
+    cursors.append(response.json().get("next_cursor") if ok else None)
+    return response
+
+
+async def wait_for_audio_jobs():
+    while any(job.status == "pending" for job in audio_jobs.jobs.values()):
+        await asyncio.sleep(0.01)
+
+
+async def bench(args):
+    chat = Recorder()
+    messages = Recorder()
+
+    # The audio workers (and so the background stages) get their own trace
+    audio_trace = start_trace()
+    audio_jobs.start()
+
+    transport = httpx.ASGITransport(app=main.app)
+    async with httpx.AsyncClient(
+        transport=transport, base_url="http://bench", timeout=None
+    ) as client:
+        # Untimed turns build the chain, clients and pools, like a warm worker
+        for i in range(args.warmup):
+            body = {
+                "chat_id": f"warmup-{i}",
+                "timestamp": 1_700_000_000,
+                "message": "Warming up!",
+                "model": args.model,
+                "prompt_template": "trainer",
+            }
+            await client.post("/chat", json=body)
+        await wait_for_audio_jobs()
+        audio_jobs.jobs.clear()
+        audio_trace.stages.clear()
+
+        await run_chat_turns(client, args, chat)
+        start = time.perf_counter()
+        await wait_for_audio_jobs()
+        drain_seconds = time.perf_counter() - start
+        await run_message_reads(client, args, messages)
+
+    audio = Recorder()
+    audio.add_stages(audio_trace)
+    jobs = list(audio_jobs.jobs.values())
+    await main.shutdown()
+    return {
+        "chat": chat.results(),
+        "chat_messages": messages.results(),
+        "audio_jobs": {
+            "jobs": len(jobs),
+            "failed": sum(job.status == "failed" for job in jobs),
+            "drain_seconds": round(drain_seconds, 3),
+            "stages": audio.results()["stages"],
+        },
+    }
+
+
+def print_results(results):
+    def line(name, summary):
+        percentiles = "  ".join(
+            f"p{p} {summary.get(f'p{p}_ms', 0):8.1f}" for p in PERCENTILES
+        )
+        return f"  {name:<22} {summary['count']:6d}  {percentiles} ms"
+
+    for kind in ("chat", "chat_messages"):
+        r = results["results"][kind]
+        print(
+            f"{kind}: {r['requests']} requests, {r['errors']} errors, "
+            f"{r['throughput_rps']} req/s"
+        )
+        print(line("total", r["latency"]))
+        for name, summary in r["stages"].items():
+            print(line(name, summary))
+    r = results["results"]["audio_jobs"]
+    print(f"audio jobs: {r['jobs']} ({r['failed']} failed), drained in {r['drain_seconds']} s")
+    for name, summary in r["stages"].items():
+        print(line(name, summary))
+
+
+def run():
+    parser = argparse.ArgumentParser(description="Offline end-to-end benchmark")
+    parser.add_argument("--concurrency", type=int, default=32)
+    parser.add_argument("--chats", type=int, default=64)
+    parser.add_argument("--turns", type=int, default=5, help="/chat turns per chat")
+    parser.add_argument("--history", type=int, default=50, help="Messages stored per chat")
+    parser.add_argument("--warmup", type=int, default=4, help="Untimed /chat turns first")
+    parser.add_argument("--page-size", type=int, default=50, help="/chat/messages limit")
+    parser.add_argument("--model", default="gpt-3.5-turbo")
+    parser.add_argument("--llm-latency", type=float, default=0.3, help="Time to first token")
+    parser.add_argument("--tokens-per-second", type=float, default=80.0)
+    parser.add_argument("--reply-tokens", type=int, default=40)
+    parser.add_argument(
+        "--repeat-replies", action="store_true", help="Same reply every turn (TTS cache hits)"
+    )
+    parser.add_argument("--tts-latency", type=float, default=0.4)
+    parser.add_argument("--tts-bytes", type=int, default=32_000)
+    parser.add_argument("--dynamodb-latency", type=float, default=0.005)
+    parser.add_argument("--s3-latency", type=float, default=0.02)
+    parser.add_argument(
+        "--output", help="Write the results as JSON, or append them to a .jsonl file"
+    )
+    args = parser.parse_args()
+
+    table = install_fakes(args)
+    seed_history(table, args.chats, args.history)
+    # Load the tokenizer and LangChain before timing, like a warmed-up worker
+    get_encoding(args.model)
+    chatbot.warm()
+    logging.disable(logging.CRITICAL)
+
+    with contextlib.redirect_stdout(io.StringIO()):
+        results = asyncio.run(bench(args))
+
+    report = {
+        "benchmark": "e2e",
+        "commit": git_commit(),
+        "time": int(time.time()),
+        "python": sys.version.split()[0],
+        "platform": platform.platform(),
+        "config": vars(args),
+        "results": results,
+    }
+    print_results(report)
+    if args.output and args.output.endswith(".jsonl"):
+        # One line per run, a history of results across commits
+        with open(args.output, "a") as f:
+            f.write(json.dumps(report) + "\n")
+        print(f"Results appended to {args.output}")
+    elif args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+        print(f"Results written to {args.output}")
+
+
+if __name__ == "__main__":
+    run()
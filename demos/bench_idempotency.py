@@ -0,0 +1,144 @@
+import argparse
+import asyncio
+import contextlib
+import io
+import logging
+import random
+import time
+
+import httpx
+
+import main
+import update_table
+from api.clients import get_clients
+from api.idempotency import IdempotentTurns
+from demos.fakes import (
+    FakeChain,
+    FakeDynamoDB,
+    FakeKeyValueTable,
+    FakeS3Client,
+    FakeTable,
+    fake_elevenlabs_transport,
+)
+
+"""
+Benchmark: /chat turns sent by impatient clients, each turn followed by
+`--retries` copies of the same request, half while the turn still runs and
+half once it answered, against local fakes.
+
+- off: every copy runs the whole turn (the handler without api/idempotency.py)
+- memory: copies attach to the running turn or get its response replayed
+- dynamodb: the same, turns also claimed in a (fake) idempotency table
+
+Run from the repo root:
+```
+python -m demos.bench_idempotency --turns 200 --retries 2
+```
+"""
+
+
+class CountingChain(FakeChain):
+    calls = 0
+
+    async def _areply(self, prompt):
+        CountingChain.calls += 1
+        return await super()._areply(prompt)
+
+
+def install_fakes(args):
+    table = FakeTable(latency=args.dynamodb_latency)
+    dynamodb = FakeDynamoDB({update_table.TABLE_NAME: table}, latency=args.dynamodb_latency)
+    get_clients().override(
+        **{
+            "dynamodb": dynamodb,
+            f"table:{update_table.TABLE_NAME}": table,
+            "s3": FakeS3Client(latency=args.s3_latency),
+            "elevenlabs_async": httpx.AsyncClient(
+                transport=fake_elevenlabs_transport(latency=args.tts_latency)
+            ),
+        }
+    )
+    main.initialize_chatbot = lambda **kwargs: CountingChain(
+        latency=args.llm_latency, message_history=kwargs.get("message_history")
+    )
+
+
+async def no_idempotency(chat_request: main.ChatRequest):
+    return await main.chat_turn(chat_request)
+
+
+async def run_turns(args, path):
+    transport = httpx.ASGITransport(app=main.app)
+    async with httpx.AsyncClient(
+        transport=transport, base_url="http://test", timeout=None
+    ) as client:
+        run_id = random.getrandbits(32)
+
+        async def send(i):
+            response = await client.post(
+                path,
+                json={
+                    "chat_id": f"retry-{run_id}-{i}",
+                    "timestamp": 1700000000 + i,
+                    "message": "How was your day?",
+                    "model": "gpt-3.5-turbo",
+                    "prompt_template": "girlfriend",
+                },
+            )
+            return response
+
+        async def turn(i):
+            # The first request, early retries while it runs, late ones after
+            early = args.retries - args.retries // 2
+            first, *retries = await asyncio.gather(
+                send(i),
+                *(send(i) for _ in range(early)),
+            )
+            retries += [await send(i) for _ in range(args.retries // 2)]
+            return [first] + retries
+
+        start = time.perf_counter()
+        responses = await asyncio.gather(*(turn(i) for i in range(args.turns)))
+        elapsed = time.perf_counter() - start
+    return elapsed, [response for turn in responses for response in turn]
+
+
+def run():
+    parser = argparse.ArgumentParser(description="Duplicate /chat retries benchmark")
+    parser.add_argument("--turns", type=int, default=200)
+    parser.add_argument("--retries", type=int, default=2)
+    parser.add_argument("--llm-latency", type=float, default=0.5)
+    parser.add_argument("--tts-latency", type=float, default=0.3)
+    parser.add_argument("--dynamodb-latency", type=float, default=0.01)
+    parser.add_argument("--s3-latency", type=float, default=0.02)
+    args = parser.parse_args()
+
+    install_fakes(args)
+    main.app.post("/chat-without-idempotency")(no_idempotency)
+    logging.disable(logging.CRITICAL)
+
+    requests = args.turns * (1 + args.retries)
+    print(f"{args.turns} turns, {args.retries} retries each: {requests} requests")
+    for label in ("off", "memory", "dynamodb"):
+        path = "/chat-without-idempotency" if label == "off" else "/chat"
+        if label == "dynamodb":
+            get_clients().override(
+                **{"table:ChatIdempotency": FakeKeyValueTable(latency=args.dynamodb_latency)}
+            )
+        main.idempotent_turns = IdempotentTurns(backend=label)
+        CountingChain.calls = 0
+        with contextlib.redirect_stdout(io.StringIO()):
+            elapsed, responses = asyncio.run(run_turns(args, path))
+            update_table.flush_messages()
+        ok = sum(response.status_code == 200 for response in responses)
+        replayed = sum("idempotent-replayed" in response.headers for response in responses)
+        print(
+            f"{label:>8}: {elapsed:6.2f} s, {ok}/{requests} ok, {replayed} replayed, "
+            f"{CountingChain.calls} LLM calls ({CountingChain.calls / args.turns:.2f}/turn)"
+        )
+        if label != "off":
+            print(f"{'':>10}{main.idempotent_turns.metrics()}")
+
+
+if __name__ == "__main__":
+    run()
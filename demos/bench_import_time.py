@@ -0,0 +1,81 @@
+import argparse
+import json
+import subprocess
+import sys
+
+from demos.bench_e2e import git_commit
+
+"""
+Benchmark: import time of the app's entry points, from `python -X importtime`
+(cumulative microseconds of the top-level import, best of `--runs` fresh
+interpreters). Worker boot, autoscaling and every script importing
+`update_table` pay for it before doing anything.
+
+Heavy dependencies (LangChain, openai) are imported on first use or by the
+warm-up (see api/warmup.py), so they should not show up here; `--top` lists
+the slowest imports of each module to spot regressions.
+
+Results can be tracked across commits like demos/bench_e2e.py:
+```
+python -m demos.bench_import_time --output import_time.jsonl
+```
+"""
+
+MODULES = ("main", "update_table", "chatbot", "table_tools")
+
+
+def import_times(module: str) -> dict:
+    """
+    {imported module: cumulative seconds} of one `import module` in a fresh
+    interpreter.
+    """
+    stderr = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+        capture_output=True,
+        text=True,
+        check=True,
+    ).stderr
+    times = {}
+    for line in stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        _, cumulative, name = line[len("import time:") :].split("|")
+        times[name.strip()] = int(cumulative) / 1e6
+    return times
+
+
+def run():
+    parser = argparse.ArgumentParser(description="Import time benchmark")
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--top", type=int, default=5)
+    parser.add_argument(
+        "--output", help="Write the results as JSON, or append them to a .jsonl file"
+    )
+    args = parser.parse_args()
+
+    results = {}
+    for module in MODULES:
+        runs = [import_times(module) for _ in range(args.runs)]
+        best = min(runs, key=lambda times: times[module])
+        results[module] = round(best[module], 4)
+        slowest = sorted(
+            ((seconds, name) for name, seconds in best.items() if name != module),
+            reverse=True,
+        )[: args.top]
+        print(f"{module:>14}: {best[module] * 1000:7.1f} ms")
+        for seconds, name in slowest:
+            print(f"{'':>16}{seconds * 1000:7.1f} ms  {name}")
+
+    report = {"commit": git_commit(), "import_seconds": results}
+    if args.output and args.output.endswith(".jsonl"):
+        with open(args.output, "a") as f:
+            f.write(json.dumps(report) + "\n")
+        print(f"Results appended to {args.output}")
+    elif args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+        print(f"Results written to {args.output}")
+
+
+if __name__ == "__main__":
+    run()
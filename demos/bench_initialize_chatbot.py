@@ -0,0 +1,86 @@
+import argparse
+import contextlib
+import io
+import logging
+import os
+import time
+
+os.environ.setdefault("OPENAI_API_KEY", "sk-fake")
+
+from langchain.chains import ConversationChain
+from langchain.memory import ConversationBufferMemory
+from langchain.prompts.prompt import PromptTemplate
+from langchain_openai import ChatOpenAI
+
+import chatbot
+
+"""
+Micro-benchmark: `initialize_chatbot` per turn, uncached vs cached.
+
+"uncached" is the previous implementation: a new ChatOpenAI (and with it new
+OpenAI HTTP clients), a new PromptTemplate and the prompt printed and logged
+on every call. No network calls are made.
+
+Run from the repo root:
+```
+python -m demos.bench_initialize_chatbot
+```
+"""
+
+
+def uncached_initialize_chatbot(model_name, temperature, prompt_template, message_history):
+    openai = ChatOpenAI(temperature=temperature, model_name=model_name)
+    buffer_memory = ConversationBufferMemory(
+        memory_key="history", chat_memory=message_history, return_messages=False
+    )
+    text_prompt = chatbot.fetch_system_prompt(prompt_template=prompt_template)
+    chain_template = PromptTemplate(
+        input_variables=["history", "input"], template=text_prompt
+    )
+    logging.info(f"Initializing chatbot: {model_name} {temperature} {chain_template}")
+    conversation = ConversationChain(
+        llm=openai, memory=buffer_memory, prompt=chain_template
+    )
+    print(conversation.prompt)
+    logging.info(f"intialized chatbot: {conversation} with prompt {conversation.prompt}")
+    return conversation
+
+
+def history(turns):
+    messages = []
+    for i in range(turns):
+        messages.append({"type": "user", "message": f"Message number {i} from me"})
+        messages.append({"type": "ai", "message": f"Reply number {i} from the bot"})
+    with contextlib.redirect_stdout(io.StringIO()):
+        return chatbot.convert_to_langchain_messages(messages)
+
+
+def bench(initialize, calls, message_history):
+    with contextlib.redirect_stdout(io.StringIO()):
+        start = time.perf_counter()
+        for _ in range(calls):
+            initialize(
+                model_name="gpt-3.5-turbo",
+                temperature=0.2,
+                prompt_template="trainer",
+                message_history=message_history,
+            )
+        return (time.perf_counter() - start) / calls
+
+
+def run():
+    parser = argparse.ArgumentParser(description="initialize_chatbot micro-benchmark")
+    parser.add_argument("--calls", type=int, default=200)
+    parser.add_argument("--turns", type=int, default=20)
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, stream=io.StringIO())
+
+    message_history = history(args.turns)
+    uncached = bench(uncached_initialize_chatbot, args.calls, message_history)
+    cached = bench(chatbot.initialize_chatbot, args.calls, message_history)
+    print(f"uncached: {uncached * 1000:7.3f} ms/call")
+    print(f"  cached: {cached * 1000:7.3f} ms/call ({uncached / cached:.1f}x)")
+
+
+if __name__ == "__main__":
+    run()
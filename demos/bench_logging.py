@@ -0,0 +1,209 @@
+import argparse
+import contextlib
+import logging
+import os
+import sys
+import time
+from decimal import Decimal
+
+os.environ.setdefault("OPENAI_API_KEY", "sk-fake")
+
+from fastapi import status
+from fastapi.responses import JSONResponse
+
+import chatbot
+from api import logs
+from api.logs import log_event
+
+"""
+Micro-benchmark: CPU spent on logging per /chat turn of a `--messages` message
+chat, before and after structured logging (api/logs.py). Only the logging
+statements of a turn are run; the LangChain history they log is built once,
+up front. Each figure is the best of `--repeats` runs of `--turns` turns.
+
+"before" is the previous logging, statement for statement: the DynamoDB
+history, the LangChain history and the prompt formatted into INFO logs, a
+print per converted message, the stored items and the response logged whole,
+written by a StreamHandler on the request thread. "after" logs the events the
+app logs now (main.py, chatbot.py, update_table.py), with each output mode.
+
+"request" is the CPU of the request thread, "total" the whole process's,
+including the listener thread writing queued records. Logs and prints go to
+os.devnull.
+
+Run from the repo root:
+```
+python -m demos.bench_logging --messages 500
+```
+"""
+
+MODES = (
+    # name, logging, format, queue, level
+    ("before", "legacy", "text", False, "INFO"),
+    ("after, text", "structured", "text", False, "INFO"),
+    ("after, text + queue", "structured", "text", True, "INFO"),
+    ("after, json + queue", "structured", "json", True, "INFO"),
+    ("after, json + queue, DEBUG", "structured", "json", True, "DEBUG"),
+)
+
+
+def chat_history(count):
+    now = int(time.time())
+    return [
+        {
+            "ChatID": "chat-1",
+            "timestamp": Decimal(now - (count - i) * 60),
+            "message": f"Message {i} of the chat, about today's workout and plans. " * 3,
+            "type": "user" if i % 2 == 0 else "ai",
+        }
+        for i in range(count)
+    ]
+
+
+def legacy_turn(chat_request, messages, langchain_messages, chain_template, bot_response):
+    for item in (messages[-1], {**messages[-1], "message": bot_response}):
+        logging.info("========================")
+        logging.info(f"Creating item: {item}")
+        logging.info("========================")
+        logging.info(f"Item stored: {{'ResponseMetadata': {{'HTTPStatusCode': 200}}}}")
+    # The prints of the previous `convert_to_langchain_messages`
+    for msg in messages:
+        print(f"coverting {msg} with type: {msg['type']}")
+    print(f"created langchain messages: {langchain_messages}")
+    logging.info("DynamoDB Chat History %s", messages)
+    logging.info("LangChain Messages %s", langchain_messages)
+    logging.info(
+        f"Initializing chatbot: {chat_request['model']} {chat_request['temperature']} "
+        f"{chain_template}"
+    )
+    logging.info(f"Received request: {chat_request}")
+    logging.info(f"INVOKING CHATBOT")
+    logging.info(bot_response)
+    logging.info(RESPONSE)
+
+
+def structured_turn(chat_request, messages, langchain_messages, chain_template, bot_response):
+    for item in (messages[-1], {**messages[-1], "message": bot_response}):
+        log_event(
+            logging.DEBUG,
+            "store_message",
+            chat_id=item["ChatID"],
+            timestamp=item["timestamp"],
+            type=item["type"],
+            characters=len(item["message"]),
+        )
+    log_event(
+        logging.DEBUG,
+        "chat_history",
+        sample=logs.LOG_DEBUG_SAMPLE_RATE,
+        chat_id=chat_request["chat_id"],
+        messages=len(langchain_messages.messages),
+        history=lambda: langchain_messages,
+    )
+    log_event(
+        logging.INFO,
+        "chatbot_initialized",
+        model=chat_request["model"],
+        temperature=chat_request["temperature"],
+        prompt_template=chat_request["prompt_template"],
+    )
+    log_event(
+        logging.DEBUG, "chatbot_prompt", sample=logs.LOG_DEBUG_SAMPLE_RATE, prompt=chain_template
+    )
+    log_event(
+        logging.INFO,
+        "chat_request",
+        chat_id=chat_request["chat_id"],
+        model=chat_request["model"],
+        memory="buffer",
+        characters=len(chat_request["message"]),
+        history=len(langchain_messages.messages),
+    )
+    log_event(
+        logging.INFO, "chat_response", chat_id=chat_request["chat_id"], characters=len(bot_response)
+    )
+    log_event(
+        logging.DEBUG,
+        "chat_response_text",
+        sample=logs.LOG_DEBUG_SAMPLE_RATE,
+        chat_id=chat_request["chat_id"],
+        response=bot_response,
+    )
+
+
+def measure(turn, turns, args, setup=lambda: None):
+    """(request thread, process) CPU seconds per turn, queued records written."""
+    setup()
+    thread_start, process_start = time.thread_time(), time.process_time()
+    for _ in range(turns):
+        turn(*args)
+    thread_seconds = time.thread_time() - thread_start
+    logs.stop_logging()
+    process_seconds = time.process_time() - process_start
+    return thread_seconds / turns, process_seconds / turns
+
+
+def best(turn, args, setup=lambda: None):
+    runs = [measure(turn, args.turns, args.turn_args, setup) for _ in range(args.repeats)]
+    return min(thread for thread, _ in runs), min(process for _, process in runs)
+
+
+def legacy_setup(stream, level):
+    """The previous `logging.basicConfig`: a StreamHandler on the root logger."""
+    root = logging.getLogger()
+    for existing in list(root.handlers):
+        root.removeHandler(existing)
+    handler = logging.StreamHandler(stream)
+    handler.setFormatter(logging.Formatter(logs.TEXT_FORMAT, logs.DATE_FORMAT))
+    root.addHandler(handler)
+    root.setLevel(level)
+
+
+# What the previous `/chat` logged last
+RESPONSE = JSONResponse(content={}, status_code=status.HTTP_200_OK)
+
+
+def run():
+    parser = argparse.ArgumentParser(description="Logging CPU per /chat turn")
+    parser.add_argument("--messages", type=int, default=500)
+    parser.add_argument("--turns", type=int, default=20)
+    parser.add_argument("--repeats", type=int, default=10)
+    args = parser.parse_args()
+
+    messages = chat_history(args.messages)
+    chat_request = {
+        "chat_id": "chat-1",
+        "timestamp": int(time.time()),
+        "message": "How should I train for a half marathon?",
+        "model": "gpt-3.5-turbo",
+        "prompt_template": "trainer",
+        "temperature": 0.2,
+    }
+    bot_response = "Build up slowly: three easy runs a week, one long run. " * 15
+    args.turn_args = (
+        chat_request,
+        messages,
+        chatbot.convert_to_langchain_messages(messages),
+        chatbot.build_prompt("trainer"),
+        bot_response,
+    )
+
+    print(f"{args.messages} messages, {args.turns} turns, CPU ms per turn spent on logging")
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+        for name, kind, format, use_queue, level in MODES:
+            if kind == "legacy":
+                turn = legacy_turn
+                setup = lambda: legacy_setup(devnull, level)
+            else:
+                turn = structured_turn
+                setup = lambda: logs.configure_logging(format, level, use_queue, stream=devnull)
+            thread_seconds, process_seconds = best(turn, args, setup)
+            print(
+                f"{name:>28}: request {thread_seconds * 1000:7.3f} ms, "
+                f"total {process_seconds * 1000:7.3f} ms",
+                file=sys.__stdout__,
+            )
+
+
+if __name__ == "__main__":
+    run()
@@ -0,0 +1,91 @@
+import argparse
+import asyncio
+import contextlib
+import io
+import logging
+import time
+
+import httpx
+
+from api import audio
+from api.clients import get_clients
+from demos.fakes import FakeS3Client, fake_elevenlabs_transport
+
+"""
+Benchmark: audio for a long reply, one truncated request vs parallel chunks.
+
+"truncated" is the previous behavior: the first 5000 characters synthesized in
+one request, buffered and uploaded in one PUT. "chunked" synthesizes every
+chunk of the whole reply concurrently and uploads them with an S3 multipart
+upload as they complete.
+
+The fake ElevenLabs takes time proportional to the audio it returns.
+
+Run from the repo root:
+```
+python -m demos.bench_long_tts
+```
+"""
+
+PARAGRAPH = (
+    "Let's talk about your training week in detail. On Monday we do a full body "
+    "session with squats, push-ups and rows, three sets of twelve each, resting "
+    "ninety seconds between sets. On Tuesday, a forty minute walk at an easy pace. "
+    "Wednesday is upper body: overhead presses, pull-ups with a band, dips and "
+    "planks. Make sure you sleep at least eight hours and drink enough water. "
+)
+
+
+async def truncated(text, bucket):
+    # One request, as before chunking
+    clip = await audio._asynthesize(text[: audio.ELEVENLABS_CHARACTER_LIMIT])
+    await audio.aupload_audio_bytes_to_s3(clip, bucket, "truncated.mp3")
+    return min(len(text), audio.ELEVENLABS_CHARACTER_LIMIT)
+
+
+async def chunked(text, bucket):
+    await audio.aupload_audio_chunks_to_s3(
+        audio.aiter_elevenlabs_audio_chunks(text), bucket, "chunked.mp3"
+    )
+    return len(text)
+
+
+def run():
+    parser = argparse.ArgumentParser(description="Long reply TTS benchmark")
+    parser.add_argument("--paragraphs", type=int, default=30)
+    parser.add_argument("--tts-latency", type=float, default=0.3)
+    parser.add_argument("--chunk-interval", type=float, default=0.002)
+    parser.add_argument("--bytes-per-char", type=int, default=1000)
+    args = parser.parse_args()
+    logging.disable(logging.CRITICAL)
+
+    text = "\n\n".join([PARAGRAPH] * args.paragraphs)
+    chunks = audio.split_for_synthesis(text)
+    print(
+        f"{len(text)} character reply, {len(chunks)} chunks of <= {audio.TTS_CHUNK_CHARS}, "
+        f"concurrency {audio.TTS_CHUNK_CONCURRENCY}"
+    )
+    for label, bench in (("truncated", truncated), ("chunked", chunked)):
+        s3 = FakeS3Client()
+        get_clients().override(
+            s3=s3,
+            elevenlabs_async=httpx.AsyncClient(
+                transport=fake_elevenlabs_transport(
+                    latency=args.tts_latency,
+                    bytes_per_char=args.bytes_per_char,
+                    chunk_interval=args.chunk_interval,
+                )
+            ),
+        )
+        with contextlib.redirect_stdout(io.StringIO()):
+            start = time.perf_counter()
+            characters = asyncio.run(bench(text, audio.AUDIO_BUCKET))
+            elapsed = time.perf_counter() - start
+        size = sum(len(data) for data in s3.objects.values())
+        print(
+            f"{label:>9}: {elapsed:5.2f} s for {characters} characters, {size} bytes uploaded"
+        )
+
+
+if __name__ == "__main__":
+    run()
@@ -0,0 +1,127 @@
+import argparse
+import math
+import random
+import time
+from decimal import Decimal
+
+from api import message_codec
+
+"""
+Benchmark: bytes stored and DynamoDB capacity units for a synthetic corpus of
+chats, with plain and compressed message bodies.
+
+Item sizes follow DynamoDB's rules (attribute names plus values). Writes cost
+1 WCU per started KB of each item; reading a whole chat with a strongly
+consistent Query costs 1 RCU per started 4 KB of each (at most 1 MB) page.
+
+Run from the repo root:
+```
+python -m demos.bench_message_codec --chats 200
+```
+"""
+
+WORDS = (
+    "the a you your I we it is are was be to of and in that have for not on with as do at "
+    "this but by from they or an will my one all would there their what so up out if about "
+    "who get which go me when make can like time no just him know take people into year good "
+    "some could them see other than then now look only come its over think also back after "
+    "use two how our work first well way even new want because any these give day most us "
+    "workout training squats push-ups rows stretch sleep water protein breakfast walk run "
+    "proud awesome consistency goal plan tomorrow week rest recovery muscle cardio session "
+    "sets reps minutes hours healthy habit progress strong motivated remember promise"
+).split()
+
+
+def sentence(rng):
+    words = [rng.choice(WORDS) for _ in range(rng.randint(6, 18))]
+    return " ".join(words).capitalize() + rng.choice([".", ".", "!", "?"])
+
+
+def corpus(chats, turns, seed=11):
+    rng = random.Random(seed)
+    for chat in range(chats):
+        for turn in range(turns):
+            timestamp = 1_700_000_000 + turn * 10
+            yield {
+                "ChatID": f"chat-{chat:05d}",
+                "timestamp": Decimal(timestamp),
+                "message": " ".join(sentence(rng) for _ in range(rng.randint(1, 3))),
+                "type": "user",
+            }
+            # Replies range from a line to a long training plan
+            sentences = int(rng.lognormvariate(2.2, 1.0)) + 1
+            yield {
+                "ChatID": f"chat-{chat:05d}",
+                "timestamp": Decimal(timestamp + 5),
+                "message": " ".join(sentence(rng) for _ in range(sentences)),
+                "type": "ai",
+            }
+
+
+def attribute_size(value) -> int:
+    if isinstance(value, str):
+        return len(value.encode("utf-8"))
+    if isinstance(value, (bytes, bytearray)):
+        return len(value)
+    if isinstance(value, (int, Decimal)):
+        return len(str(value).lstrip("-")) // 2 + 1
+    raise TypeError(type(value))
+
+
+def item_size(item) -> int:
+    return sum(len(name) + attribute_size(value) for name, value in item.items())
+
+
+def query_rcu(sizes):
+    """RCUs of a strongly consistent Query reading items of these sizes."""
+    rcu = 0
+    page = 0
+    for size in sizes:
+        if page + size > 1024**2:
+            rcu += math.ceil(page / 4096)
+            page = 0
+        page += size
+    return rcu + math.ceil(page / 4096)
+
+
+def run():
+    parser = argparse.ArgumentParser(description="Message codec benchmark")
+    parser.add_argument("--chats", type=int, default=200)
+    parser.add_argument("--turns", type=int, default=50)
+    parser.add_argument("--min-bytes", type=int, default=message_codec.MESSAGE_COMPRESS_MIN_BYTES)
+    args = parser.parse_args()
+
+    items = list(corpus(args.chats, args.turns))
+    codecs = ["none", "zlib"] + (["zstd"] if message_codec.zstandard else [])
+    print(
+        f"{len(items)} messages in {args.chats} chats, compressing bodies >= {args.min_bytes} bytes"
+    )
+    for codec in codecs:
+        start = time.perf_counter()
+        encoded = [
+            {**item, "message": message_codec.encode_message(item["message"], codec, args.min_bytes)}
+            for item in items
+        ]
+        encode_time = time.perf_counter() - start
+        start = time.perf_counter()
+        for item in encoded:
+            message_codec.decode_message(item["message"])
+        decode_time = time.perf_counter() - start
+
+        sizes = [item_size(item) for item in encoded]
+        wcu = sum(math.ceil(size / 1024) for size in sizes)
+        chats = {}
+        for item, size in zip(encoded, sizes):
+            chats.setdefault(item["ChatID"], []).append(size)
+        rcu = sum(query_rcu(chat_sizes) for chat_sizes in chats.values())
+        compressed = sum(isinstance(item["message"], bytes) for item in encoded)
+        print(
+            f"{codec:>5}: {sum(sizes) / 1024**2:7.2f} MB stored, {wcu:7d} WCU to write, "
+            f"{rcu:6d} RCU to read every chat, {compressed} compressed, "
+            f"encode {encode_time * 1e6 / len(items):5.1f} us/msg, "
+            f"decode {decode_time * 1e6 / len(items):5.1f} us/msg"
+        )
+
+
+if __name__ == "__main__":
+    run()
@@ -0,0 +1,86 @@
+import argparse
+import asyncio
+import contextlib
+import io
+import time
+
+import boto3
+
+from api.aio import run_blocking
+from api.audio import AUDIO_BUCKET, aget_s3_link
+from api.clients import AWS_REGION, get_clients
+from api.presign import presigned_urls, sign
+
+"""
+Micro-benchmark: presigning the audio links of `--keys` messages (e.g. a
+history replayed with audio) one `run_blocking` call per link, as before,
+vs batched with api/presign.py, cold and cached.
+
+Signing is local (no request is sent), so a real boto3 S3 client with dummy
+credentials is used. Run from the repo root:
+```
+python -m demos.bench_presign --keys 1000
+```
+"""
+
+
+async def per_link(keys):
+    # One thread hop and one signature per message, no cache
+    s3 = get_clients().s3
+    return [await run_blocking(sign, s3, AUDIO_BUCKET, key) for key in keys]
+
+
+async def timed(results, name, call):
+    start = time.perf_counter()
+    await call()
+    results[name] = time.perf_counter() - start
+
+
+async def bench(keys):
+    # Warm up the client's endpoint resolution and the I/O pool
+    await per_link(keys[:10])
+
+    results = {}
+    await timed(results, "per link, uncached", lambda: per_link(keys))
+    presigned_urls.clear()
+    await timed(
+        results, "batch, cold", lambda: presigned_urls.aget_links(keys, AUDIO_BUCKET)
+    )
+    await timed(
+        results, "batch, cached", lambda: presigned_urls.aget_links(keys, AUDIO_BUCKET)
+    )
+
+    async def cached_per_link():
+        for key in keys:
+            await aget_s3_link(key, AUDIO_BUCKET)
+
+    await timed(results, "per link, cached", cached_per_link)
+    return results
+
+
+def run():
+    parser = argparse.ArgumentParser(description="Presigned link benchmark")
+    parser.add_argument("--keys", type=int, default=1000)
+    args = parser.parse_args()
+
+    get_clients().override(
+        s3=boto3.client(
+            "s3",
+            region_name=AWS_REGION,
+            aws_access_key_id="AKIABENCHMARK",
+            aws_secret_access_key="benchmark",
+        )
+    )
+    keys = [f"tts-cache/{i:064x}.mp3" for i in range(args.keys)]
+    with contextlib.redirect_stdout(io.StringIO()):
+        results = asyncio.run(bench(keys))
+    for name, seconds in results.items():
+        print(
+            f"{name:>20}: {seconds * 1000:8.1f} ms, "
+            f"{args.keys / seconds:10.0f} links/s, {seconds / args.keys * 1e6:7.1f} us/link"
+        )
+    print(f"cache: {presigned_urls.metrics()}")
+
+
+if __name__ == "__main__":
+    run()
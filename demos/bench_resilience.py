@@ -0,0 +1,135 @@
+import argparse
+import asyncio
+import contextlib
+import io
+import logging
+import time
+
+import httpx
+
+from api import audio
+from api.clients import get_clients
+from api.resilience import CircuitBreaker, UpstreamPolicy, start_deadline
+from demos.fakes import fake_elevenlabs_transport
+
+"""
+Benchmark: tail latency and failures of ElevenLabs syntheses under the
+policies of api/resilience.py, against a fake ElevenLabs with a heavy tail
+(`--slow-rate` of the requests take `--slow-latency`) and transient errors
+(`--error-rate` of them answer 503).
+
+- none: one attempt per synthesis
+- retry: retries with jittered backoff
+- retry+hedge: plus a second request once one is slower than the recent p95
+
+Then an outage (every request fails): with the circuit breaker open, the
+syntheses fail fast instead of each paying for its retries.
+
+Run from the repo root:
+```
+python -m demos.bench_resilience --calls 1000
+```
+"""
+
+TEXT = "Great session today! Remember to stretch and drink plenty of water."
+
+
+def percentile(sorted_values, p):
+    return sorted_values[min(len(sorted_values) - 1, int(len(sorted_values) * p / 100))]
+
+
+def use_transport(args, error_rate):
+    get_clients().override(
+        elevenlabs_async=httpx.AsyncClient(
+            transport=fake_elevenlabs_transport(
+                latency=args.latency,
+                error_rate=error_rate,
+                slow_rate=args.slow_rate,
+                slow_latency=args.slow_latency,
+                seed=1,
+            )
+        )
+    )
+
+
+async def run_calls(args, policy):
+    audio.elevenlabs_policy = policy
+    semaphore = asyncio.Semaphore(args.concurrency)
+    latencies = []
+    failures = 0
+
+    async def synthesize():
+        nonlocal failures
+        async with semaphore:
+            start_deadline(args.deadline)
+            start = time.perf_counter()
+            try:
+                clip = await audio.aget_elevenlabs_audio(TEXT)
+            except Exception:
+                clip = None
+            latencies.append(time.perf_counter() - start)
+            failures += not clip
+
+    start = time.perf_counter()
+    await asyncio.gather(*(synthesize() for _ in range(args.calls)))
+    return time.perf_counter() - start, sorted(latencies), failures
+
+
+def report(name, elapsed, latencies, failures, policy):
+    stats = policy.metrics()
+    print(
+        f"{name:>12}: {elapsed:6.2f} s  "
+        f"p50 {percentile(latencies, 50) * 1000:6.0f}  "
+        f"p95 {percentile(latencies, 95) * 1000:6.0f}  "
+        f"p99 {percentile(latencies, 99) * 1000:6.0f} ms  "
+        f"failed {failures:4d}  retries {stats['retries']:4d}  "
+        f"hedges {stats['hedges']:3d} (won {stats['hedges_won']})  "
+        f"breaker opened {stats['breaker']['opened']}x, "
+        f"short-circuited {stats['breaker']['short_circuited']}"
+    )
+
+
+def run():
+    parser = argparse.ArgumentParser(description="ElevenLabs resilience benchmark")
+    parser.add_argument("--calls", type=int, default=500)
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--latency", type=float, default=0.05)
+    parser.add_argument("--slow-rate", type=float, default=0.03)
+    parser.add_argument("--slow-latency", type=float, default=1.5)
+    parser.add_argument("--error-rate", type=float, default=0.05)
+    parser.add_argument("--deadline", type=float, default=10.0, help="Seconds per synthesis")
+    args = parser.parse_args()
+    logging.disable(logging.CRITICAL)
+
+    print(
+        f"{args.calls} syntheses, {args.concurrency} at a time, "
+        f"{args.slow_rate:.0%} take {args.slow_latency}s, {args.error_rate:.0%} fail"
+    )
+    use_transport(args, args.error_rate)
+    # A breaker that never opens, so the transient errors don't trip it
+    policies = {
+        "none": UpstreamPolicy("elevenlabs", attempts=1, breaker=CircuitBreaker("none", 10**9)),
+        "retry": UpstreamPolicy("elevenlabs", breaker=CircuitBreaker("retry", 10**9)),
+        "retry+hedge": UpstreamPolicy(
+            "elevenlabs", hedging=True, breaker=CircuitBreaker("hedge", 10**9)
+        ),
+    }
+    for name, policy in policies.items():
+        with contextlib.redirect_stdout(io.StringIO()):
+            result = asyncio.run(run_calls(args, policy))
+        report(name, *result, policy)
+
+    print("outage, every request fails:")
+    use_transport(args, 1.0)
+    policies = {
+        "no breaker": UpstreamPolicy("elevenlabs", breaker=CircuitBreaker("off", 10**9)),
+        "breaker": UpstreamPolicy("elevenlabs"),
+    }
+    for name, policy in policies.items():
+        with contextlib.redirect_stdout(io.StringIO()):
+            result = asyncio.run(run_calls(args, policy))
+        report(name, *result, policy)
+
+
+if __name__ == "__main__":
+    run()
@@ -0,0 +1,90 @@
+import argparse
+import asyncio
+import contextlib
+import io
+import logging
+import time
+
+import httpx
+
+from api import audio
+from api.clients import get_clients
+from api.tts_pipeline import SentenceAudioPipeline, stream_text_and_audio
+from demos.fakes import fake_elevenlabs_transport, fake_token_stream
+
+"""
+Benchmark: time-to-first-audio for a reply, whole-reply TTS vs sentence pipeline.
+
+"sequential" waits for the full LLM reply, then synthesizes it in one request.
+"pipelined" sends each sentence to the streaming TTS endpoint as soon as it is
+complete, overlapping with generation.
+
+Run from the repo root:
+```
+python -m demos.bench_streaming_tts
+```
+"""
+
+REPLY = (
+    "That's flipping awesome, good to hear you got a workout in today! "
+    "Consistency is what builds results, so I'm really proud of you. "
+    "For tomorrow, let's do a lighter upper body session: push-ups, rows and "
+    "some shoulder presses, three sets of twelve each. "
+    "Make sure you stretch for ten minutes afterwards. "
+    "And don't forget, we're aiming for eight hours of sleep tonight. "
+    "Turn off those screens an hour before bed. Promise?"
+)
+
+
+async def sequential(args):
+    start = time.perf_counter()
+    text = "".join([token async for token in fake_token_stream(REPLY, args.tokens_per_second)])
+    clip = await audio.aget_elevenlabs_audio(text)
+    first_audio = time.perf_counter() - start
+    return first_audio, time.perf_counter() - start, len(clip)
+
+
+async def pipelined(args):
+    pipeline = SentenceAudioPipeline(
+        concurrency=args.concurrency, optimize_streaming_latency=args.latency_level
+    )
+    start = time.perf_counter()
+    first_audio = None
+    tokens = fake_token_stream(REPLY, args.tokens_per_second)
+    async for kind, _ in stream_text_and_audio(tokens, pipeline):
+        if kind == "audio" and first_audio is None:
+            first_audio = time.perf_counter() - start
+    return first_audio, time.perf_counter() - start, len(pipeline.audio)
+
+
+def run():
+    parser = argparse.ArgumentParser(description="Time-to-first-audio benchmark")
+    parser.add_argument("--tokens-per-second", type=float, default=30.0)
+    parser.add_argument("--tts-latency", type=float, default=0.3)
+    parser.add_argument("--chunk-interval", type=float, default=0.05)
+    parser.add_argument("--concurrency", type=int, default=3)
+    parser.add_argument("--latency-level", type=int, default=3)
+    args = parser.parse_args()
+
+    get_clients().override(
+        elevenlabs_async=httpx.AsyncClient(
+            transport=fake_elevenlabs_transport(
+                latency=args.tts_latency,
+                bytes_per_char=60,
+                chunk_interval=args.chunk_interval,
+            )
+        )
+    )
+    logging.disable(logging.CRITICAL)
+
+    print(f"{len(REPLY)} character reply at {args.tokens_per_second} tokens/s")
+    for label, bench in (("sequential", sequential), ("pipelined", pipelined)):
+        with contextlib.redirect_stdout(io.StringIO()):
+            first_audio, total, size = asyncio.run(bench(args))
+        print(
+            f"{label:>10}: first audio {first_audio:5.2f} s, all audio {total:5.2f} s, {size} bytes"
+        )
+
+
+if __name__ == "__main__":
+    run()
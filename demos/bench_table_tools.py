@@ -0,0 +1,108 @@
+import argparse
+import logging
+import os
+import random
+import tempfile
+import time
+from decimal import Decimal
+
+import table_tools
+import update_table
+from api.clients import get_clients
+from demos.fakes import FakeDynamoDB, FakeS3Client, FakeTable
+
+"""
+Benchmark: table_tools.py against a fake `ChatMessages` table with `--latency`
+seconds per call.
+
+- export with 1 segment (a plain Scan) and with `--segments` in parallel
+- import of the export into an empty table, paced by `--write-units`
+- archive of the chats older than 30 days (`--stale` of them) to a fake S3
+
+Run from the repo root:
+```
+python -m demos.bench_table_tools --chats 2000 --messages 20
+```
+"""
+
+
+def install_fakes(args):
+    table = FakeTable(latency=args.latency, page_size=args.page_size)
+    get_clients().override(
+        **{
+            "dynamodb": FakeDynamoDB({update_table.TABLE_NAME: table}, latency=args.latency),
+            f"table:{update_table.TABLE_NAME}": table,
+            "s3": FakeS3Client(latency=args.latency),
+        }
+    )
+    return table
+
+
+def seed(table, args):
+    now = int(time.time())
+    rng = random.Random(1)
+    for chat in range(args.chats):
+        # Stale chats were last active 60 to 365 days ago
+        newest = now - rng.randint(60, 365) * 86400 if rng.random() < args.stale else now
+        for i in range(args.messages):
+            table._put(
+                {
+                    "ChatID": f"chat-{chat}",
+                    "timestamp": Decimal(newest - (args.messages - i) * 60),
+                    "message": f"Message {i} of the chat, about today's workout and plans. " * 3,
+                    "type": "user" if i % 2 == 0 else "ai",
+                }
+            )
+
+
+def count(table):
+    return sum(len(partition) for partition in table.items.values())
+
+
+def run():
+    parser = argparse.ArgumentParser(description="Bulk export / import / archive benchmark")
+    parser.add_argument("--chats", type=int, default=2000)
+    parser.add_argument("--messages", type=int, default=20)
+    parser.add_argument("--segments", type=int, default=8)
+    parser.add_argument("--page-size", type=int, default=1000)
+    parser.add_argument("--latency", type=float, default=0.02)
+    parser.add_argument("--write-units", type=float, default=0)
+    parser.add_argument("--stale", type=float, default=0.3)
+    args = parser.parse_args()
+    logging.disable(logging.CRITICAL)
+
+    table = install_fakes(args)
+    seed(table, args)
+    items = count(table)
+    print(f"{args.chats} chats, {items} items, {args.latency * 1000:.0f} ms per call")
+
+    with tempfile.TemporaryDirectory() as directory:
+        for segments in (1, args.segments):
+            path = os.path.join(directory, f"export-{segments}")
+            manifest = table_tools.export_table(path, segments)
+            size = sum(os.path.getsize(os.path.join(path, f["name"])) for f in manifest["files"])
+            print(
+                f"export, {segments:2d} segments: {manifest['seconds']:6.2f} s, "
+                f"{manifest['items'] / manifest['seconds']:9.0f} items/s, "
+                f"{size / 1e6:.2f} MB {manifest['compression']} "
+                f"({manifest['read_units']} read units)"
+            )
+
+        table.items.clear()
+        stats = table_tools.import_table(path, workers=args.segments, write_units=args.write_units)
+        print(
+            f"import, {args.segments:2d} workers:  {stats['seconds']:6.2f} s, "
+            f"{stats['items'] / stats['seconds']:9.0f} items/s, {stats['failed']} failed, "
+            f"{count(table)}/{items} items back ({stats['write_units']} write units)"
+        )
+
+    stats = table_tools.archive_chats(30, segments=args.segments, workers=args.segments)
+    print(
+        f"archive > 30 days:    {stats['seconds']:6.2f} s, {stats['chats']} chats, "
+        f"{stats['items']} items to S3 ({stats['bytes'] / 1e6:.2f} MB), "
+        f"{count(table)} items left"
+    )
+
+
+if __name__ == "__main__":
+    run()
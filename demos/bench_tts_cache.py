@@ -0,0 +1,107 @@
+import argparse
+import asyncio
+import contextlib
+import io
+import logging
+import random
+import tempfile
+import time
+
+import httpx
+
+from api import audio
+from api.clients import get_clients
+from api.tts_cache import TTSAudioCache
+from demos.fakes import FakeS3Client, fake_elevenlabs_transport
+
+"""
+Benchmark: audio for a stream of persona replies, random S3 names vs the
+content-addressed TTS cache.
+
+Replies are drawn with a skewed distribution from a few short greetings and
+acknowledgements (which personas repeat constantly) and unique longer answers.
+
+Run from the repo root:
+```
+python -m demos.bench_tts_cache --replies 500
+```
+"""
+
+REPEATED = [
+    "Hey! How's it going?",
+    "That's flipping awesome!",
+    "Good morning, sunshine!",
+    "Let's get to work.",
+    "I'm proud of you.",
+    "Tell me more.",
+    "Hmm, interesting.",
+    "Don't forget to drink water today!",
+]
+
+
+def replies(count, unique_share, seed=7):
+    rng = random.Random(seed)
+    weights = [1 / (rank + 1) for rank in range(len(REPEATED))]
+    for i in range(count):
+        if rng.random() < unique_share:
+            yield f"Here's your plan number {i}: three sets of squats, then a long walk and stretching."
+        else:
+            yield rng.choices(REPEATED, weights)[0]
+
+
+async def uncached(texts, s3):
+    for text in texts:
+        clip = await audio.aget_elevenlabs_audio(text)
+        await audio.aupload_audio_bytes_to_s3(
+            clip, audio.AUDIO_BUCKET, audio.generate_mp3_file_name()
+        )
+    return {"s3_objects": len(s3.objects)}
+
+
+async def cached(texts, s3, disk_dir):
+    cache = TTSAudioCache(disk_dir=disk_dir)
+    for text in texts:
+        await cache.get_object_name(text)
+    return {"s3_objects": len(s3.objects), **cache.metrics()}
+
+
+def run():
+    parser = argparse.ArgumentParser(description="TTS cache benchmark")
+    parser.add_argument("--replies", type=int, default=500)
+    parser.add_argument("--unique-share", type=float, default=0.3)
+    parser.add_argument("--tts-latency", type=float, default=0.02)
+    parser.add_argument("--s3-latency", type=float, default=0.005)
+    args = parser.parse_args()
+    logging.disable(logging.CRITICAL)
+
+    texts = list(replies(args.replies, args.unique_share))
+    characters = sum(len(text) for text in texts)
+    print(f"{len(texts)} replies, {len(set(texts))} distinct, {characters} characters")
+
+    for label in ("uncached", "cached"):
+        s3 = FakeS3Client(latency=args.s3_latency)
+        get_clients().override(
+            s3=s3,
+            elevenlabs_async=httpx.AsyncClient(
+                transport=fake_elevenlabs_transport(latency=args.tts_latency, bytes_per_char=60)
+            ),
+        )
+        with tempfile.TemporaryDirectory() as disk_dir:
+            with contextlib.redirect_stdout(io.StringIO()):
+                start = time.perf_counter()
+                if label == "uncached":
+                    result = asyncio.run(uncached(texts, s3))
+                else:
+                    result = asyncio.run(cached(texts, s3, disk_dir))
+                elapsed = time.perf_counter() - start
+        print(f"{label:>8}: {elapsed:6.2f} s, {result['s3_objects']} S3 objects")
+        if label == "cached":
+            print(
+                f"          hit rate {result['hit_rate']:.1%}, "
+                f"{result['characters_saved']} characters saved, "
+                f"{result['characters_synthesized']} synthesized"
+            )
+
+
+if __name__ == "__main__":
+    run()
@@ -0,0 +1,588 @@
+import asyncio
+import io
+import json
+import random
+import re
+import threading
+import time
+import zlib
+from decimal import Decimal
+
+import httpx
+from botocore.exceptions import ClientError
+
+"""
+In-process stand-ins for the upstreams used by the backend (DynamoDB, S3,
+OpenAI and ElevenLabs), for load tests and benchmarks that must run without
+network access or AWS credentials.
+
+Each fake takes a `latency` in seconds so a demo can model a slow upstream.
+Blocking fakes use `time.sleep` (like boto3 / requests), async fakes use
+`asyncio.sleep` (like httpx / the OpenAI async client).
+"""
+
+
+def _key_conditions(condition):
+    """
+    Flatten a boto3 `KeyConditionExpression` into {attribute: (operator, values)}.
+    """
+    expression = condition.get_expression()
+    if expression["operator"] == "AND":
+        conditions = {}
+        for part in expression["values"]:
+            conditions.update(_key_conditions(part))
+        return conditions
+    key, *values = expression["values"]
+    return {key.name: (expression["operator"], values)}
+
+
+def _matches(value, operator, values):
+    if operator == "=":
+        return value == values[0]
+    if operator == "<":
+        return value < values[0]
+    if operator == "<=":
+        return value <= values[0]
+    if operator == ">":
+        return value > values[0]
+    if operator == ">=":
+        return value >= values[0]
+    if operator == "BETWEEN":
+        return values[0] <= value <= values[1]
+    raise NotImplementedError(f"Unsupported key condition: {operator}")
+
+
+class FakeTable:
+    """
+    Stand-in for the boto3 `ChatMessages` Table (ChatID HASH, timestamp RANGE).
+    """
+
+    def __init__(self, latency=0.0, page_size=1000):
+        self.latency = latency
+        self.page_size = page_size
+        self.items = {}
+        self.calls = {"put_item": 0, "query": 0, "update_item": 0, "scan": 0}
+
+    def put_item(self, Item, **kwargs):
+        time.sleep(self.latency)
+        self.calls["put_item"] += 1
+        self._put(Item)
+        return {"ResponseMetadata": {"HTTPStatusCode": 200}}
+
+    def _put(self, Item):
+        item = dict(Item)
+        # DynamoDB hands numbers back as Decimal
+        item["timestamp"] = Decimal(item["timestamp"])
+        self.items.setdefault(item["ChatID"], {})[item["timestamp"]] = item
+
+    def _delete(self, Key):
+        partition = self.items.get(Key["ChatID"], {})
+        partition.pop(Decimal(Key["timestamp"]), None)
+        if not partition:
+            self.items.pop(Key["ChatID"], None)
+
+    def get_item(self, Key, **kwargs):
+        time.sleep(self.latency)
+        item = self.items.get(Key["ChatID"], {}).get(Decimal(Key["timestamp"]))
+        return {"Item": dict(item)} if item else {}
+
+    def update_item(self, Key, UpdateExpression, ExpressionAttributeValues, **kwargs):
+        # Only the `SET attr = :value` form used by update_table is supported
+        time.sleep(self.latency)
+        self.calls["update_item"] += 1
+        attribute, placeholder = UpdateExpression[len("SET ") :].split(" = ")
+        partition = self.items.setdefault(Key["ChatID"], {})
+        item = partition.setdefault(
+            Decimal(Key["timestamp"]),
+            {"ChatID": Key["ChatID"], "timestamp": Decimal(Key["timestamp"])},
+        )
+        item[attribute] = ExpressionAttributeValues[placeholder]
+        return {}
+
+    def query(
+        self,
+        KeyConditionExpression,
+        ScanIndexForward=True,
+        Limit=None,
+        ExclusiveStartKey=None,
+        **kwargs,
+    ):
+        time.sleep(self.latency)
+        self.calls["query"] += 1
+        conditions = _key_conditions(KeyConditionExpression)
+        _, (chat_id,) = conditions.pop("ChatID")
+        partition = self.items.get(chat_id, {})
+
+        timestamps = [
+            ts
+            for ts in sorted(partition, reverse=not ScanIndexForward)
+            if all(_matches(ts, op, vals) for op, vals in conditions.values())
+        ]
+        if ExclusiveStartKey is not None:
+            start = Decimal(ExclusiveStartKey["timestamp"])
+            if not all(_matches(start, op, vals) for op, vals in conditions.values()):
+                # Like DynamoDB, which only resumes from a key of the result
+                raise ClientError(
+                    {
+                        "Error": {
+                            "Code": "ValidationException",
+                            "Message": "The provided starting key does not match the "
+                            "range key predicate",
+                        }
+                    },
+                    "Query",
+                )
+            timestamps = [
+                ts for ts in timestamps if (ts > start if ScanIndexForward else ts < start)
+            ]
+
+        # A page ends at Limit or at the (item count) stand-in for the 1 MB cap
+        page_size = min(Limit or self.page_size, self.page_size)
+        page = timestamps[:page_size]
+        response = {"Items": [dict(partition[ts]) for ts in page], "Count": len(page)}
+        if len(timestamps) > page_size or (Limit is not None and len(page) == Limit):
+            response["LastEvaluatedKey"] = {"ChatID": chat_id, "timestamp": page[-1]}
+        return response
+
+    def scan(
+        self,
+        Limit=None,
+        ExclusiveStartKey=None,
+        Segment=None,
+        TotalSegments=None,
+        **kwargs,
+    ):
+        time.sleep(self.latency)
+        self.calls["scan"] += 1
+        # A parallel Scan segment gets the partitions hashed to it
+        keys = [
+            (chat_id, timestamp)
+            for chat_id in sorted(self.items)
+            if Segment is None or zlib.crc32(chat_id.encode()) % TotalSegments == Segment
+            for timestamp in sorted(self.items[chat_id])
+        ]
+        if ExclusiveStartKey is not None:
+            start = (ExclusiveStartKey["ChatID"], Decimal(ExclusiveStartKey["timestamp"]))
+            keys = [key for key in keys if key > start]
+        page_size = min(Limit or self.page_size, self.page_size)
+        page = keys[:page_size]
+        response = {
+            "Items": [dict(self.items[chat_id][ts]) for chat_id, ts in page],
+            "Count": len(page),
+        }
+        if len(keys) > page_size:
+            chat_id, timestamp = page[-1]
+            response["LastEvaluatedKey"] = {"ChatID": chat_id, "timestamp": timestamp}
+        return response
+
+
+class FakeKeyValueTable:
+    """
+    Stand-in for a boto3 Table with a single HASH key, e.g. the idempotency
+    table. `put_item` supports the `attribute_not_exists(<key>) OR <attr> < :v`
+    condition used to claim a key.
+    """
+
+    def __init__(self, key="IdempotencyKey", latency=0.0):
+        self.key = key
+        self.latency = latency
+        self.items = {}
+        self.calls = {"put_item": 0, "get_item": 0, "delete_item": 0}
+        self._lock = threading.Lock()
+
+    def put_item(self, Item, ConditionExpression=None, ExpressionAttributeValues=None, **kwargs):
+        time.sleep(self.latency)
+        with self._lock:
+            self.calls["put_item"] += 1
+            current = self.items.get(Item[self.key])
+            if ConditionExpression is not None and current is not None:
+                match = re.fullmatch(
+                    rf"attribute_not_exists\({self.key}\) OR (\w+) < (:\w+)",
+                    ConditionExpression,
+                )
+                if match is None:
+                    raise NotImplementedError(f"Unsupported condition: {ConditionExpression}")
+                attribute, placeholder = match.groups()
+                if not current[attribute] < ExpressionAttributeValues[placeholder]:
+                    raise ClientError(
+                        {
+                            "Error": {
+                                "Code": "ConditionalCheckFailedException",
+                                "Message": "The conditional request failed",
+                            }
+                        },
+                        "PutItem",
+                    )
+            self.items[Item[self.key]] = dict(Item)
+        return {"ResponseMetadata": {"HTTPStatusCode": 200}}
+
+    def get_item(self, Key, **kwargs):
+        time.sleep(self.latency)
+        with self._lock:
+            self.calls["get_item"] += 1
+            item = self.items.get(Key[self.key])
+        return {"Item": dict(item)} if item else {}
+
+    def delete_item(self, Key, **kwargs):
+        time.sleep(self.latency)
+        with self._lock:
+            self.calls["delete_item"] += 1
+            self.items.pop(Key[self.key], None)
+        return {}
+
+
+class FakeDynamoDB:
+    """
+    Stand-in for the boto3 DynamoDB resource, for batch writes (puts and
+    deletes) to `FakeTable`s.
+
+    A share `unprocessed_rate` of the items of each call is returned as
+    UnprocessedItems, like a throttled table.
+    """
+
+    def __init__(self, tables, latency=0.0, unprocessed_rate=0.0):
+        self.tables = tables
+        self.latency = latency
+        self.unprocessed_rate = unprocessed_rate
+        self.calls = {"batch_write_item": 0}
+
+    def Table(self, name):
+        return self.tables[name]
+
+    def batch_write_item(self, RequestItems, **kwargs):
+        time.sleep(self.latency)
+        self.calls["batch_write_item"] += 1
+        requests = [request for table in RequestItems.values() for request in table]
+        if len(requests) > 25:
+            raise ValueError("Too many items requested for the BatchWriteItem call")
+        unprocessed = {}
+        for name, table_requests in RequestItems.items():
+            keys = [
+                (key["ChatID"], key["timestamp"])
+                for key in (
+                    r["PutRequest"]["Item"] if "PutRequest" in r else r["DeleteRequest"]["Key"]
+                    for r in table_requests
+                )
+            ]
+            if len(set(keys)) != len(keys):
+                raise ValueError("Provided list of item keys contains duplicates")
+            for request in table_requests:
+                if random.random() < self.unprocessed_rate:
+                    unprocessed.setdefault(name, []).append(request)
+                elif "PutRequest" in request:
+                    self.tables[name]._put(request["PutRequest"]["Item"])
+                else:
+                    self.tables[name]._delete(request["DeleteRequest"]["Key"])
+        return {"UnprocessedItems": unprocessed}
+
+
+class FakeS3Client:
+    """
+    Stand-in for the boto3 S3 client, keeping uploaded objects in memory.
+    """
+
+    def __init__(self, latency=0.0):
+        self.latency = latency
+        self.objects = {}
+        # UploadId -> {PartNumber: bytes} of unfinished multipart uploads
+        self.uploads = {}
+
+    def upload_fileobj(self, fileobj, bucket, key, ExtraArgs=None):
+        time.sleep(self.latency)
+        self.objects[(bucket, key)] = fileobj.read()
+
+    def put_object(self, Bucket, Key, Body, **kwargs):
+        time.sleep(self.latency)
+        self.objects[(Bucket, Key)] = bytes(Body)
+        return {}
+
+    def create_multipart_upload(self, Bucket, Key, **kwargs):
+        time.sleep(self.latency)
+        upload_id = f"upload-{len(self.uploads)}"
+        self.uploads[upload_id] = {}
+        return {"UploadId": upload_id}
+
+    def upload_part(self, Bucket, Key, UploadId, PartNumber, Body, **kwargs):
+        time.sleep(self.latency)
+        self.uploads[UploadId][PartNumber] = bytes(Body)
+        return {"ETag": f'"{UploadId}-{PartNumber}"'}
+
+    def complete_multipart_upload(self, Bucket, Key, UploadId, MultipartUpload, **kwargs):
+        time.sleep(self.latency)
+        parts = self.uploads.pop(UploadId)
+        self.objects[(Bucket, Key)] = b"".join(
+            parts[part["PartNumber"]] for part in MultipartUpload["Parts"]
+        )
+        return {}
+
+    def abort_multipart_upload(self, Bucket, Key, UploadId, **kwargs):
+        self.uploads.pop(UploadId, None)
+        return {}
+
+    def head_object(self, Bucket, Key, **kwargs):
+        time.sleep(self.latency)
+        if (Bucket, Key) not in self.objects:
+            raise ClientError({"Error": {"Code": "404", "Message": "Not Found"}}, "HeadObject")
+        return {"ContentLength": len(self.objects[(Bucket, Key)])}
+
+    def get_object(self, Bucket, Key, **kwargs):
+        time.sleep(self.latency)
+        if (Bucket, Key) not in self.objects:
+            raise ClientError({"Error": {"Code": "NoSuchKey", "Message": "Not Found"}}, "GetObject")
+        return {"Body": io.BytesIO(self.objects[(Bucket, Key)])}
+
+    def generate_presigned_url(self, ClientMethod, Params, ExpiresIn=3600):
+        return f"https://{Params['Bucket']}.s3.fake/{Params['Key']}?expires={ExpiresIn}"
+
+
+def fake_elevenlabs_transport(
+    latency=0.0,
+    audio_bytes=32_000,
+    bytes_per_char=None,
+    chunk_bytes=4096,
+    chunk_interval=0.0,
+    error_rate=0.0,
+    error_status=503,
+    slow_rate=0.0,
+    slow_latency=0.0,
+    seed=None,
+):
+    """
+    An httpx transport that answers text-to-speech POSTs with fake MP3 bytes.
+
+    Audio is `audio_bytes` long, or `bytes_per_char` per character of text. The
+    first byte takes `latency`, then each `chunk_bytes` chunk takes
+    `chunk_interval`: the `/stream` endpoint sends chunks as they are
+    "synthesized", the regular endpoint only once all of them are done.
+
+    A share `error_rate` of the requests fails with `error_status` after
+    `latency`, and a share `slow_rate` takes `slow_latency` instead (a heavy
+    tail, e.g. a stuck connection).
+    """
+    rng = random.Random(seed)
+
+    async def handler(request: httpx.Request):
+        if rng.random() < error_rate:
+            await asyncio.sleep(latency)
+            return httpx.Response(error_status, content=b'{"detail": "busy"}')
+        if bytes_per_char is None:
+            size = audio_bytes
+        else:
+            size = bytes_per_char * len(json.loads(request.content)["text"])
+        audio = b"\xff\xfb" * (size // 2)
+        chunks = [audio[i : i + chunk_bytes] for i in range(0, len(audio), chunk_bytes)]
+
+        await asyncio.sleep(slow_latency if rng.random() < slow_rate else latency)
+        if request.url.path.endswith("/stream"):
+
+            async def body():
+                for chunk in chunks:
+                    yield chunk
+                    await asyncio.sleep(chunk_interval)
+
+            return httpx.Response(200, content=body())
+
+        await asyncio.sleep(chunk_interval * len(chunks))
+        return httpx.Response(200, content=audio)
+
+    return httpx.MockTransport(handler)
+
+
+def fake_openai_transport(
+    latency=0.0,
+    tokens_per_second=50.0,
+    reply_tokens=40,
+    reply="Hey! That's awesome, tell me more about it.",
+    unique=False,
+):
+    """
+    An httpx transport that answers OpenAI chat completion requests.
+
+    The reply is `reply` repeated to `reply_tokens` words (one token each), and
+    ends with a request counter if `unique` (so replies aren't TTS cache hits).
+    The first token takes `latency`, then tokens come at `tokens_per_second`:
+    as server-sent events when the request streams, all at once otherwise.
+    """
+    words = re.findall(r"\S+\s*", reply + " ")
+    reply_words = [words[i % len(words)] for i in range(reply_tokens)]
+    requests = 0
+
+    def chunk(body, delta, finish_reason=None):
+        return {
+            "id": "chatcmpl-fake",
+            "object": "chat.completion.chunk",
+            "created": int(time.time()),
+            "model": body["model"],
+            "choices": [{"index": 0, "delta": delta, "finish_reason": finish_reason}],
+        }
+
+    async def handler(request: httpx.Request):
+        nonlocal requests
+        requests += 1
+        tokens = reply_words + [f"#{requests}"] if unique else list(reply_words)
+        tokens[-1] = tokens[-1].rstrip()
+        body = json.loads(request.content)
+        await asyncio.sleep(latency)
+        if body.get("stream"):
+
+            def event(data):
+                return f"data: {json.dumps(data)}\n\n".encode()
+
+            async def events():
+                yield event(chunk(body, {"role": "assistant", "content": ""}))
+                for token in tokens:
+                    yield event(chunk(body, {"content": token}))
+                    await asyncio.sleep(1 / tokens_per_second)
+                yield event(chunk(body, {}, "stop"))
+                yield b"data: [DONE]\n\n"
+
+            return httpx.Response(
+                200, headers={"content-type": "text/event-stream"}, content=events()
+            )
+
+        await asyncio.sleep(len(tokens) / tokens_per_second)
+        prompt_tokens = sum(len(m["content"].split()) for m in body["messages"])
+        return httpx.Response(
+            200,
+            json={
+                "id": "chatcmpl-fake",
+                "object": "chat.completion",
+                "created": int(time.time()),
+                "model": body["model"],
+                "choices": [
+                    {
+                        "index": 0,
+                        "message": {"role": "assistant", "content": "".join(tokens)},
+                        "finish_reason": "stop",
+                    }
+                ],
+                "usage": {
+                    "prompt_tokens": prompt_tokens,
+                    "completion_tokens": len(tokens),
+                    "total_tokens": prompt_tokens + len(tokens),
+                },
+            },
+        )
+
+    return httpx.MockTransport(handler)
+
+
+async def fake_token_stream(text, tokens_per_second=30.0):
+    """
+    Yield `text` word by word at the given rate, like a streaming LLM.
+    """
+    for token in re.findall(r"\S+\s*", text):
+        await asyncio.sleep(1 / tokens_per_second)
+        yield token
+
+
+class FakeResponse:
+    """Minimal `requests.Response` for the blocking ElevenLabs path."""
+
+    def __init__(self, content, status_code=200):
+        self.content = content
+        self.status_code = status_code
+
+
+class FakeSession:
+    """
+    Stand-in for the `requests.Session` used for blocking ElevenLabs calls.
+    """
+
+    def __init__(self, latency=0.0, audio_bytes=32_000):
+        self.latency = latency
+        self.audio_bytes = audio_bytes
+
+    def post(self, url, json=None, headers=None, timeout=None, **kwargs):
+        time.sleep(self.latency)
+        return FakeResponse(b"\xff\xfb" * (self.audio_bytes // 2))
+
+
+class FakeMemory:
+    """
+    Stand-in for the chatbot's `ConversationBufferMemory`, starting from the
+    chat's `history` (a buffer string).
+    """
+
+    def __init__(self, history=""):
+        self.history = history
+        self.turns = []
+
+    def load_memory_variables(self, inputs):
+        lines = [self.history] if self.history else []
+        lines.extend(f"Human: {q}\nAI: {a}" for q, a in self.turns)
+        return {"history": "\n".join(lines)}
+
+    def save_context(self, inputs, outputs):
+        self.turns.append((inputs["input"], outputs["response"]))
+
+
+class FakeChain:
+    """
+    Stand-in for the `ConversationChain` returned by `initialize_chatbot`,
+    with the memory, prompt and LLM that `chatbot.ainvoke_response` runs.
+
+    Like the real chain, build one per `initialize_chatbot` call with the
+    chat's `message_history`: its memory is that chat's only.
+    """
+
+    def __init__(
+        self, latency=0.0, reply="Hey! That's awesome, tell me more.", message_history=None
+    ):
+        from langchain_core.messages import get_buffer_string
+        from langchain_core.runnables import RunnableLambda
+
+        self.latency = latency
+        self.reply = reply
+        history = get_buffer_string(message_history.messages) if message_history else ""
+        self.memory = FakeMemory(history)
+        self.prompt = RunnableLambda(lambda inputs: inputs)
+        self.llm = RunnableLambda(self._reply, afunc=self._areply)
+
+    def _reply(self, prompt):
+        from langchain_core.messages import AIMessage
+
+        time.sleep(self.latency)
+        return AIMessage(content=self.reply)
+
+    async def _areply(self, prompt):
+        from langchain_core.messages import AIMessage
+
+        await asyncio.sleep(self.latency)
+        return AIMessage(content=self.reply)
+
+    def invoke(self, inputs):
+        time.sleep(self.latency)
+        return {"input": inputs["input"], "response": self.reply}
+
+    async def ainvoke(self, inputs):
+        await asyncio.sleep(self.latency)
+        return {"input": inputs["input"], "response": self.reply}
+
+
+class FakeEmbeddings:
+    """
+    Stand-in for `OpenAIEmbeddings`: hashed bag-of-words vectors, so texts
+    sharing words are similar.
+    """
+
+    def __init__(self, latency=0.0, dimensions=256):
+        self.latency = latency
+        self.dimensions = dimensions
+        self.calls = 0
+
+    def _embed(self, text):
+        vector = [0.0] * self.dimensions
+        for word in re.findall(r"\w+", text.lower()):
+            vector[hash(word) % self.dimensions] += 1.0
+        return vector
+
+    async def aembed_documents(self, texts):
+        await asyncio.sleep(self.latency)
+        self.calls += 1
+        return [self._embed(text) for text in texts]
+
+    async def aembed_query(self, text):
+        await asyncio.sleep(self.latency)
+        self.calls += 1
+        return self._embed(text)
@@ -0,0 +1,208 @@
+import argparse
+import asyncio
+import contextlib
+import io
+import logging
+import os
+import time
+from collections import Counter
+
+import httpx
+from fastapi import status
+from fastapi.responses import JSONResponse
+
+# The baseline builds a boto3 client per S3 call: credentials from the
+# environment, never from the (unreachable) instance metadata service
+os.environ.setdefault("AWS_ACCESS_KEY_ID", "fake")
+os.environ.setdefault("AWS_SECRET_ACCESS_KEY", "fake")
+os.environ.setdefault("AWS_EC2_METADATA_DISABLED", "true")
+
+import chatbot
+import main
+import update_table
+from api import audio
+from api.clients import AWS_REGION, get_clients
+from chatbot import convert_to_langchain_messages
+from demos.fakes import (
+    FakeChain,
+    FakeDynamoDB,
+    FakeS3Client,
+    FakeSession,
+    FakeTable,
+    fake_elevenlabs_transport,
+)
+
+"""
+Load test: concurrent /chat turns against local fakes, threadpool vs async.
+
+The "threadpool" run mounts the baseline's synchronous handler (plain `def`,
+blocking calls), which Starlette runs on its shared threadpool, with the
+baseline's clients: a new connection for every ElevenLabs call
+(`requests.post`) and a new boto3 S3 client for every upload and presigned
+link, each upload on a new connection. Opening a connection costs
+`--connect-latency`. The "async" run drives the real `/chat` endpoint on the
+pooled clients of api/clients.py.
+
+Every turn builds its own chain (a `FakeChain` over the chat's history), like
+`initialize_chatbot`. Turns answered with anything but 200 (e.g. 503 when
+admission control sheds load, see api/admission.py) are reported, and only
+successful turns count towards throughput.
+
+Run from the repo root:
+```
+python -m demos.load_test_chat --turns 400
+```
+"""
+
+
+def install_fakes(args):
+    table = FakeTable(latency=args.dynamodb_latency)
+    dynamodb = FakeDynamoDB({update_table.TABLE_NAME: table}, latency=args.dynamodb_latency)
+    get_clients().override(
+        **{
+            "dynamodb": dynamodb,
+            f"table:{update_table.TABLE_NAME}": table,
+            "s3": FakeS3Client(latency=args.s3_latency),
+            "elevenlabs": FakeSession(latency=args.tts_latency),
+            "elevenlabs_async": httpx.AsyncClient(
+                transport=fake_elevenlabs_transport(latency=args.tts_latency)
+            ),
+        }
+    )
+    main.initialize_chatbot = lambda **kwargs: FakeChain(
+        latency=args.llm_latency, message_history=kwargs.get("message_history")
+    )
+    return table, dynamodb
+
+
+def legacy_chat_handler(args, table):
+    """
+    The baseline's `/chat` turn: every upstream call blocks the worker thread.
+    """
+    import boto3
+    from boto3.dynamodb.conditions import Key
+
+    s3 = FakeS3Client(latency=args.s3_latency)
+
+    def new_s3_client():
+        # The baseline's `boto3.client("s3")` per call, then served by the fake
+        boto3.client("s3", region_name=AWS_REGION)
+        return s3
+
+    def legacy_chat_response(chat_request: main.ChatRequest):
+        table.put_item(
+            Item={
+                "ChatID": chat_request.chat_id,
+                "timestamp": chat_request.timestamp,
+                "message": chat_request.message,
+                "type": "user",
+            }
+        )
+        messages = table.query(KeyConditionExpression=Key("ChatID").eq(chat_request.chat_id))[
+            "Items"
+        ]
+        langchain_messages = convert_to_langchain_messages(messages)
+        chatbot = main.initialize_chatbot(message_history=langchain_messages)
+        result = chatbot.invoke({"history": langchain_messages, "input": chat_request.message})
+        bot_response = result["response"]
+        table.put_item(
+            Item={
+                "ChatID": chat_request.chat_id,
+                "timestamp": update_table.current_epoch_time(),
+                "message": bot_response,
+                "type": "ai",
+            }
+        )
+        # `requests.post`: a new session, so a new connection, per call
+        time.sleep(args.connect_latency)
+        bot_audio = FakeSession(latency=args.tts_latency).post(
+            f"{audio.ELEVENLABS_API_URL}/v1/text-to-speech/{audio.ELEVENLABS_VOICE_ID}",
+            json={"text": bot_response},
+        ).content
+        s3_file_name = audio.generate_mp3_file_name()
+        s3_client = new_s3_client()
+        time.sleep(args.connect_latency)
+        s3_client.upload_fileobj(io.BytesIO(bot_audio), audio.AUDIO_BUCKET, s3_file_name)
+        link = new_s3_client().generate_presigned_url(
+            "get_object",
+            Params={"Bucket": audio.AUDIO_BUCKET, "Key": s3_file_name},
+            ExpiresIn=604800,
+        )
+        return JSONResponse(
+            content={"data": result, "audio_link": link}, status_code=status.HTTP_200_OK
+        )
+
+    return legacy_chat_response
+
+
+async def run_turns(path, turns):
+    transport = httpx.ASGITransport(app=main.app)
+    async with httpx.AsyncClient(
+        transport=transport, base_url="http://test", timeout=None
+    ) as client:
+
+        async def turn(i):
+            response = await client.post(
+                path,
+                json={
+                    "chat_id": f"load-{i}",
+                    "timestamp": 1700000000 + i,
+                    "message": "How was your day?",
+                    "model": "gpt-3.5-turbo",
+                    "prompt_template": "girlfriend",
+                },
+            )
+            return response.status_code
+
+        start = time.perf_counter()
+        codes = await asyncio.gather(*(turn(i) for i in range(turns)))
+        elapsed = time.perf_counter() - start
+    return elapsed, codes
+
+
+def run():
+    parser = argparse.ArgumentParser(description="Concurrent /chat load test")
+    parser.add_argument("--turns", type=int, default=400)
+    parser.add_argument("--llm-latency", type=float, default=0.5)
+    parser.add_argument("--tts-latency", type=float, default=0.3)
+    parser.add_argument("--dynamodb-latency", type=float, default=0.01)
+    parser.add_argument("--s3-latency", type=float, default=0.02)
+    parser.add_argument(
+        "--connect-latency",
+        type=float,
+        default=0.03,
+        help="Seconds to open a new HTTPS connection (TCP + TLS), baseline only",
+    )
+    parser.add_argument(
+        "--message-writes",
+        choices=("sync", "write-behind"),
+        default=update_table.MESSAGE_WRITES,
+        help="How /chat stores messages (MESSAGE_WRITES)",
+    )
+    args = parser.parse_args()
+    update_table.MESSAGE_WRITES = args.message_writes
+
+    table, dynamodb = install_fakes(args)
+    # Import LangChain before timing, like a warmed-up worker
+    chatbot.warm()
+    main.app.post("/legacy/chat")(legacy_chat_handler(args, table))
+    logging.disable(logging.CRITICAL)
+
+    print(f"{args.turns} concurrent turns, one worker")
+    for label, path in (("threadpool", "/legacy/chat"), ("async", "/chat")):
+        writes_before = table.calls["put_item"] + dynamodb.calls["batch_write_item"]
+        with contextlib.redirect_stdout(io.StringIO()):
+            elapsed, codes = asyncio.run(run_turns(path, args.turns))
+            update_table.flush_messages()
+        writes = table.calls["put_item"] + dynamodb.calls["batch_write_item"] - writes_before
+        ok = sum(code == 200 for code in codes)
+        failed = Counter(code for code in codes if code != 200)
+        print(
+            f"{label:>10}: {elapsed:6.2f} s, {ok / elapsed:7.1f} ok turns/s, {ok}/{args.turns} ok, "
+            f"{writes / args.turns:.2f} DynamoDB writes/turn"
+            + (f", failed: {dict(sorted(failed.items()))}" if failed else "")
+        )
+
+
+if __name__ == "__main__":
+    run()
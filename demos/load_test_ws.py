@@ -0,0 +1,194 @@
+import argparse
+import asyncio
+import contextlib
+import io
+import json
+import logging
+import statistics
+import time
+
+import httpx
+from langchain.prompts.prompt import PromptTemplate
+from langchain_community.chat_models.fake import FakeListChatModel
+
+import chatbot
+import main
+import update_table
+from api.chat_sessions import chat_sessions
+from api.clients import get_clients
+from demos.fakes import (
+    FakeDynamoDB,
+    FakeS3Client,
+    FakeTable,
+    fake_elevenlabs_transport,
+)
+
+"""
+Load test: many concurrent chats, each a WebSocket session vs stateless HTTP turns.
+
+Every client sends `--turns` messages one after the other. A turn is over when
+its reply and audio link have arrived: the `audio` event of the session, or
+the `done` event of `POST /chat/stream?audio=job`. The sockets are driven
+in-process over ASGI, so thousands fit in one event loop.
+
+Run from the repo root:
+```
+python -m demos.load_test_ws --clients 500
+```
+"""
+
+REPLY = "Sounds great, keep it up!"
+
+
+class ASGIWebSocket:
+    """
+    Minimal in-process WebSocket client for an ASGI app.
+    """
+
+    def __init__(self, app, path):
+        self.app = app
+        self.path = path
+        self._to_app = asyncio.Queue()
+        self._from_app = asyncio.Queue()
+        self._task = None
+
+    async def connect(self):
+        scope = {
+            "type": "websocket",
+            "asgi": {"version": "3.0"},
+            "scheme": "ws",
+            "path": self.path,
+            "raw_path": self.path.encode(),
+            "root_path": "",
+            "query_string": b"",
+            "headers": [],
+            "server": ("test", 80),
+            "client": ("test", 50000),
+            "subprotocols": [],
+        }
+        self._task = asyncio.create_task(self.app(scope, self._to_app.get, self._from_app.put))
+        await self._to_app.put({"type": "websocket.connect"})
+        message = await self._from_app.get()
+        if message["type"] != "websocket.accept":
+            raise ConnectionError(f"Rejected: {message}")
+
+    async def send_json(self, data):
+        await self._to_app.put({"type": "websocket.receive", "text": json.dumps(data)})
+
+    async def receive_json(self):
+        message = await self._from_app.get()
+        if message["type"] == "websocket.close":
+            raise ConnectionError(f"Closed with {message.get('code')}")
+        return json.loads(message["text"])
+
+    async def close(self):
+        await self._to_app.put({"type": "websocket.disconnect", "code": 1000})
+        await self._task
+
+
+def install_fakes(args):
+    table = FakeTable(latency=args.dynamodb_latency)
+    dynamodb = FakeDynamoDB({update_table.TABLE_NAME: table}, latency=args.dynamodb_latency)
+    get_clients().override(
+        **{
+            "dynamodb": dynamodb,
+            f"table:{update_table.TABLE_NAME}": table,
+            "s3": FakeS3Client(latency=args.s3_latency),
+            "elevenlabs_async": httpx.AsyncClient(
+                transport=fake_elevenlabs_transport(latency=args.tts_latency)
+            ),
+        }
+    )
+    llm = FakeListChatModel(responses=[REPLY], sleep=args.llm_latency / len(REPLY))
+
+    def get_llm_and_prompt(model_name, temperature, prompt_template):
+        template = chatbot.fetch_system_prompt(prompt_template=prompt_template)
+        return llm, PromptTemplate(input_variables=["history", "input"], template=template)
+
+    chatbot.get_llm_and_prompt = get_llm_and_prompt
+    return table
+
+
+async def websocket_client(i, turns, latencies):
+    socket = ASGIWebSocket(main.app, "/chat/ws")
+    await socket.connect()
+    await socket.send_json(
+        {"chat_id": f"ws-{i}", "model": "gpt-3.5-turbo", "prompt_template": "trainer"}
+    )
+    await socket.receive_json()
+    for turn in range(turns):
+        start = time.perf_counter()
+        await socket.send_json({"message": "How was your day?", "timestamp": 1700000000 + turn * 10})
+        while (await socket.receive_json())["event"] != "audio":
+            pass
+        latencies.append(time.perf_counter() - start)
+    await socket.close()
+
+
+async def http_client(client, i, turns, latencies):
+    for turn in range(turns):
+        start = time.perf_counter()
+        response = await client.post(
+            "/chat/stream?format=ndjson&audio=job",
+            json={
+                "chat_id": f"http-{i}",
+                "timestamp": 1700000000 + turn * 10,
+                "message": "How was your day?",
+                "model": "gpt-3.5-turbo",
+                "prompt_template": "trainer",
+            },
+        )
+        assert json.loads(response.text.splitlines()[-1])["event"] == "done"
+        latencies.append(time.perf_counter() - start)
+
+
+async def run_clients(mode, clients, turns):
+    latencies = []
+    start = time.perf_counter()
+    if mode == "websocket":
+        await asyncio.gather(*(websocket_client(i, turns, latencies) for i in range(clients)))
+    else:
+        transport = httpx.ASGITransport(app=main.app)
+        async with httpx.AsyncClient(
+            transport=transport, base_url="http://test", timeout=None
+        ) as client:
+            await asyncio.gather(
+                *(http_client(client, i, turns, latencies) for i in range(clients))
+            )
+    return time.perf_counter() - start, latencies
+
+
+def run():
+    parser = argparse.ArgumentParser(description="WebSocket session load test")
+    parser.add_argument("--clients", type=int, default=200)
+    parser.add_argument("--turns", type=int, default=5)
+    parser.add_argument("--llm-latency", type=float, default=0.25)
+    parser.add_argument("--tts-latency", type=float, default=0.1)
+    parser.add_argument("--dynamodb-latency", type=float, default=0.01)
+    parser.add_argument("--s3-latency", type=float, default=0.02)
+    args = parser.parse_args()
+
+    table = install_fakes(args)
+    # Import LangChain before timing, like a warmed-up worker
+    chatbot.warm()
+    chat_sessions.max_sessions = max(chat_sessions.max_sessions, args.clients)
+    logging.disable(logging.CRITICAL)
+
+    total = args.clients * args.turns
+    print(f"{args.clients} concurrent chats x {args.turns} turns, one worker")
+    for mode in ("http", "websocket"):
+        queries = table.calls["query"]
+        with contextlib.redirect_stdout(io.StringIO()):
+            elapsed, latencies = asyncio.run(run_clients(mode, args.clients, args.turns))
+        latencies.sort()
+        print(
+            f"{mode:>9}: {elapsed:6.2f} s, {total / elapsed:7.1f} turns/s, "
+            f"p50 {statistics.median(latencies) * 1000:6.0f} ms, "
+            f"p95 {latencies[int(len(latencies) * 0.95)] * 1000:6.0f} ms, "
+            f"{(table.calls['query'] - queries) / total:.2f} queries/turn"
+        )
+    print(f"sessions: {chat_sessions.metrics()}")
+
+
+if __name__ == "__main__":
+    run()
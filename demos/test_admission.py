@@ -0,0 +1,64 @@
+import asyncio
+
+from api.admission import AsyncLimiter
+
+"""
+Checks: a cancelled `AsyncLimiter.acquire` gives its slot (and its rate
+budget) back, whether it is cancelled waiting for the budget or for a slot.
+
+Run from the repo root with `python -m demos.test_admission`, or with pytest.
+"""
+
+
+async def _cancel_while_paying():
+    # The first two calls spend the burst and go into debt, the third waits
+    limiter = AsyncLimiter("test", concurrency=3, rate=1, burst=1, max_wait=30)
+    await limiter.acquire()
+    await limiter.acquire()
+    task = asyncio.ensure_future(limiter.acquire())
+    await asyncio.sleep(0.05)
+    assert limiter.stats.in_flight == 3
+    task.cancel()
+    await asyncio.gather(task, return_exceptions=True)
+    assert limiter.stats.in_flight == 2, limiter.metrics()
+    # Its budget is refunded too
+    assert limiter.bucket.available() > -1.5, limiter.metrics()
+    limiter.release()
+    limiter.release()
+    assert limiter.stats.in_flight == 0
+
+
+async def _cancel_while_queued():
+    limiter = AsyncLimiter("test", concurrency=1, max_wait=30)
+    await limiter.acquire()
+    queued = asyncio.ensure_future(limiter.acquire())
+    await asyncio.sleep(0.01)
+    # The slot is handed to the queued call, which is cancelled before it runs
+    limiter.release()
+    queued.cancel()
+    await asyncio.gather(queued, return_exceptions=True)
+    if not queued.cancelled():
+        # Python < 3.12 `wait_for` returns the slot rather than cancel
+        limiter.release()
+    assert limiter.stats.in_flight == 0, limiter.metrics()
+    async with limiter.slot():
+        assert limiter.stats.in_flight == 1
+    assert limiter.stats.in_flight == 0
+
+
+def test_cancel_while_paying():
+    asyncio.run(_cancel_while_paying())
+
+
+def test_cancel_while_queued():
+    asyncio.run(_cancel_while_queued())
+
+
+def run():
+    test_cancel_while_paying()
+    test_cancel_while_queued()
+    print("ok")
+
+
+if __name__ == "__main__":
+    run()
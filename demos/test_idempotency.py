@@ -0,0 +1,128 @@
+import asyncio
+import random
+
+import httpx
+from fastapi.responses import JSONResponse
+
+import main
+import update_table
+from api.clients import get_clients
+from api.idempotency import IdempotentTurns, turn_key
+from demos.bench_idempotency import CountingChain
+from demos.fakes import FakeKeyValueTable, FakeS3Client, fake_elevenlabs_transport
+from demos.test_table import install_table
+
+"""
+Checks: copies of a /chat turn sent while it runs and after it answered get
+its response with one LLM call, also from another worker sharing the
+idempotency table; a different message at the same timestamp is a new turn,
+and a failed turn isn't replayed.
+
+Run from the repo root with `python -m demos.test_idempotency`, or with pytest.
+"""
+
+
+def install_fakes():
+    install_table()
+    get_clients().override(
+        **{
+            "s3": FakeS3Client(),
+            "elevenlabs_async": httpx.AsyncClient(transport=fake_elevenlabs_transport()),
+            "table:ChatIdempotency": FakeKeyValueTable(),
+        }
+    )
+    main.initialize_chatbot = lambda **kwargs: CountingChain(
+        latency=0.2, message_history=kwargs.get("message_history")
+    )
+    CountingChain.calls = 0
+
+
+async def _send(message="How was your day?", chat_id=None, timestamp=1700000000):
+    async with httpx.AsyncClient(
+        transport=httpx.ASGITransport(app=main.app), base_url="http://test", timeout=None
+    ) as client:
+        return await client.post(
+            "/chat",
+            json={
+                "chat_id": chat_id,
+                "timestamp": timestamp,
+                "message": message,
+                "model": "gpt-3.5-turbo",
+                "prompt_template": "girlfriend",
+            },
+        )
+
+
+async def _retries():
+    install_fakes()
+    main.idempotent_turns = IdempotentTurns(backend="memory")
+    chat_id = f"test-idempotency-{random.getrandbits(32)}"
+    # Two copies while the turn runs, one after it answered
+    responses = await asyncio.gather(*(_send(chat_id=chat_id) for _ in range(3)))
+    responses.append(await _send(chat_id=chat_id))
+    assert all(response.status_code == 200 for response in responses)
+    assert len({response.content for response in responses}) == 1
+    assert sum("idempotent-replayed" in response.headers for response in responses) == 3
+    assert CountingChain.calls == 1
+
+    other = await _send("Something else", chat_id=chat_id)
+    assert other.status_code == 200 and "idempotent-replayed" not in other.headers
+    assert CountingChain.calls == 2
+    update_table.flush_messages()
+
+
+async def _other_worker():
+    install_fakes()
+    chat_id = f"test-idempotency-{random.getrandbits(32)}"
+    main.idempotent_turns = IdempotentTurns(backend="dynamodb")
+    first = await _send(chat_id=chat_id)
+    # A retry routed to another worker, with nothing in memory
+    main.idempotent_turns = IdempotentTurns(backend="dynamodb")
+    retry = await _send(chat_id=chat_id)
+    assert first.status_code == retry.status_code == 200
+    assert retry.content == first.content and "idempotent-replayed" in retry.headers
+    assert CountingChain.calls == 1
+    update_table.flush_messages()
+
+
+async def _failed_turn():
+    turns = IdempotentTurns(backend="memory")
+    key = turn_key("chat", 1700000000, "Hi")
+    statuses = iter((503, 200))
+    calls = 0
+
+    async def compute():
+        nonlocal calls
+        calls += 1
+        return JSONResponse({"calls": calls}, status_code=next(statuses))
+
+    response, replayed = await turns.run(key, compute)
+    assert response.status_code == 503 and not replayed
+    response, replayed = await turns.run(key, compute)
+    assert response.status_code == 200 and not replayed
+    response, replayed = await turns.run(key, compute)
+    assert replayed and response.body == b'{"calls":2}'
+    assert calls == 2
+
+
+def test_retries():
+    asyncio.run(_retries())
+
+
+def test_other_worker():
+    asyncio.run(_other_worker())
+
+
+def test_failed_turn():
+    asyncio.run(_failed_turn())
+
+
+def run():
+    test_retries()
+    test_other_worker()
+    test_failed_turn()
+    print("ok")
+
+
+if __name__ == "__main__":
+    run()
@@ -0,0 +1,134 @@
+import asyncio
+import os
+import random
+import tempfile
+
+import httpx
+import openai
+
+# ChatOpenAI insists on a key, the fake OpenAI transport ignores it
+os.environ.setdefault("OPENAI_API_KEY", "fake")
+
+import chatbot
+import update_table
+from api import summary_memory, vector_memory
+from api.clients import get_clients
+from api.summary_memory import SUMMARY_RECENT_MESSAGES, load_summary_history
+from api.vector_memory import RETRIEVAL_RECENT_MESSAGES, VectorMemory
+from demos.fakes import FakeEmbeddings, fake_openai_transport
+from demos.test_table import install_table
+
+"""
+Checks for the memory modes other than the buffer:
+- retrieval: an old message relevant to the user's is added to the prompt
+  next to the recent ones, and a persisted index is loaded again without
+  embedding the chat twice;
+- summary: once enough messages pile up, everything but the verbatim window
+  is summarized and the prompt becomes the summary plus that window.
+
+Run from the repo root with `python -m demos.test_memory`, or with pytest.
+"""
+
+FIRST_TIMESTAMP = 1700000000
+SUMMARY = "They planned squats on Monday."
+
+
+def store_chat(messages):
+    chat_id = f"test-memory-{random.getrandbits(32)}"
+    update_table.store_messages(
+        [
+            {
+                "chat_id": chat_id,
+                "timestamp": FIRST_TIMESTAMP + i,
+                "message": message,
+                "message_type": "user" if i % 2 == 0 else "ai",
+            }
+            for i, message in enumerate(messages)
+        ]
+    )
+    return chat_id
+
+
+async def _retrieval():
+    install_table()
+    embeddings = chatbot._embeddings = FakeEmbeddings()
+    messages = [f"Weather report {i}: cloudy skies" for i in range(20)]
+    messages[2] = "My plan is three sets of squats on Monday"
+    chat_id = store_chat(messages)
+    recent = update_table.get_all_messages_for_chat(chat_id)
+
+    default_dir = vector_memory.VECTOR_INDEX_DIR
+    with tempfile.TemporaryDirectory() as index_dir:
+        vector_memory.VECTOR_INDEX_DIR = index_dir
+        try:
+            memory = VectorMemory()
+            # Catching up on the stored messages runs in the background
+            await memory.get_index(chat_id)
+            await asyncio.gather(*memory._background)
+            timestamp = FIRST_TIMESTAMP + len(messages)
+            history = await memory.load_history(
+                chat_id, "How many squats on Monday?", timestamp, recent
+            )
+            relevant, *verbatim = history.messages
+            assert "squats on Monday" in relevant.content, relevant.content
+            assert [m.content for m in verbatim] == messages[-RETRIEVAL_RECENT_MESSAGES:]
+            await memory.aclose()
+
+            calls = embeddings.calls
+            restarted = VectorMemory()
+            index = await restarted.get_index(chat_id)
+            await asyncio.gather(*restarted._background)
+            assert len(index) == len(messages) + 1 and timestamp in index
+            assert embeddings.calls == calls
+        finally:
+            vector_memory.VECTOR_INDEX_DIR = default_dir
+
+
+async def _summary():
+    install_table()
+    get_clients().override(
+        openai=openai.OpenAI(api_key="fake"),
+        openai_async=openai.AsyncOpenAI(
+            api_key="fake",
+            http_client=httpx.AsyncClient(
+                transport=fake_openai_transport(
+                    reply=SUMMARY, reply_tokens=len(SUMMARY.split()), tokens_per_second=1000
+                )
+            ),
+        ),
+    )
+    messages = [f"Message {i}" for i in range(20)]
+    chat_id = store_chat(messages)
+
+    history = await load_summary_history(chat_id, "gpt-3.5-turbo")
+    assert [m.content for m in history.messages] == messages[-len(history.messages) :]
+    # Too many unsummarized messages, a refresh was scheduled
+    await asyncio.gather(*summary_memory._refreshing.values())
+    summary = update_table.get_summary(chat_id)
+    assert summary["message"] == SUMMARY
+    summarized = len(messages) - SUMMARY_RECENT_MESSAGES
+    assert summary["summarized_until"] == FIRST_TIMESTAMP + summarized - 1
+
+    history = await load_summary_history(chat_id, "gpt-3.5-turbo")
+    first, *verbatim = history.messages
+    assert SUMMARY in first.content
+    assert [m.content for m in verbatim] == messages[summarized:]
+    assert chat_id not in summary_memory._refreshing
+
+
+def test_retrieval():
+    asyncio.run(_retrieval())
+
+
+def test_summary():
+    asyncio.run(_summary())
+
+
+def run():
+    test_retrieval()
+    test_summary()
+    print("ok")
+
+
+if __name__ == "__main__":
+    run()
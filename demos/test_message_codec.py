@@ -0,0 +1,75 @@
+import zlib
+
+from api.message_codec import (
+    FORMAT_VERSION,
+    decode_item,
+    decode_message,
+    encode_item,
+    encode_message,
+    zstandard,
+)
+
+"""
+Checks: long messages round-trip through every codec, short ones and plain
+strings written before compression (legacy items) are read as they are, and
+an unknown format is refused rather than misread.
+
+Run from the repo root with `python -m demos.test_message_codec`, or with pytest.
+"""
+
+LONG_REPLY = "That's flipping awesome, tell me more about your day! " * 40
+
+
+class Binary:
+    # Like boto3's `Binary`, which wraps binary attributes read from DynamoDB
+    def __init__(self, value):
+        self.value = value
+
+
+def test_round_trip():
+    for codec in ("zlib", "zstd"):
+        encoded = encode_message(LONG_REPLY, codec, min_bytes=1024)
+        assert isinstance(encoded, bytes) and len(encoded) < len(LONG_REPLY)
+        assert encoded[0] == FORMAT_VERSION
+        assert decode_message(encoded) == LONG_REPLY
+        assert decode_message(Binary(encoded)) == LONG_REPLY
+    assert encode_message(LONG_REPLY, "none") == LONG_REPLY
+
+
+def test_short_messages_stay_strings():
+    assert encode_message("Hi!", "zlib", min_bytes=1024) == "Hi!"
+    item = {"ChatID": "chat", "timestamp": 1, "message": "Hi!", "type": "user"}
+    assert encode_item(item, "zlib") is item
+
+
+def test_legacy_items():
+    item = {"ChatID": "chat", "timestamp": 1, "message": LONG_REPLY, "type": "ai"}
+    assert decode_item(item) is item
+    assert decode_item(None) is None
+    assert decode_item({"ChatID": "chat", "timestamp": 2}) == {"ChatID": "chat", "timestamp": 2}
+    encoded = encode_item(item, "zlib")
+    assert encoded["message"] != LONG_REPLY
+    assert decode_item({**encoded, "message": Binary(encoded["message"])}) == item
+
+
+def test_unknown_format():
+    for header in (bytes([FORMAT_VERSION + 1, 1]), bytes([FORMAT_VERSION, 99])):
+        try:
+            decode_message(header + zlib.compress(LONG_REPLY.encode()))
+        except ValueError:
+            continue
+        raise AssertionError(f"Decoded an unknown format {header!r}")
+
+
+def run():
+    if zstandard is None:
+        print("zstandard is not installed, zstd falls back to zlib")
+    test_round_trip()
+    test_short_messages_stay_strings()
+    test_legacy_items()
+    test_unknown_format()
+    print("ok")
+
+
+if __name__ == "__main__":
+    run()
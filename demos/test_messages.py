@@ -0,0 +1,128 @@
+import asyncio
+import json
+import random
+
+import httpx
+
+import main
+import update_table
+from api.conversation_cache import conversation_cache
+from demos.test_table import install_table
+
+"""
+Checks: /chat/messages pages walked with their `next_cursor`, backwards
+(`before`) and forwards (`after`), return every message of a chat once and
+never its summary item, from the table and from the conversation cache; the
+NDJSON export streams the whole chat; a poll with the ETag gets a 304 until
+the chat gains a message.
+
+Run from the repo root with `python -m demos.test_messages`, or with pytest.
+"""
+
+MESSAGES = 25
+FIRST_TIMESTAMP = 1700000000
+
+
+def store_chat():
+    install_table()
+    chat_id = f"test-messages-{random.getrandbits(32)}"
+    update_table.store_messages(
+        [
+            {
+                "chat_id": chat_id,
+                "timestamp": FIRST_TIMESTAMP + i,
+                "message": f"Message {i}",
+                "message_type": "user" if i % 2 == 0 else "ai",
+            }
+            for i in range(MESSAGES)
+        ]
+    )
+    update_table.store_summary(chat_id, "They said hi.", FIRST_TIMESTAMP + 3)
+    return chat_id
+
+
+def post(client, body, **params):
+    return client.post("/chat/messages", json=body, params=params)
+
+
+def client():
+    return httpx.AsyncClient(transport=httpx.ASGITransport(app=main.app), base_url="http://test")
+
+
+async def _walk(chat_id, direction):
+    timestamps = []
+    cursor = {direction: 0} if direction == "after" else {}
+    async with client() as http:
+        while cursor is not None:
+            response = await post(http, {"chat_id": chat_id, "limit": 10, **cursor})
+            assert response.status_code == 200, response.text
+            content = response.json()
+            page = [int(item["timestamp"]) for item in content["data"]]
+            assert page == sorted(page) and 0 < len(page) <= 10
+            timestamps = timestamps + page if direction == "after" else page + timestamps
+            cursor = content["next_cursor"]
+    return timestamps
+
+
+async def _pages():
+    chat_id = store_chat()
+    expected = [FIRST_TIMESTAMP + i for i in range(MESSAGES)]
+    conversation_cache.invalidate(chat_id)
+    for direction in ("before", "after"):
+        assert await _walk(chat_id, direction) == expected, direction
+    # Again with the whole chat cached
+    update_table.get_all_messages_for_chat(chat_id)
+    for direction in ("before", "after"):
+        assert await _walk(chat_id, direction) == expected, direction
+
+
+async def _export():
+    chat_id = store_chat()
+    async with client() as http:
+        for body, count in (
+            ({"chat_id": chat_id, "limit": 10}, MESSAGES),
+            ({"chat_id": chat_id, "limit": 10, "after": FIRST_TIMESTAMP + 4}, MESSAGES - 5),
+            ({"chat_id": chat_id, "limit": 10, "before": FIRST_TIMESTAMP + 12}, 12),
+        ):
+            response = await post(http, body, format="ndjson")
+            assert response.status_code == 200, response.text
+            lines = [json.loads(line) for line in response.text.splitlines()]
+            assert len(lines) == count, (body, len(lines))
+            assert all(line["type"] != "summary" for line in lines)
+
+
+async def _etag():
+    chat_id = store_chat()
+    body = {"chat_id": chat_id, "limit": 10}
+    async with client() as http:
+        first = await post(http, body)
+        etag = first.headers["ETag"]
+        polled = await http.post("/chat/messages", json=body, headers={"If-None-Match": etag})
+        assert polled.status_code == 304 and polled.headers["ETag"] == etag
+        update_table.store_message(chat_id, FIRST_TIMESTAMP + MESSAGES, "Hi again")
+        changed = await http.post("/chat/messages", json=body, headers={"If-None-Match": etag})
+        assert changed.status_code == 200 and changed.headers["ETag"] != etag
+        assert changed.json()["data"][-1]["message"] == "Hi again"
+
+
+def test_pages():
+    asyncio.run(_pages())
+
+
+def test_export():
+    asyncio.run(_export())
+
+
+def test_etag():
+    asyncio.run(_etag())
+
+
+def run():
+    test_pages()
+    test_export()
+    test_etag()
+    print("ok")
+
+
+if __name__ == "__main__":
+    run()
@@ -0,0 +1,94 @@
+import time
+from datetime import datetime, timedelta, timezone
+from types import SimpleNamespace
+
+from api import presign
+from api.clients import get_clients
+from api.presign import PresignedURLCache, credentials_expiry
+from demos.fakes import FakeS3Client
+
+"""
+Checks: cached presigned links are signed again once they have
+`min_validity` left, sooner when the credentials that signed them expire
+first (refreshable role credentials, or a session token of unknown expiry),
+and the ETag refresh period follows.
+
+Run from the repo root with `python -m demos.test_presign`, or with pytest.
+"""
+
+BUCKET = "audio"
+DAY = 86400
+
+
+def install_s3(token=None, expires_in=None):
+    """
+    Sign with long-term credentials, or temporary ones with a `token` and,
+    like refreshable credentials, a known expiry.
+    """
+    s3 = FakeS3Client()
+    expiry_time = None
+    if expires_in is not None:
+        expiry_time = datetime.now(timezone.utc) + timedelta(seconds=expires_in)
+    # Where botocore keeps the credentials a client signs with
+    s3._request_signer = SimpleNamespace(
+        _credentials=SimpleNamespace(token=token, _expiry_time=expiry_time)
+    )
+    get_clients().override(s3=s3)
+    return s3
+
+
+def refresh_in(cache, key):
+    return cache._links[(BUCKET, key)][1] - time.time()
+
+
+def test_long_term_credentials():
+    install_s3()
+    assert credentials_expiry(get_clients().s3) is None
+    cache = PresignedURLCache(expiration=7 * DAY, min_validity=DAY)
+    link = cache.get_link("a.mp3", BUCKET)
+    assert link and cache.get_link("a.mp3", BUCKET) == link
+    assert cache.metrics()["hits"] == 1
+    assert 6 * DAY - 5 < refresh_in(cache, "a.mp3") <= 6 * DAY
+    assert cache.refresh_period() == DAY
+
+
+def test_refreshable_credentials():
+    install_s3(token="session", expires_in=600)
+    assert abs(credentials_expiry(get_clients().s3) - (time.time() + 600)) < 5
+    cache = PresignedURLCache(expiration=7 * DAY, min_validity=DAY)
+    cache.get_link("a.mp3", BUCKET)
+    # Half of the 10 minutes the link really has
+    assert 295 < refresh_in(cache, "a.mp3") <= 300
+    assert cache.refresh_period() <= presign.PRESIGN_TEMPORARY_CREDENTIALS_TTL // 3
+
+
+def test_session_token():
+    install_s3(token="session")
+    cache = PresignedURLCache(expiration=7 * DAY, min_validity=DAY)
+    cache.get_link("a.mp3", BUCKET)
+    ttl = presign.PRESIGN_TEMPORARY_CREDENTIALS_TTL
+    assert ttl / 2 - 5 < refresh_in(cache, "a.mp3") <= ttl / 2
+
+
+def test_expired_links_signed_again():
+    install_s3(token="session", expires_in=600)
+    cache = PresignedURLCache(expiration=7 * DAY, min_validity=DAY)
+    cache.get_links(["a.mp3", "b.mp3"], BUCKET)
+    link, _ = cache._links[(BUCKET, "a.mp3")]
+    cache._links[(BUCKET, "a.mp3")] = (link, time.time() - 1)
+    assert cache.cached(BUCKET, "a.mp3") is None
+    assert cache.cached(BUCKET, "b.mp3")
+    assert cache.get_link("a.mp3", BUCKET) == link
+    assert cache.metrics()["refreshed"] == 1 and cache.metrics()["misses"] == 3
+
+
+def run():
+    test_long_term_credentials()
+    test_refreshable_credentials()
+    test_session_token()
+    test_expired_links_signed_again()
+    print("ok")
+
+
+if __name__ == "__main__":
+    run()
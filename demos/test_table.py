@@ -1,3 +1,95 @@
-from update_table import store_message
+import random
 
-store_message("test_chat_id", 123456789, "Test user message", "user")
+import update_table
+from api.clients import get_clients
+from api.conversation_cache import conversation_cache
+from demos.fakes import FakeDynamoDB, FakeTable
+
+"""
+Checks: messages stored with `store_messages` and `store_message` read back
+in order, and messages whose write failed are never served from the
+conversation cache. Runs on a `FakeTable`, never the real `ChatMessages`.
+
+Run from the repo root with `python -m demos.test_table`, or with pytest.
+"""
+
+
+def install_table(table=None, unprocessed_rate=0.0):
+    """
+    Serve the `ChatMessages` table from a fake; `unprocessed_rate=1` fails
+    every batch write.
+    """
+    table = table or FakeTable()
+    dynamodb = FakeDynamoDB({update_table.TABLE_NAME: table}, unprocessed_rate=unprocessed_rate)
+    get_clients().override(
+        **{"dynamodb": dynamodb, f"table:{update_table.TABLE_NAME}": table}
+    )
+    return table
+
+
+def new_chat_id():
+    return f"test-table-{random.getrandbits(32)}"
+
+
+def test_store_messages():
+    table = install_table()
+    chat_id = new_chat_id()
+    failed = update_table.store_messages(
+        [
+            {"chat_id": chat_id, "timestamp": 123456789, "message": "Test user message"},
+            {
+                "chat_id": chat_id,
+                "timestamp": 123456790,
+                "message": "Test AI message",
+                "message_type": "ai",
+            },
+        ]
+    )
+    assert failed == []
+    assert len(table.items[chat_id]) == 2
+    conversation_cache.invalidate(chat_id)
+    messages = update_table.get_all_messages_for_chat(chat_id)
+    assert [(m["timestamp"], m["type"], m["message"]) for m in messages] == [
+        (123456789, "user", "Test user message"),
+        (123456790, "ai", "Test AI message"),
+    ]
+
+
+def test_failed_batch_not_cached():
+    table = install_table()
+    chat_id = new_chat_id()
+    update_table.store_messages([{"chat_id": chat_id, "timestamp": 1, "message": "Hi"}])
+    # The whole chat is cached by a read, then writes to it fail
+    update_table.get_all_messages_for_chat(chat_id)
+    install_table(table, unprocessed_rate=1.0)
+    failed = update_table.store_messages(
+        [{"chat_id": chat_id, "timestamp": ts, "message": "Lost"} for ts in (2, 3)]
+    )
+    assert len(failed) == 2
+    cached = conversation_cache.get(chat_id)
+    assert cached is None or [int(m["timestamp"]) for m in cached[0]] == [1], cached
+
+
+def test_failed_write_behind():
+    table = install_table()
+    chat_id = new_chat_id()
+    update_table.store_message(chat_id, 1, "Hi", durable=True)
+    update_table.get_all_messages_for_chat(chat_id)
+    install_table(table, unprocessed_rate=1.0)
+    stored = update_table.store_message(chat_id, 2, "Lost")
+    assert stored.result(timeout=60) is False
+    assert update_table.flush_messages(chat_id) is False
+    # The cache held the queued message, it is read from the table again
+    install_table(table)
+    assert [int(m["timestamp"]) for m in update_table.get_all_messages_for_chat(chat_id)] == [1]
+
+
+def run():
+    test_store_messages()
+    test_failed_batch_not_cached()
+    test_failed_write_behind()
+    print("ok")
+
+
+if __name__ == "__main__":
+    run()
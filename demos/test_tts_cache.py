@@ -0,0 +1,79 @@
+import asyncio
+import tempfile
+
+import httpx
+
+from api.audio import AUDIO_BUCKET
+from api.clients import get_clients
+from api.tts_cache import TTSAudioCache, object_name, tts_cache_key
+from demos.fakes import FakeS3Client, fake_elevenlabs_transport
+
+"""
+Checks: the same reply asked for at once, or spelled with other whitespace, is
+synthesized and uploaded once; another worker finds it in S3, and a restarted
+one on disk; a different reply gets its own clip.
+
+Run from the repo root with `python -m demos.test_tts_cache`, or with pytest.
+"""
+
+GREETING = "Hey! How's it going?"
+
+
+def install_fakes():
+    s3 = FakeS3Client()
+    get_clients().override(
+        s3=s3,
+        elevenlabs_async=httpx.AsyncClient(transport=fake_elevenlabs_transport(latency=0.05)),
+    )
+    return s3
+
+
+async def _dedup():
+    s3 = install_fakes()
+    cache = TTSAudioCache()
+    names = await asyncio.gather(
+        *(cache.get_object_name(text) for text in (GREETING, GREETING, f"  {GREETING}\n"))
+    )
+    assert len(set(names)) == 1 and names[0] == object_name(tts_cache_key(GREETING))
+    assert cache.metrics()["misses"] == 1 and len(s3.objects) == 1
+    # Served from the index of known S3 keys
+    assert await cache.get_object_name(GREETING) == names[0]
+    assert cache.metrics()["s3_hits"] == 1
+
+    other = await cache.get_object_name("Tell me more.")
+    assert other != names[0] and len(s3.objects) == 2
+
+    # Another worker finds the clip with a HEAD request
+    worker = TTSAudioCache()
+    assert await worker.get_object_name(GREETING) == names[0]
+    assert worker.metrics()["s3_hits"] == 1 and worker.metrics()["misses"] == 0
+    assert (AUDIO_BUCKET, names[0]) in s3.objects
+
+
+async def _disk():
+    with tempfile.TemporaryDirectory() as disk_dir:
+        install_fakes()
+        first = TTSAudioCache(disk_dir=disk_dir)
+        clip = b"".join([chunk async for chunk in first.astream(GREETING)])
+        # A restarted worker streams the clip from disk
+        restarted = TTSAudioCache(disk_dir=disk_dir)
+        assert b"".join([chunk async for chunk in restarted.astream(GREETING)]) == clip
+        assert restarted.metrics()["disk_hits"] == 1 and restarted.metrics()["misses"] == 0
+
+
+def test_dedup():
+    asyncio.run(_dedup())
+
+
+def test_disk():
+    asyncio.run(_disk())
+
+
+def run():
+    test_dedup()
+    test_disk()
+    print("ok")
+
+
+if __name__ == "__main__":
+    run()
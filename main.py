@@ -1,34 +1,91 @@
-from fastapi import FastAPI, status
-from fastapi.responses import JSONResponse
+from fastapi import FastAPI, Header, Response, WebSocket, status
+from fastapi.responses import JSONResponse, PlainTextResponse, StreamingResponse
 from pydantic import BaseModel
 from fastapi.middleware.cors import CORSMiddleware
-from chatbot import initialize_chatbot, convert_to_langchain_messages
+from starlette.background import BackgroundTask
+from chatbot import (
+    initialize_chatbot,
+    convert_to_langchain_messages,
+    astream_response,
+    ainvoke_response,
+    save_response,
+    llm_slot,
+    warm as chatbot_warm,
+)
 from update_table import (
-    store_message,
-    get_all_messages_for_chat,
+    aconfirm_stored,
+    astore_message,
+    aget_all_messages_for_chat,
+    aget_recent_messages_for_chat,
+    aget_message,
+    aget_messages_page,
     current_epoch_time,
+    message_writer,
+    MessageNotStored,
+    MESSAGES_PAGE_MAX,
 )
+import base64
+import hashlib
+import json
 import logging
+import sys
+import time
+from decimal import Decimal
+from typing import Literal, Optional
 from api.audio import (
-    get_elevenlabs_audio,
-    generate_mp3_file_name,
-    upload_audio_bytes_to_s3,
-    get_s3_link,
+    aget_s3_link,
 )
-from fastapi.encoders import jsonable_encoder
-
-# Configure logging
-logging.basicConfig(
-    level=logging.INFO,
-    format="%(asctime)s - %(name)s - %(levelname)s - %(message)s - %(funcName)s - Line: %(lineno)d",
-    datefmt="%Y-%m-%d %H:%M:%S",
+from api.admission import Saturated, upstream_limits
+from api.aio import run_blocking, shutdown_executor
+from api.clients import get_clients
+from api.conversation_cache import conversation_cache
+from api.audio_jobs import (
+    audio_jobs,
+    attach_audio,
+    save_audio,
+    AUDIO_BUCKET,
+    READY,
+    PENDING,
+    FAILED,
+    SKIPPED,
+)
+from api.chat_sessions import chat_sessions
+from api.idempotency import TurnInProgress, idempotent_turns, turn_key
+from api.logs import LOG_DEBUG_SAMPLE_RATE, configure_logging, log_event, stop_logging
+from api.logs import metrics as logging_metrics
+from api.presign import presigned_urls
+from api.resilience import (
+    CHAT_DEADLINE,
+    DeadlineExceeded,
+    deadline_scope,
+    elevenlabs_policy,
+    openai_policy,
+    start_deadline,
 )
+from api.resilience import metrics as resilience_metrics
+from api.summary_memory import load_summary_history, stop_summary_refreshes
+from api.tts_cache import tts_cache
+from api.tracing import ServerTimingMiddleware, render_prometheus, stage, tracer
+from api.tokens import get_encoding
+from api.warmup import warm_up
+from api.tts_pipeline import SentenceAudioPipeline, stream_text_and_audio
 
-logger = logging.getLogger("my-logger")
+# Configure logging: LOG_FORMAT, LOG_LEVEL and LOG_QUEUE, see api/logs.py
+configure_logging()
+
+# Longest a /chat/stream response waits for its audio before sending `done`
+AUDIO_STREAM_WAIT = 60
+# Longest a /chat/audio long-poll may wait
+AUDIO_POLL_MAX_WAIT = 30
 
 
 class ChatMessagesRequest(BaseModel):
     chat_id: str
+    # Cursors (message timestamps), see `get_messages_page`
+    before: Optional[int] = None
+    after: Optional[int] = None
+    # Page size, the whole chat is returned when no cursor or limit is given
+    limit: Optional[int] = None
 
 
 class ChatRequest(BaseModel):
@@ -40,6 +97,9 @@ class ChatRequest(BaseModel):
     model: str
     prompt_template: str
     temperature: float = 0.2  # default value if not provided
+    # "buffer": recent history verbatim, "summary": rolling summary + last few messages,
+    # "retrieval": most relevant past messages + last few messages
+    memory: Literal["buffer", "summary", "retrieval"] = "buffer"
 
 
 app = FastAPI()
@@ -59,6 +119,92 @@ app.add_middleware(
     allow_methods=["*"],  # Allows all methods
     allow_headers=["*"],  # Allows all headers
 )
+# Stage timings of each response, when SERVER_TIMING=1
+app.add_middleware(ServerTimingMiddleware)
+
+# Counters of the shared components, exported as gauges at /metrics
+tracer.add_collector("clients", lambda: get_clients().metrics())
+tracer.add_collector("chat_sessions", chat_sessions.metrics)
+tracer.add_collector("message_writer", message_writer.metrics)
+tracer.add_collector("tts_cache", tts_cache.metrics)
+tracer.add_collector("conversation_cache", conversation_cache.metrics)
+tracer.add_collector("admission", upstream_limits.metrics)
+tracer.add_collector("resilience", resilience_metrics)
+tracer.add_collector("presign", presigned_urls.metrics)
+tracer.add_collector("idempotency", idempotent_turns.metrics)
+tracer.add_collector("warmup", warm_up.metrics)
+tracer.add_collector("logging", logging_metrics)
+
+
+def saturated_response(e: Saturated) -> JSONResponse:
+    """
+    503 when the service is full, 429 when an upstream budget is spent, with
+    the seconds to wait before retrying.
+    """
+    return JSONResponse(
+        content={"error": str(e), "retry_after": e.retry_after},
+        status_code=e.status_code,
+        headers={"Retry-After": str(e.retry_after)},
+    )
+
+
+def deadline_response(e: DeadlineExceeded) -> JSONResponse:
+    return JSONResponse(
+        content={"error": str(e)}, status_code=status.HTTP_504_GATEWAY_TIMEOUT
+    )
+
+
+@app.exception_handler(Saturated)
+async def handle_saturated(request, e: Saturated):
+    return saturated_response(e)
+
+
+@app.exception_handler(DeadlineExceeded)
+async def handle_deadline_exceeded(request, e: DeadlineExceeded):
+    return deadline_response(e)
+
+
+def get_vector_memory():
+    """
+    The retrieval memory, imported on first use of retrieval mode (or by the
+    warm-up) rather than at startup: it brings in NumPy.
+    """
+    from api.vector_memory import vector_memory
+
+    return vector_memory
+
+
+# Model whose tokenizer is loaded by the warm-up
+WARM_UP_MODEL = "gpt-3.5-turbo"
+
+# Built before the first turn needs them, see api/warmup.py. Building the
+# boto3 clients also resolves the AWS credentials.
+warm_up.add_step("clients", lambda: get_clients().warm())
+warm_up.add_step("langchain", chatbot_warm)
+warm_up.add_step("tokenizer", lambda: get_encoding(WARM_UP_MODEL))
+warm_up.add_step("retrieval", get_vector_memory)
+
+
+@app.on_event("startup")
+async def startup():
+    audio_jobs.start()
+    await warm_up.start()
+
+
+@app.on_event("shutdown")
+async def shutdown():
+    await warm_up.stop()
+    await chat_sessions.close_all()
+    await audio_jobs.stop()
+    await stop_summary_refreshes()
+    if "api.vector_memory" in sys.modules:
+        await get_vector_memory().aclose()
+    # Write the queued messages while the DynamoDB client is still open
+    await run_blocking(message_writer.close)
+    await get_clients().aclose()
+    shutdown_executor(wait=False)
+    # Last, so the components' shutdown logs are written
+    stop_logging()
 
 
 @app.get("/")
@@ -66,10 +212,31 @@ def read_root():
     return {"Hello": "World"}
 
 
-@app.post("/chat")
-def get_chat_response(chat_request: ChatRequest):
-    try:
-        store_message(
+@app.get("/ready")
+def get_readiness():
+    """
+    200 once the worker is warmed up (see api/warmup.py), 503 until then.
+    """
+    if not warm_up.ready:
+        return JSONResponse(
+            content=warm_up.metrics(),
+            status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+            headers={"Retry-After": "1"},
+        )
+    return JSONResponse(content=warm_up.metrics(), status_code=status.HTTP_200_OK)
+
+
+async def load_chatbot(chat_request: ChatRequest):
+    """
+    Store the user's message and build a chatbot over the chat's history.
+
+    Returns
+    -------
+    (the chatbot, its history, what `astore_message` returned for the user's
+    message: pass it to `aconfirm_stored` before acknowledging the turn)
+    """
+    with stage("store_user_message", characters=len(chat_request.message)):
+        stored = await astore_message(
             chat_id=chat_request.chat_id,
             timestamp=chat_request.timestamp,
             message=chat_request.message,
@@ -77,101 +244,636 @@ def get_chat_response(chat_request: ChatRequest):
             audio_file_url=None,
         )
 
-        messages = get_all_messages_for_chat(chat_request.chat_id)
-
+    if chat_request.memory == "summary":
+        with stage("history_query"):
+            langchain_messages = await load_summary_history(
+                chat_request.chat_id, model_name=chat_request.model
+            )
+    elif chat_request.memory == "retrieval":
+        with stage("history_query") as span:
+            messages = await aget_recent_messages_for_chat(
+                chat_request.chat_id, model_name=chat_request.model
+            )
+            span.add(messages=len(messages))
+        with stage("history_retrieval"):
+            langchain_messages = await get_vector_memory().load_history(
+                chat_request.chat_id,
+                chat_request.message,
+                chat_request.timestamp,
+                messages,
+            )
+    else:
+        with stage("history_query") as span:
+            messages = await aget_recent_messages_for_chat(
+                chat_request.chat_id, model_name=chat_request.model
+            )
+            span.add(messages=len(messages))
         langchain_messages = convert_to_langchain_messages(messages)
 
-        logging.info("DynamoDB Chat History %s", messages)
-        logging.info("LangChain Messages %s", langchain_messages)
+    # The history itself only for a sample of the turns, at DEBUG
+    log_event(
+        logging.DEBUG,
+        "chat_history",
+        sample=LOG_DEBUG_SAMPLE_RATE,
+        chat_id=chat_request.chat_id,
+        messages=len(langchain_messages.messages),
+        history=lambda: langchain_messages,
+    )
+
+    chatbot = initialize_chatbot(
+        model_name=chat_request.model,
+        temperature=chat_request.temperature,
+        prompt_template=chat_request.prompt_template,
+        message_history=langchain_messages,
+    )
+    log_event(
+        logging.INFO,
+        "chat_request",
+        chat_id=chat_request.chat_id,
+        model=chat_request.model,
+        memory=chat_request.memory,
+        characters=len(chat_request.message),
+        history=len(langchain_messages.messages),
+    )
+    return chatbot, langchain_messages, stored
+
 
-        chatbot = initialize_chatbot(
-            model_name=chat_request.model,
-            temperature=chat_request.temperature,
-            prompt_template=chat_request.prompt_template,
-            message_history=langchain_messages,
+def log_response(chat_request: ChatRequest, bot_response: str):
+    log_event(
+        logging.INFO,
+        "chat_response",
+        chat_id=chat_request.chat_id,
+        characters=len(bot_response or ""),
+    )
+    log_event(
+        logging.DEBUG,
+        "chat_response_text",
+        sample=LOG_DEBUG_SAMPLE_RATE,
+        chat_id=chat_request.chat_id,
+        response=bot_response,
+    )
+
+
+async def store_ai_message(chat_request: ChatRequest, bot_timestamp: int, bot_response: str):
+    """
+    Store the bot's reply, and queue it for embedding in retrieval mode.
+    """
+    with stage("store_ai_message", characters=len(bot_response)):
+        await astore_message(
+            chat_id=chat_request.chat_id,
+            timestamp=bot_timestamp,
+            message=bot_response,
+            message_type="ai",
+            audio_file_url=None,
+        )
+    if chat_request.memory == "retrieval":
+        get_vector_memory().schedule_index(
+            chat_request.chat_id, bot_timestamp, "ai", bot_response
         )
-        logging.info(f"Received request: {chat_request}")
 
-        logging.info(f"INVOKING CHATBOT")
-        result = chatbot.invoke(
-            {"history": langchain_messages, "input": chat_request.message}
+
+@app.post("/chat")
+async def get_chat_response(chat_request: ChatRequest):
+    # Retries of a turn (same chat, timestamp and message) share its response:
+    # attached to it while it runs, replayed once it completed. They are
+    # matched before admission, so they don't take a slot of the gate.
+    key = turn_key(chat_request.chat_id, chat_request.timestamp, chat_request.message)
+    try:
+        response, replayed = await idempotent_turns.run(
+            key, lambda: chat_turn(chat_request)
+        )
+    except TurnInProgress as e:
+        return JSONResponse(
+            content={"error": str(e), "retry_after": e.retry_after},
+            status_code=status.HTTP_409_CONFLICT,
+            headers={"Retry-After": str(e.retry_after)},
+        )
+    if replayed and response.status_code == status.HTTP_200_OK:
+        return Response(
+            content=response.body,
+            status_code=response.status_code,
+            media_type=response.media_type,
+            headers={"Idempotent-Replayed": "true"},
         )
+    return response
 
-        bot_response = result.get("response")
 
-        logging.info(bot_response)
+async def chat_turn(chat_request: ChatRequest) -> JSONResponse:
+    """
+    Run one /chat turn: store the message, invoke the LLM, store the reply and
+    queue its audio.
+    """
+    try:
+        await upstream_limits.chat.acquire()
+    except Saturated as e:
+        return saturated_response(e)
+    try:
+        # Upstream calls get what is left of the turn's budget
+        start_deadline(CHAT_DEADLINE)
+        chatbot, _, stored = await load_chatbot(chat_request)
+
+        async with llm_slot(chat_request.model):
+            with stage("llm") as span:
+                # Hedged past the recent p95 when OPENAI_HEDGE=1. Attempts
+                # don't write to the chatbot's memory, only the winner is saved
+                async with deadline_scope():
+                    result = await openai_policy.attempt(
+                        lambda: ainvoke_response(chatbot, chat_request.message)
+                    )
+                span.add(characters=len(result.get("response") or ""))
+
+        bot_response = result.get("response")
+        log_response(chat_request, bot_response)
+        # The user's message was written while the LLM ran
+        await aconfirm_stored(stored)
 
+        # An empty reply is neither stored nor voiced
+        response_content = {"data": result, "timestamp": None, "audio_status": None}
         if bot_response:
+            save_response(chatbot, chat_request.message, bot_response)
             # pass the message back immediately
             bot_timestamp = current_epoch_time()
-            store_message(
-                chat_id=chat_request.chat_id,
-                timestamp=bot_timestamp,
-                message=bot_response,
-                message_type="ai",
-                audio_file_url=None,
-            )
+            await store_ai_message(chat_request, bot_timestamp, bot_response)
 
-            bot_audio = get_elevenlabs_audio(bot_response)
-            print(f"Type of audio: {type(bot_audio)}")
-            if bot_audio and isinstance(bot_audio, bytes):
-                # Proceed with uploading to S3
-                s3_file_name = generate_mp3_file_name()
-                print(f"s3 file name: {s3_file_name}")
-                # ChatID
-                upload_status = upload_audio_bytes_to_s3(
-                    audio_content=bot_audio,
-                    bucket="hippo-ai-audio",
-                    object_name=s3_file_name,
-                    metadata={
-                        "ContentType": "audio/mpeg",
-                        "x-amz-meta-chatid": chat_request.chat_id,
-                        # TROUBLESHOOTING: this has to be a string
-                        "x-amz-meta-timestamp": str(bot_timestamp),
-                    },
-                )
-                # TODO - create a new bucket for this project.
-                if upload_status:
-                    bot_response_audio = get_s3_link(
-                        file_name=s3_file_name, bucket_name="hippo-ai-audio"
-                    )
-                else:
-                    bot_response_audio = None
-
-                response_content = {
-                    "data": result,
-                    "audio_s3_upload": upload_status,
-                    "audio_link": bot_response_audio,
-                    "audio_file_name": s3_file_name,
-                }
-            else:
-                print("The response content is not bytes.")
-                response_content = {
-                    "data": result,
-                }
+            # Audio is generated in the background, poll /chat/audio for the link
+            audio_job = audio_jobs.submit(
+                chat_request.chat_id, bot_timestamp, bot_response
+            )
+            response_content = {
+                "data": result,
+                "timestamp": bot_timestamp,
+                "audio_status": audio_job.status,
+            }
 
-        response = JSONResponse(
+        return JSONResponse(
             content=response_content, status_code=status.HTTP_200_OK
         )
-
-        logging.info(response)
-
-        return response
+    except Saturated as e:
+        return saturated_response(e)
+    except DeadlineExceeded as e:
+        return deadline_response(e)
+    except MessageNotStored as e:
+        return JSONResponse(
+            content={"error": str(e), "retry_after": e.retry_after},
+            status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+            headers={"Retry-After": str(e.retry_after)},
+        )
     except Exception as e:
         logging.error(f"An error occurred: {str(e)}")
         return JSONResponse(
             content={"error": str(e)}, status_code=status.HTTP_500_INTERNAL_SERVER_ERROR
         )
+    finally:
+        upstream_limits.chat.release()
+
+
+def format_stream_event(event: str, data: dict, stream_format: str) -> str:
+    """
+    Encode one event for /chat/stream as a Server-Sent Event or an NDJSON line.
+    """
+    if stream_format == "ndjson":
+        return json.dumps({"event": event, **data}) + "\n"
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+
+async def stream_chat_events(
+    chat_request: ChatRequest, stream_format: str, audio_mode: str
+):
+    """
+    Yield the /chat/stream events: `token`* (interleaved with `audio`* when
+    `audio_mode` is "stream") then `done` (or `error`). With "skip" the reply
+    gets no audio.
+    """
+    try:
+        start_deadline(CHAT_DEADLINE)
+        chatbot, _, stored = await load_chatbot(chat_request)
+        tokens = astream_response(chatbot, chat_request.message)
+
+        bot_tokens = []
+        pipeline = None
+        if audio_mode == "stream":
+            # Sentences are synthesized while the rest of the reply is generated
+            pipeline = SentenceAudioPipeline()
+            audio_sequence = 0
+            async for kind, value in stream_text_and_audio(tokens, pipeline):
+                if kind == "token":
+                    bot_tokens.append(value)
+                    yield format_stream_event("token", {"token": value}, stream_format)
+                else:
+                    audio_data = {
+                        "sequence": audio_sequence,
+                        "audio": base64.b64encode(value).decode("ascii"),
+                    }
+                    audio_sequence += 1
+                    yield format_stream_event("audio", audio_data, stream_format)
+        else:
+            async for token in tokens:
+                bot_tokens.append(token)
+                yield format_stream_event("token", {"token": token}, stream_format)
+
+        bot_response = "".join(bot_tokens)
+        log_response(chat_request, bot_response)
+        await aconfirm_stored(stored)
+
+        done = {"response": bot_response}
+        if bot_response:
+            bot_timestamp = current_epoch_time()
+            await store_ai_message(chat_request, bot_timestamp, bot_response)
+            done["timestamp"] = bot_timestamp
+            if pipeline:
+                saved = None
+                if pipeline.audio and not pipeline.failed:
+                    s3_file_name = await tts_cache.store(
+                        bot_response,
+                        bytes(pipeline.audio),
+                        pipeline.optimize_streaming_latency,
+                    )
+                    if s3_file_name:
+                        audio_link = await attach_audio(
+                            chat_request.chat_id, bot_timestamp, s3_file_name
+                        )
+                        saved = s3_file_name, audio_link
+                elif pipeline.audio:
+                    # Partial audio (a sentence failed) is not shared
+                    saved = await save_audio(
+                        chat_request.chat_id, bot_timestamp, bytes(pipeline.audio)
+                    )
+                audio_file_name, audio_link = saved or (None, None)
+                done.update(
+                    audio_status=READY if saved and not pipeline.failed else FAILED,
+                    audio_link=audio_link,
+                    audio_file_name=audio_file_name,
+                )
+            elif audio_mode == "skip":
+                done.update(audio_status=SKIPPED, audio_link=None, audio_file_name=None)
+            else:
+                # The text is already streamed, so the stream can wait for the audio
+                audio_job = audio_jobs.submit(
+                    chat_request.chat_id, bot_timestamp, bot_response
+                )
+                await audio_jobs.wait(audio_job, timeout=AUDIO_STREAM_WAIT)
+                done.update(
+                    audio_status=audio_job.status,
+                    audio_link=audio_job.audio_link,
+                    audio_file_name=audio_job.audio_file_name,
+                )
+
+        yield format_stream_event("done", done, stream_format)
+    except (Saturated, MessageNotStored) as e:
+        error = {"error": str(e), "retry_after": e.retry_after}
+        yield format_stream_event("error", error, stream_format)
+    except DeadlineExceeded as e:
+        yield format_stream_event("error", {"error": str(e)}, stream_format)
+    except Exception as e:
+        logging.error(f"An error occurred while streaming: {str(e)}")
+        yield format_stream_event("error", {"error": str(e)}, stream_format)
+
+
+@app.post("/chat/stream")
+async def stream_chat_response(
+    chat_request: ChatRequest,
+    format: Literal["sse", "ndjson"] = "sse",
+    audio: Literal["job", "stream"] = "job",
+):
+    """
+    Streaming variant of /chat: tokens are sent as the LLM produces them.
+
+    `?format=sse` (default) sends Server-Sent Events, `?format=ndjson` sends one
+    JSON object per line. The last event is `done`, carrying the full response,
+    its stored timestamp and the audio link (or `error` if the turn failed).
+
+    With `?audio=stream` each sentence is synthesized as soon as it is complete
+    and its MP3 bytes are sent in order as base64 `audio` events, overlapping
+    with the LLM. The full clip is then uploaded to S3 as one object.
+
+    Turns over the admission limits get a 503 (or 429) with `Retry-After`.
+    When ElevenLabs is saturated (or failing, see api/resilience.py) the reply
+    is sent without audio, its `done` event has `audio_status` "skipped".
+    """
+    # Admission is decided before the stream starts, so it can still be a 503
+    try:
+        await upstream_limits.chat.acquire()
+    except Saturated as e:
+        return saturated_response(e)
+    if audio == "stream" and (
+        elevenlabs_policy.breaker.is_open() or not upstream_limits.elevenlabs.has_capacity()
+    ):
+        audio = "skip"
+
+    media_type = "application/x-ndjson" if format == "ndjson" else "text/event-stream"
+    return StreamingResponse(
+        stream_chat_events(chat_request, format, audio),
+        media_type=media_type,
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+        # Runs once the stream ended, also when the client went away
+        background=BackgroundTask(upstream_limits.chat.release),
+    )
+
+
+@app.websocket("/chat/ws")
+async def chat_websocket(websocket: WebSocket):
+    """
+    A chat session over a WebSocket: the history is loaded and the chatbot
+    built once, then each message frame streams back `token` events, `done`
+    and later an `audio` event. See api/chat_sessions.py for the protocol.
+    """
+    await chat_sessions.serve(websocket)
+
+
+@app.get("/chat/audio/{chat_id}/{timestamp}")
+async def get_chat_audio(chat_id: str, timestamp: int, wait: float = 0):
+    """
+    Status of the audio for the AI message at `timestamp`: pending, ready or failed.
+
+    Pass `?wait=<seconds>` to long-poll until the audio is finished (capped at
+    AUDIO_POLL_MAX_WAIT).
+    """
+    audio_job = audio_jobs.get(chat_id, timestamp)
+    if audio_job:
+        if wait > 0:
+            await audio_jobs.wait(audio_job, timeout=min(wait, AUDIO_POLL_MAX_WAIT))
+        return JSONResponse(content=audio_job.to_dict(), status_code=status.HTTP_200_OK)
+
+    # Not generated by this worker (or since a restart), fall back to the table
+    item = await aget_message(chat_id, timestamp)
+    if not item:
+        return JSONResponse(
+            content={"error": "Message not found"},
+            status_code=status.HTTP_404_NOT_FOUND,
+        )
+    audio_file_name = item.get("AudioFileURL")
+    audio_link = None
+    if audio_file_name:
+        audio_link = await aget_s3_link(
+            file_name=audio_file_name, bucket_name=AUDIO_BUCKET
+        )
+    return JSONResponse(
+        content={
+            "chat_id": chat_id,
+            "timestamp": timestamp,
+            "status": READY if audio_file_name else PENDING,
+            "audio_link": audio_link,
+            "audio_file_name": audio_file_name,
+            "error": None,
+        },
+        status_code=status.HTTP_200_OK,
+    )
+
+
+@app.get("/metrics")
+def get_metrics():
+    """
+    Stage latency and size histograms, and the counters of the /metrics/*
+    endpoints, in the Prometheus text format.
+    """
+    return PlainTextResponse(
+        render_prometheus(), media_type="text/plain; version=0.0.4; charset=utf-8"
+    )
+
+
+@app.get("/metrics/admission")
+def get_admission_metrics():
+    """
+    In-flight, queued and rejected calls of the admission gate and of each
+    upstream limiter.
+    """
+    return JSONResponse(content=upstream_limits.metrics(), status_code=status.HTTP_200_OK)
+
+
+@app.get("/metrics/resilience")
+def get_resilience_metrics():
+    """
+    Retries, hedges, deadline overruns, recent latency and circuit breaker
+    state of the ElevenLabs and OpenAI calls.
+    """
+    return JSONResponse(content=resilience_metrics(), status_code=status.HTTP_200_OK)
+
+
+@app.get("/metrics/idempotency")
+def get_idempotency_metrics():
+    """
+    /chat turns computed, coalesced with a running duplicate and replayed.
+    """
+    return JSONResponse(content=idempotent_turns.metrics(), status_code=status.HTTP_200_OK)
+
+
+@app.get("/metrics/logging")
+def get_logging_metrics():
+    """
+    Log records waiting to be written, and dropped while the queue was full.
+    """
+    return JSONResponse(content=logging_metrics(), status_code=status.HTTP_200_OK)
+
+
+@app.get("/metrics/clients")
+def get_client_metrics():
+    """
+    Pool metrics for each shared upstream client.
+    """
+    return JSONResponse(content=get_clients().metrics(), status_code=status.HTTP_200_OK)
+
+
+@app.get("/metrics/chat-sessions")
+def get_chat_session_metrics():
+    """
+    Live, opened, idle-closed and rejected WebSocket chat sessions.
+    """
+    return JSONResponse(content=chat_sessions.metrics(), status_code=status.HTTP_200_OK)
+
+
+@app.get("/metrics/message-writer")
+def get_message_writer_metrics():
+    """
+    Items and BatchWriteItem calls of the write-behind message queue.
+    """
+    return JSONResponse(content=message_writer.metrics(), status_code=status.HTTP_200_OK)
+
+
+@app.get("/metrics/tts-cache")
+def get_tts_cache_metrics():
+    """
+    Hit rate and ElevenLabs characters saved by the TTS audio cache.
+    """
+    return JSONResponse(content=tts_cache.metrics(), status_code=status.HTTP_200_OK)
+
+
+@app.get("/metrics/presign")
+def get_presign_metrics():
+    """
+    Hit rate and size of the presigned audio link cache.
+    """
+    return JSONResponse(content=presigned_urls.metrics(), status_code=status.HTTP_200_OK)
+
+
+@app.get("/metrics/conversation-cache")
+def get_conversation_cache_metrics():
+    """
+    Hit rate, size and evictions of the in-process conversation cache.
+    """
+    return JSONResponse(
+        content=conversation_cache.metrics(), status_code=status.HTTP_200_OK
+    )
+
+
+def message_to_json(item) -> dict:
+    """
+    Make a stored message JSON serializable (DynamoDB numbers are Decimals).
+    """
+    return {
+        key: int(value) if isinstance(value, Decimal) else value
+        for key, value in item.items()
+    }
+
+
+def messages_etag(
+    messages_request: ChatMessagesRequest,
+    response_format: str,
+    latest,
+    audio_links: bool = False,
+) -> str:
+    """
+    ETag of a /chat/messages response, from the chat's newest messages.
+
+    A chat only changes by gaining messages or by a recent reply getting its
+    audio, so the timestamps and audio of the two newest messages (the reply
+    and the user's next message) identify its state. With audio links the tag
+    also changes every `presigned_urls.refresh_period()` seconds, so a
+    revalidated page never holds links about to expire.
+    """
+    state = [(int(item["timestamp"]), item.get("AudioFileURL")) for item in latest]
+    request = [
+        messages_request.chat_id,
+        messages_request.before,
+        messages_request.after,
+        messages_request.limit,
+        response_format,
+    ]
+    if audio_links:
+        request.append(int(time.time() // presigned_urls.refresh_period()))
+    digest = hashlib.sha256(json.dumps([request, state]).encode()).hexdigest()
+    return f'W/"{digest[:32]}"'
+
+
+def etag_matches(if_none_match: Optional[str], etag: str) -> bool:
+    if not if_none_match:
+        return False
+    tags = [tag.strip() for tag in if_none_match.split(",")]
+    return "*" in tags or etag in tags
+
+
+async def add_audio_links(messages: list) -> list:
+    """
+    Set the presigned `audio_link` of each message (JSON dicts, see
+    `message_to_json`), None for those without audio. The page's links are
+    signed in one batch, see api/presign.py.
+    """
+    keys = [item["AudioFileURL"] for item in messages if item.get("AudioFileURL")]
+    links = await presigned_urls.aget_links(keys, AUDIO_BUCKET) if keys else {}
+    for item in messages:
+        item["audio_link"] = links.get(item.get("AudioFileURL"))
+    return messages
+
+
+async def export_messages(
+    messages_request: ChatMessagesRequest, page_size: int, audio_links: bool = False
+):
+    """
+    Yield a chat's messages oldest first as NDJSON lines, one page at a time.
+    """
+    cursor = messages_request.after if messages_request.after is not None else 0
+    while True:
+        page, more = await aget_messages_page(
+            messages_request.chat_id, after=cursor, limit=page_size
+        )
+        if messages_request.before is not None:
+            page = [item for item in page if item["timestamp"] < messages_request.before]
+        data = [message_to_json(item) for item in page]
+        if audio_links:
+            await add_audio_links(data)
+        for item in data:
+            yield json.dumps(item) + "\n"
+        if messages_request.before is not None and len(page) < page_size:
+            return
+        if not (more and page):
+            return
+        cursor = page[-1]["timestamp"]
 
 
 @app.post("/chat/messages")
-def get_chat_messages(messages_request: ChatMessagesRequest):
-    print(f" received messages request: {messages_request}")
-    messages = get_all_messages_for_chat(messages_request.chat_id)
-    # Convert messages to JSON serializable format using jsonable_encoder
-    messages_json = jsonable_encoder(messages)
-    logging.info(f"messages: {messages_json}")
-    return JSONResponse(content={"data": messages_json}, status_code=status.HTTP_200_OK)
+async def get_chat_messages(
+    messages_request: ChatMessagesRequest,
+    format: Literal["json", "ndjson"] = "json",
+    audio_links: bool = False,
+    if_none_match: Optional[str] = Header(None),
+):
+    """
+    A chat's messages, in chronological order.
+
+    Paginated with `limit` and a cursor: `after` (the oldest messages newer than
+    it, e.g. the newest timestamp the client has) or `before` (the newest
+    messages older than it, to scroll back). `next_cursor` is the cursor of the
+    next page in the same direction, or null on the last page. Without a cursor
+    or limit the whole chat is returned, as before.
+
+    `?format=ndjson` streams every message (from `after`, up to `before`) as
+    one JSON object per line, reading the chat a page at a time.
+
+    With `?audio_links=true` every message gets an `audio_link`: the presigned
+    link to its `AudioFileURL` (null without audio), signed for the whole page
+    at once and cached, see api/presign.py.
+
+    Responses carry an ETag of the chat's state; polling with `If-None-Match`
+    gets a 304 without reading the page.
+    """
+    log_event(
+        logging.INFO,
+        "messages_request",
+        chat_id=messages_request.chat_id,
+        limit=messages_request.limit,
+        before=messages_request.before,
+        after=messages_request.after,
+    )
+    chat_id = messages_request.chat_id
+    limit = min(messages_request.limit or MESSAGES_PAGE_MAX, MESSAGES_PAGE_MAX)
+
+    latest, _ = await aget_messages_page(chat_id, limit=2)
+    etag = messages_etag(messages_request, format, latest, audio_links)
+    headers = {"ETag": etag, "Cache-Control": "no-cache"}
+    if etag_matches(if_none_match, etag):
+        return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers=headers)
+
+    if format == "ndjson":
+        return StreamingResponse(
+            export_messages(messages_request, limit, audio_links),
+            media_type="application/x-ndjson",
+            headers=headers,
+        )
+
+    paginated = (
+        messages_request.limit is not None
+        or messages_request.before is not None
+        or messages_request.after is not None
+    )
+    if not paginated:
+        messages = await aget_all_messages_for_chat(chat_id)
+        data = [message_to_json(item) for item in messages]
+        content = {"data": data}
+    else:
+        messages, more = await aget_messages_page(
+            chat_id, messages_request.before, messages_request.after, limit
+        )
+        next_cursor = None
+        if more and messages:
+            if messages_request.after is not None:
+                next_cursor = {"after": int(messages[-1]["timestamp"])}
+            else:
+                next_cursor = {"before": int(messages[0]["timestamp"])}
+        data = [message_to_json(item) for item in messages]
+        content = {"data": data, "next_cursor": next_cursor}
+    if audio_links:
+        await add_audio_links(data)
+    logging.info(f"Returning {len(messages)} messages of {chat_id}")
+    return JSONResponse(content=content, status_code=status.HTTP_200_OK, headers=headers)
 
 
 """
@@ -0,0 +1,92 @@
+import argparse
+import logging
+import time
+
+from api.message_codec import (
+    MESSAGE_COMPRESS_MIN_BYTES,
+    available_codec,
+    decode_message,
+    encode_message,
+)
+from api.message_writer import batch_write_items
+from update_table import TABLE_NAME, get_table
+
+"""
+Rewrite the stored messages of the `ChatMessages` table with a message codec
+(see api/message_codec.py).
+
+Scans the table page by page and re-encodes every message body: with
+`--codec zlib` (or zstd) large plain messages are compressed, with
+`--codec none` compressed messages are written back as plain strings.
+Messages newer than `--min-age` seconds are skipped, so the rewrite doesn't
+race with a just stored reply getting its AudioFileURL.
+
+Usage:
+```
+python migrate_messages.py --codec zlib --dry-run
+python migrate_messages.py --codec zlib
+```
+"""
+
+# Items read per Scan call
+SCAN_PAGE_SIZE = 500
+
+
+def migrate(codec, min_bytes=MESSAGE_COMPRESS_MIN_BYTES, min_age=3600, dry_run=False):
+    """
+    Re-encode every stored message with `codec`.
+
+    Returns
+    -------
+    A dict of counts: items scanned, rewritten, failed, and message bytes
+    before and after.
+    """
+    codec = available_codec(codec)
+    newest = int(time.time()) - min_age
+    stats = {"scanned": 0, "rewritten": 0, "failed": 0, "bytes_before": 0, "bytes_after": 0}
+    scan = {"Limit": SCAN_PAGE_SIZE}
+    while True:
+        response = get_table().scan(**scan)
+        rewrites = []
+        for item in response["Items"]:
+            stats["scanned"] += 1
+            message = item.get("message")
+            if message is None or item["timestamp"] > newest:
+                continue
+            stored = message.value if hasattr(message, "value") else message
+            encoded = encode_message(decode_message(message), codec, min_bytes)
+            if encoded == stored:
+                continue
+            stats["bytes_before"] += _size(stored)
+            stats["bytes_after"] += _size(encoded)
+            rewrites.append({**item, "message": encoded})
+
+        stats["rewritten"] += len(rewrites)
+        if rewrites and not dry_run:
+            stats["failed"] += len(batch_write_items(TABLE_NAME, rewrites))
+        logging.info(f"Migration progress: {stats}")
+
+        if "LastEvaluatedKey" not in response:
+            return stats
+        scan["ExclusiveStartKey"] = response["LastEvaluatedKey"]
+
+
+def _size(value) -> int:
+    return len(value.encode("utf-8")) if isinstance(value, str) else len(value)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Re-encode stored chat messages")
+    parser.add_argument("--codec", choices=["none", "zlib", "zstd"], required=True)
+    parser.add_argument("--min-bytes", type=int, default=MESSAGE_COMPRESS_MIN_BYTES)
+    parser.add_argument("--min-age", type=int, default=3600)
+    parser.add_argument("--dry-run", action="store_true")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+
+    stats = migrate(args.codec, args.min_bytes, args.min_age, args.dry_run)
+    print(
+        f"{'Would rewrite' if args.dry_run else 'Rewrote'} {stats['rewritten']} of "
+        f"{stats['scanned']} items ({stats['failed']} failed), message bytes "
+        f"{stats['bytes_before']} -> {stats['bytes_after']}"
+    )
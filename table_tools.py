@@ -0,0 +1,439 @@
+import argparse
+import base64
+import datetime
+import gzip
+import io
+import json
+import logging
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from decimal import Decimal
+from urllib.parse import quote
+
+from boto3.dynamodb.conditions import Key
+from boto3.dynamodb.types import Binary
+
+from api.admission import TokenBucket, dynamodb_read_units, dynamodb_write_units
+from api.audio import AUDIO_BUCKET
+from api.clients import get_clients
+from api.message_codec import decode_item, encode_item
+from api.message_writer import BATCH_WRITE_MAX_ITEMS, batch_delete_items, batch_write_items
+from update_table import TABLE_NAME, get_table
+
+try:
+    import zstandard
+except ImportError:  # optional, `pip install zstandard`
+    zstandard = None
+
+"""
+Bulk export, import and archival of the `ChatMessages` table.
+
+- export: a parallel segmented Scan (`--segments` workers, each reading its
+  own slice of the table) into one compressed NDJSON file per segment, plus a
+  manifest.json. Files are zstd-compressed (gzip when zstandard isn't
+  installed), one flat JSON object per item with the message as text.
+- import: the files of an export, read in parallel and written back with
+  BatchWriteItem; messages are stored with the current MESSAGE_CODEC.
+- archive: chats without a message since `--older-than` days are written to
+  S3 (one compressed NDJSON object per chat), then deleted from the table.
+  Only the archived items are deleted, a message stored meanwhile stays.
+
+Reads and writes are paced against a capacity budget (`--read-units`,
+`--write-units` per second, shared by every worker), so a bulk job doesn't
+take the provisioned capacity the service needs. The budget is this
+process's own, separate from the server's DYNAMODB_*_UNITS_PER_SECOND.
+
+Usage:
+```
+python table_tools.py export exports/2024-06-01 --segments 8 --read-units 100
+python table_tools.py import exports/2024-06-01 --workers 4 --write-units 50
+python table_tools.py archive --older-than 180 --dry-run
+python table_tools.py archive --older-than 180 --bucket my-archive
+```
+"""
+
+# Parallel Scan segments (and threads) of an export or archive scan
+SCAN_SEGMENTS = int(os.getenv("SCAN_SEGMENTS", "8"))
+# Items read per Scan call (DynamoDB also ends a page at 1 MB)
+SCAN_PAGE_SIZE = 1000
+# Capacity units per second a bulk job may use (0: unlimited)
+BULK_READ_UNITS_PER_SECOND = float(os.getenv("BULK_READ_UNITS_PER_SECOND", "0"))
+BULK_WRITE_UNITS_PER_SECOND = float(os.getenv("BULK_WRITE_UNITS_PER_SECOND", "0"))
+# Bucket and prefix archived chats are written to
+ARCHIVE_BUCKET = os.getenv("ARCHIVE_BUCKET", AUDIO_BUCKET)
+ARCHIVE_PREFIX = os.getenv("ARCHIVE_PREFIX", "archive/chats/")
+ZSTD_LEVEL = 3
+GZIP_LEVEL = 6
+
+MANIFEST = "manifest.json"
+
+
+class CapacityBudget:
+    """
+    Capacity units per second shared by the workers of a bulk job, or no limit.
+    """
+
+    def __init__(self, units_per_second: float):
+        # A second of units may be spent at once
+        self.bucket = TokenBucket(units_per_second) if units_per_second else None
+        self.units = 0.0
+        self.wait_seconds = 0.0
+        self._lock = threading.Lock()
+
+    def spend(self, units: float):
+        """
+        Take `units`, sleeping while the budget is in debt.
+        """
+        wait = self.bucket.reserve(units) if self.bucket is not None else 0.0
+        with self._lock:
+            self.units += units
+            self.wait_seconds += wait
+        if wait:
+            time.sleep(wait)
+
+
+def compression() -> str:
+    return "zstd" if zstandard is not None else "gzip"
+
+
+def compress(data: bytes, codec: str) -> bytes:
+    if codec == "zstd":
+        return zstandard.ZstdCompressor(level=ZSTD_LEVEL).compress(data)
+    return gzip.compress(data, GZIP_LEVEL)
+
+
+def open_writer(path: str, codec: str):
+    """
+    A text file writing `codec`-compressed UTF-8 to `path`.
+    """
+    if codec == "zstd":
+        raw = zstandard.ZstdCompressor(level=ZSTD_LEVEL).stream_writer(open(path, "wb"))
+        return io.TextIOWrapper(raw, encoding="utf-8")
+    return gzip.open(path, "wt", encoding="utf-8", compresslevel=GZIP_LEVEL)
+
+
+def open_reader(path: str):
+    """
+    A text file reading an export file, compressed with zstd or gzip.
+    """
+    if path.endswith(".zst"):
+        if zstandard is None:
+            raise RuntimeError("Reading zstd-compressed exports needs `pip install zstandard`")
+        raw = zstandard.ZstdDecompressor().stream_reader(open(path, "rb"))
+        return io.TextIOWrapper(raw, encoding="utf-8")
+    return gzip.open(path, "rt", encoding="utf-8")
+
+
+def _json_value(value):
+    if isinstance(value, Decimal):
+        return int(value) if value == value.to_integral_value() else float(value)
+    if isinstance(value, (Binary, bytes, bytearray)):
+        raw = value.value if isinstance(value, Binary) else bytes(value)
+        return {"$binary": base64.b64encode(raw).decode("ascii")}
+    raise TypeError(f"Can't export a {type(value).__name__}")
+
+
+def _item_value(value):
+    if "$binary" in value:
+        return Binary(base64.b64decode(value["$binary"]))
+    return value
+
+
+def dump_item(item) -> str:
+    """
+    One NDJSON line of a table item, with its message as text.
+    """
+    return json.dumps(decode_item(item), default=_json_value, ensure_ascii=False)
+
+
+def load_item(line: str):
+    """
+    The item to write back of an NDJSON line, its message encoded with the
+    current MESSAGE_CODEC.
+    """
+    item = json.loads(line, parse_float=Decimal, object_hook=_item_value)
+    return encode_item(item)
+
+
+def scan_segment(segment: int, total_segments: int, budget: CapacityBudget, **scan):
+    """
+    Yield the pages (lists of items) of one segment of a parallel Scan.
+    """
+    scan = {
+        "Segment": segment,
+        "TotalSegments": total_segments,
+        "Limit": SCAN_PAGE_SIZE,
+        "ReturnConsumedCapacity": "TOTAL",
+        **scan,
+    }
+    while True:
+        response = get_table().scan(**scan)
+        # Paid after the fact, the next page waits while the budget is in debt
+        budget.spend(dynamodb_read_units(response))
+        yield response["Items"]
+        if "LastEvaluatedKey" not in response:
+            return
+        scan["ExclusiveStartKey"] = response["LastEvaluatedKey"]
+
+
+def _parallel(function, args, workers: int):
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="table-tools") as pool:
+        return list(pool.map(function, args))
+
+
+def export_table(directory: str, segments: int = SCAN_SEGMENTS, read_units: float = 0):
+    """
+    Export the table into `directory`, one compressed NDJSON file per Scan
+    segment, the segments scanned in parallel.
+
+    Returns
+    -------
+    The manifest: the files with their item counts, and totals.
+    """
+    os.makedirs(directory, exist_ok=True)
+    codec = compression()
+    extension = "zst" if codec == "zstd" else "gz"
+    budget = CapacityBudget(read_units)
+    start = time.monotonic()
+
+    def export_segment(segment):
+        name = f"{TABLE_NAME}-{segment:05d}-of-{segments:05d}.ndjson.{extension}"
+        items = 0
+        with open_writer(os.path.join(directory, name), codec) as file:
+            for page in scan_segment(segment, segments, budget):
+                file.writelines(dump_item(item) + "\n" for item in page)
+                items += len(page)
+        logging.info(f"Exported segment {segment}: {items} items")
+        return {"name": name, "items": items}
+
+    files = _parallel(export_segment, range(segments), segments)
+    manifest = {
+        "table": TABLE_NAME,
+        "exported_at": datetime.datetime.now(datetime.timezone.utc).isoformat(),
+        "format": "ndjson",
+        "compression": codec,
+        "segments": segments,
+        "items": sum(file["items"] for file in files),
+        "read_units": round(budget.units, 1),
+        "seconds": round(time.monotonic() - start, 2),
+        "files": files,
+    }
+    with open(os.path.join(directory, MANIFEST), "w") as file:
+        json.dump(manifest, file, indent=2)
+    return manifest
+
+
+def import_table(directory: str, workers: int = 4, write_units: float = 0):
+    """
+    Write the items of an export back into the table, the files read in
+    parallel, BatchWriteItem calls paced by `write_units` per second.
+
+    Returns
+    -------
+    A dict of counts: items written and failed, and write units spent.
+    """
+    with open(os.path.join(directory, MANIFEST)) as file:
+        manifest = json.load(file)
+    budget = CapacityBudget(write_units)
+    start = time.monotonic()
+
+    def write(batch):
+        budget.spend(sum(dynamodb_write_units("PutItem", {"Item": item}) for item in batch))
+        return len(batch_write_items(TABLE_NAME, batch))
+
+    def import_file(entry):
+        written = failed = 0
+        batch = []
+        with open_reader(os.path.join(directory, entry["name"])) as file:
+            for line in file:
+                batch.append(load_item(line))
+                if len(batch) == BATCH_WRITE_MAX_ITEMS:
+                    failed += write(batch)
+                    written += len(batch)
+                    batch = []
+        if batch:
+            failed += write(batch)
+            written += len(batch)
+        logging.info(f"Imported {entry['name']}: {written} items, {failed} failed")
+        return written, failed
+
+    counts = _parallel(import_file, manifest["files"], workers)
+    return {
+        "items": sum(written for written, _ in counts) - sum(failed for _, failed in counts),
+        "failed": sum(failed for _, failed in counts),
+        "write_units": round(budget.units, 1),
+        "seconds": round(time.monotonic() - start, 2),
+    }
+
+
+def stale_chats(cutoff: int, segments: int, budget: CapacityBudget) -> list:
+    """
+    The chats whose newest message is older than `cutoff` (epoch seconds).
+    """
+    newest = {}
+    lock = threading.Lock()
+
+    def scan(segment):
+        for page in scan_segment(
+            segment,
+            segments,
+            budget,
+            ProjectionExpression="ChatID, #ts",
+            ExpressionAttributeNames={"#ts": "timestamp"},
+        ):
+            with lock:
+                for item in page:
+                    chat_id = item["ChatID"]
+                    newest[chat_id] = max(newest.get(chat_id, 0), item["timestamp"])
+
+    _parallel(scan, range(segments), segments)
+    return sorted(chat_id for chat_id, timestamp in newest.items() if timestamp < cutoff)
+
+
+def chat_items(chat_id: str, budget: CapacityBudget) -> list:
+    """
+    Every item of a chat (its messages and summary), oldest first.
+    """
+    items = []
+    query = {"KeyConditionExpression": Key("ChatID").eq(chat_id), "ReturnConsumedCapacity": "TOTAL"}
+    while True:
+        response = get_table().query(**query)
+        budget.spend(dynamodb_read_units(response))
+        items.extend(response["Items"])
+        if "LastEvaluatedKey" not in response:
+            return items
+        query["ExclusiveStartKey"] = response["LastEvaluatedKey"]
+
+
+def archive_chats(
+    older_than_days: float,
+    bucket: str = ARCHIVE_BUCKET,
+    prefix: str = ARCHIVE_PREFIX,
+    segments: int = SCAN_SEGMENTS,
+    workers: int = 4,
+    read_units: float = 0,
+    write_units: float = 0,
+    dry_run: bool = False,
+):
+    """
+    Move the chats without a message in `older_than_days` days to S3: each
+    chat is written as one compressed NDJSON object, and its items deleted
+    once the upload succeeded.
+
+    Returns
+    -------
+    A dict of counts: chats and items archived, items not deleted, chats
+    that could not be uploaded (and were kept), bytes uploaded, and capacity
+    units spent.
+    """
+    cutoff = int(time.time() - older_than_days * 86400)
+    codec = compression()
+    extension = "zst" if codec == "zstd" else "gz"
+    reads = CapacityBudget(read_units)
+    writes = CapacityBudget(write_units)
+    stats = {"chats": 0, "items": 0, "failed": 0, "upload_failed": 0, "bytes": 0}
+    lock = threading.Lock()
+    start = time.monotonic()
+
+    chats = stale_chats(cutoff, segments, reads)
+    logging.info(f"{len(chats)} chats without messages since {cutoff}")
+
+    def archive(chat_id):
+        items = chat_items(chat_id, reads)
+        if not items:
+            return
+        body = compress("".join(dump_item(item) + "\n" for item in items).encode("utf-8"), codec)
+        failed = 0
+        if not dry_run:
+            try:
+                get_clients().s3.put_object(
+                    Bucket=bucket,
+                    Key=f"{prefix}{quote(chat_id, safe='')}.ndjson.{extension}",
+                    Body=body,
+                    ContentType="application/x-ndjson",
+                    ContentEncoding=codec,
+                )
+            except Exception as e:
+                # Not deleted, the next run archives it again
+                logging.error(f"Could not archive chat {chat_id}: {str(e)}")
+                with lock:
+                    stats["upload_failed"] += 1
+                return
+            # Only what was archived: a message stored since then stays
+            writes.spend(sum(dynamodb_write_units("DeleteItem", {"Item": item}) for item in items))
+            keys = [{"ChatID": item["ChatID"], "timestamp": item["timestamp"]} for item in items]
+            failed = len(batch_delete_items(TABLE_NAME, keys))
+        with lock:
+            stats["chats"] += 1
+            stats["items"] += len(items)
+            stats["failed"] += failed
+            stats["bytes"] += len(body)
+            if stats["chats"] % 100 == 0:
+                logging.info(f"Archive progress: {stats}")
+
+    _parallel(archive, chats, workers)
+    return {
+        **stats,
+        "read_units": round(reads.units, 1),
+        "write_units": round(writes.units, 1),
+        "seconds": round(time.monotonic() - start, 2),
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Bulk tools for the ChatMessages table")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    export_parser = commands.add_parser("export", help="Export the table to compressed NDJSON")
+    export_parser.add_argument("directory")
+    export_parser.add_argument("--segments", type=int, default=SCAN_SEGMENTS)
+    export_parser.add_argument("--read-units", type=float, default=BULK_READ_UNITS_PER_SECOND)
+
+    import_parser = commands.add_parser("import", help="Write an export back to the table")
+    import_parser.add_argument("directory")
+    import_parser.add_argument("--workers", type=int, default=4)
+    import_parser.add_argument("--write-units", type=float, default=BULK_WRITE_UNITS_PER_SECOND)
+
+    archive_parser = commands.add_parser("archive", help="Move old chats to S3")
+    archive_parser.add_argument("--older-than", type=float, required=True, help="Days")
+    archive_parser.add_argument("--bucket", default=ARCHIVE_BUCKET)
+    archive_parser.add_argument("--prefix", default=ARCHIVE_PREFIX)
+    archive_parser.add_argument("--segments", type=int, default=SCAN_SEGMENTS)
+    archive_parser.add_argument("--workers", type=int, default=4)
+    archive_parser.add_argument("--read-units", type=float, default=BULK_READ_UNITS_PER_SECOND)
+    archive_parser.add_argument("--write-units", type=float, default=BULK_WRITE_UNITS_PER_SECOND)
+    archive_parser.add_argument("--dry-run", action="store_true")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+
+    if args.command == "export":
+        manifest = export_table(args.directory, args.segments, args.read_units)
+        print(
+            f"Exported {manifest['items']} items into {len(manifest['files'])} files "
+            f"in {manifest['seconds']}s ({manifest['read_units']} read units)"
+        )
+    elif args.command == "import":
+        stats = import_table(args.directory, args.workers, args.write_units)
+        print(
+            f"Imported {stats['items']} items ({stats['failed']} failed) "
+            f"in {stats['seconds']}s ({stats['write_units']} write units)"
+        )
+    else:
+        stats = archive_chats(
+            args.older_than,
+            args.bucket,
+            args.prefix,
+            args.segments,
+            args.workers,
+            args.read_units,
+            args.write_units,
+            args.dry_run,
+        )
+        print(
+            f"{'Would archive' if args.dry_run else 'Archived'} {stats['chats']} chats, "
+            f"{stats['items']} items ({stats['failed']} not deleted, "
+            f"{stats['upload_failed']} chats not uploaded), "
+            f"{stats['bytes']} bytes in {stats['seconds']}s"
+        )
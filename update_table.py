@@ -1,12 +1,45 @@
+from concurrent.futures import Future
 from datetime import datetime
+import os
 import time
-import boto3
 import logging
+import asyncio
 from decimal import Decimal
 
-# Initialize a DynamoDB client
-dynamodb = boto3.resource("dynamodb", region_name="us-west-2")
-table = dynamodb.Table("ChatMessages")
+from api.aio import run_blocking
+from api.clients import get_clients
+from api.conversation_cache import CONVERSATION_CACHE_VERIFY, conversation_cache
+from api.logs import log_event
+from api.message_codec import decode_item, encode_item
+from api.message_writer import WriteBehindQueue, batch_write_items
+from api.tokens import count_message_tokens
+
+TABLE_NAME = "ChatMessages"
+# Prompt tokens of chat history sent to the LLM each turn
+HISTORY_TOKEN_BUDGET = int(os.getenv("HISTORY_TOKEN_BUDGET", "3000"))
+# Messages read per Query when loading recent history
+HISTORY_PAGE_SIZE = 20
+# Most messages returned per /chat/messages page
+MESSAGES_PAGE_MAX = 500
+# Sort key of a chat's summary item (see api/summary_memory.py), below every message
+SUMMARY_TIMESTAMP = 0
+# "write-behind" queues messages and batches them (see api/message_writer.py),
+# "sync" writes each message with its own PutItem on the request path
+MESSAGE_WRITES = os.getenv("MESSAGE_WRITES", "write-behind")
+
+
+def _drop_unwritten(items):
+    # The cached chats have messages the table doesn't, read them again
+    for chat_id in {item["ChatID"] for item in items}:
+        conversation_cache.invalidate(chat_id)
+
+
+message_writer = WriteBehindQueue(TABLE_NAME, on_failure=_drop_unwritten)
+
+
+def get_table():
+    """Return the shared `ChatMessages` table (see api/clients.py)."""
+    return get_clients().table(TABLE_NAME)
 
 
 def current_epoch_time():
@@ -25,60 +58,521 @@ def iso_to_epoch(timestamp):
         return int(dt.timestamp())
 
 
-def store_message(
-    chat_id, timestamp, message, message_type="user", audio_file_url=None
-):
-    epoch_time = iso_to_epoch(timestamp)
-
+def _message_item(chat_id, timestamp, message, message_type, audio_file_url):
     item = {
         "ChatID": str(chat_id),
-        "timestamp": epoch_time,
+        "timestamp": iso_to_epoch(timestamp),
         "message": message,
         "type": message_type,
     }
-    logging.info("========================")
-    logging.info(f"Creating item: {item}")
     # Add audio_file_url to the item if it's provided
     if audio_file_url:
         item["AudioFileURL"] = audio_file_url
+    return item
 
-    response = table.put_item(Item=item)
-    logging.info("========================")
-    logging.info(f"Item stored: {response}")
 
-    return response
+def _cache_stored(item):
+    # Write through, items read back from DynamoDB have Decimal numbers
+    conversation_cache.add_message(
+        item["ChatID"], {**item, "timestamp": Decimal(item["timestamp"])}
+    )
+
+
+def store_message(
+    chat_id,
+    timestamp,
+    message,
+    message_type="user",
+    audio_file_url=None,
+    durable=False,
+):
+    """
+    Store a chat message.
+
+    Unless `durable` is set (or MESSAGE_WRITES is "sync"), the message is
+    queued and written in a batch shortly after; reads of this module flush
+    the chat's queued messages first, so they always see it.
+
+    Returns
+    -------
+    The PutItem response, or for a queued message the future of its write
+    (see `aconfirm_stored`).
+    """
+    item = _message_item(chat_id, timestamp, message, message_type, audio_file_url)
+    log_event(
+        logging.DEBUG,
+        "store_message",
+        chat_id=chat_id,
+        timestamp=timestamp,
+        type=message_type,
+        characters=len(message),
+    )
+
+    if durable or MESSAGE_WRITES == "sync":
+        response = get_table().put_item(Item=encode_item(item))
+        _cache_stored(item)
+        return response
+
+    # Cached first: a failed write drops the chat from the cache again
+    _cache_stored(item)
+    return message_writer.put(encode_item(item))
+
+
+class MessageNotStored(Exception):
+    """
+    A queued message could not be written, see `aconfirm_stored`.
+    """
+
+    retry_after = 1
+
+
+async def aconfirm_stored(stored):
+    """
+    Wait until a message stored by `astore_message` is written.
+
+    Queued messages are written while the turn runs, so this rarely waits.
+    Raises `MessageNotStored` if the write failed, so the message isn't
+    acknowledged.
+    """
+    if isinstance(stored, Future) and not await asyncio.wrap_future(stored):
+        raise MessageNotStored("The message could not be stored, retry the turn")
+
+
+def store_messages(messages):
+    """
+    Store many chat messages at once, with BatchWriteItem calls of 25.
+
+    Parameters
+    ----------
+    messages: dicts with the arguments of `store_message` (`chat_id`,
+        `timestamp`, `message`, and optionally `message_type`, `audio_file_url`).
+
+    Returns
+    -------
+    The items that could not be written.
+    """
+    items = [
+        _message_item(
+            m["chat_id"],
+            m["timestamp"],
+            m["message"],
+            m.get("message_type", "user"),
+            m.get("audio_file_url"),
+        )
+        for m in messages
+    ]
+    failed = batch_write_items(TABLE_NAME, [encode_item(item) for item in items])
+    failed_keys = {(item["ChatID"], item["timestamp"]) for item in failed}
+    for item in items:
+        if (item["ChatID"], item["timestamp"]) not in failed_keys:
+            _cache_stored(item)
+    logging.info(f"Stored {len(items) - len(failed)} of {len(items)} messages")
+    return failed
+
+
+def flush_messages(chat_id=None, timeout=None):
+    """
+    Wait until the queued messages of `chat_id` (or all of them) are written.
+
+    Returns
+    -------
+    False if `timeout` seconds passed first, or if some of them could not be
+    written (see `WriteBehindQueue.flush`).
+    """
+    return message_writer.flush(chat_id, timeout)
+
+
+def _messages_of(chat_id, after_timestamp=SUMMARY_TIMESTAMP):
+    """Key condition for a chat's messages, excluding its summary item."""
+    # Imported on first use, like boto3 itself (see api/clients.py)
+    from boto3.dynamodb.conditions import Key
+
+    return Key("ChatID").eq(chat_id) & Key("timestamp").gt(after_timestamp)
+
+
+def _cached_chat(chat_id, complete=False):
+    """
+    The conversation cache's (messages, complete) of a chat, or None (also
+    when `complete` is set and only the newest messages are cached).
+
+    A hit is checked with a consistent Query of the chat's newest key: when
+    that key isn't cached, another worker wrote to the chat and it is dropped.
+    Messages of this worker still queued for writing are newer than the
+    table's newest, which is then cached all the same.
+    """
+    cached = conversation_cache.get(chat_id)
+    if complete and cached and not cached[1]:
+        return None
+    if not cached or not CONVERSATION_CACHE_VERIFY:
+        return cached
+    response = get_table().query(
+        KeyConditionExpression=_messages_of(chat_id),
+        ScanIndexForward=False,
+        Limit=1,
+        ConsistentRead=True,
+        ProjectionExpression="#ts",
+        ExpressionAttributeNames={"#ts": "timestamp"},
+    )
+    newest = response["Items"][0]["timestamp"] if response["Items"] else None
+    if newest is None or newest not in {item["timestamp"] for item in cached[0]}:
+        conversation_cache.drop_stale(chat_id)
+        return None
+    return cached
 
 
 def get_all_messages_for_chat(chat_id):
     """
     Retrieve chat messages from DynamoDB.
+
+    Follows `LastEvaluatedKey`, so chats over the 1 MB Query page are read in full.
+    Served from the conversation cache when the whole chat is cached.
+    """
+    cached = _cached_chat(chat_id, complete=True)
+    if cached:
+        return cached[0]
+    message_writer.flush(chat_id)
+
+    query = {
+        "KeyConditionExpression": _messages_of(chat_id),
+        # Make sure a message stored just before is read back
+        "ConsistentRead": True,
+    }
+    items = []
+    while True:
+        response = get_table().query(**query)
+        items.extend(decode_item(item) for item in response["Items"])
+        if "LastEvaluatedKey" not in response:
+            conversation_cache.put(chat_id, items, complete=True)
+            return items
+        query["ExclusiveStartKey"] = response["LastEvaluatedKey"]
+
+
+def _within_token_budget(items, model_name, token_budget):
+    """
+    Take messages (newest first) until the next one would go over `token_budget`.
+
+    Returns
+    -------
+    (the messages taken, whether the budget was filled)
+    """
+    messages = []
+    tokens_used = 0
+    for item in items:
+        tokens = count_message_tokens(item.get("message", ""), model_name)
+        if messages and tokens_used + tokens > token_budget:
+            return messages, True
+        tokens_used += tokens
+        messages.append(item)
+    return messages, False
+
+
+def get_recent_messages_for_chat(
+    chat_id,
+    model_name="gpt-3.5-turbo",
+    token_budget=HISTORY_TOKEN_BUDGET,
+    page_size=HISTORY_PAGE_SIZE,
+):
+    """
+    Retrieve the most recent chat messages that fit in a token budget.
+
+    Reads newest-first, `page_size` messages per Query, and stops as soon as
+    the next message would go over `token_budget` (counted with the model's
+    tokenizer). The newest message is always included.
+
+    Served from the conversation cache when the cached messages fill the
+    budget (or are the whole chat), otherwise the messages read are cached.
+
+    Returns
+    -------
+    The messages in chronological order, like `get_all_messages_for_chat`.
+    """
+    cached = _cached_chat(chat_id)
+    if cached:
+        items, complete = cached
+        messages, filled = _within_token_budget(
+            reversed(items), model_name, token_budget
+        )
+        if filled or complete:
+            messages.reverse()
+            return messages
+    message_writer.flush(chat_id)
+
+    query = {
+        "KeyConditionExpression": _messages_of(chat_id),
+        "ScanIndexForward": False,
+        "Limit": page_size,
+        # Make sure a message stored just before is read back
+        "ConsistentRead": True,
+    }
+    items = []
+    while True:
+        response = get_table().query(**query)
+        items.extend(decode_item(item) for item in response["Items"])
+        messages, filled = _within_token_budget(items, model_name, token_budget)
+        complete = "LastEvaluatedKey" not in response
+        if filled or complete:
+            conversation_cache.put(chat_id, items[::-1], complete=complete)
+            messages.reverse()
+            return messages
+        query["ExclusiveStartKey"] = response["LastEvaluatedKey"]
+
+
+def get_messages_after(chat_id, after_timestamp, limit, oldest_first=False):
+    """
+    Retrieve up to `limit` of the newest (or with `oldest_first`, the oldest)
+    messages stored after `after_timestamp`.
+
+    Returns
+    -------
+    (the messages in chronological order, whether older ones were left out)
     """
-    response = table.query(
-        KeyConditionExpression=boto3.dynamodb.conditions.Key("ChatID").eq(chat_id)
+    cached = _cached_chat(chat_id)
+    if cached:
+        items, complete = cached
+        if complete or (items and items[0]["timestamp"] <= after_timestamp):
+            items = [item for item in items if item["timestamp"] > after_timestamp]
+            page = items[:limit] if oldest_first else items[-limit:]
+            return page, len(items) > limit
+    message_writer.flush(chat_id)
+
+    response = get_table().query(
+        KeyConditionExpression=_messages_of(chat_id, after_timestamp),
+        ScanIndexForward=oldest_first,
+        # One extra to know whether there are more
+        Limit=limit + 1,
+        ConsistentRead=True,
     )
-    return response["Items"]
+    items = [decode_item(item) for item in response["Items"][:limit]]
+    truncated = len(response["Items"]) > limit
+    return (items if oldest_first else items[::-1]), truncated
 
 
-# Insert a sample conversation
-if __name__ == "__main__":
-    # For testing
-    store_message(
-        "9000", "2024-03-18T12:00:00Z", "Hi, your name is Bobby. I'm Shawn.", "user"
+def get_messages_page(chat_id, before=None, after=None, limit=MESSAGES_PAGE_MAX):
+    """
+    Retrieve one page of a chat's messages, next to a cursor (a message timestamp).
+
+    With `after`, returns the oldest messages newer than it (to poll for new
+    messages or export a chat in order). Otherwise returns the newest messages
+    older than `before`, or the newest of the chat when `before` is None (to
+    scroll back through history).
+
+    The cursor is part of the Query's key condition, so a page only reads
+    the items it returns.
+
+    Returns
+    -------
+    (the messages in chronological order, whether there are more past the page)
+    """
+    oldest_first = after is not None
+    cached = _cached_chat(chat_id, complete=True)
+    if cached:
+        items = cached[0]
+        if oldest_first:
+            items = [item for item in items if item["timestamp"] > after]
+            return items[:limit], len(items) > limit
+        if before is not None:
+            items = [item for item in items if item["timestamp"] < before]
+        return items[-limit:], len(items) > limit
+    message_writer.flush(chat_id)
+
+    if oldest_first:
+        condition = _messages_of(chat_id, max(int(after), SUMMARY_TIMESTAMP))
+    elif before is not None:
+        if int(before) <= SUMMARY_TIMESTAMP + 1:
+            return [], False
+        from boto3.dynamodb.conditions import Key
+
+        # One condition per sort key: the messages between the summary and `before`
+        condition = Key("ChatID").eq(chat_id) & Key("timestamp").between(
+            SUMMARY_TIMESTAMP + 1, int(before) - 1
+        )
+    else:
+        condition = _messages_of(chat_id)
+    response = get_table().query(
+        KeyConditionExpression=condition,
+        ScanIndexForward=oldest_first,
+        # One extra to know whether there are more
+        Limit=limit + 1,
+        ConsistentRead=True,
+    )
+    items = [decode_item(item) for item in response["Items"][:limit]]
+    more = len(response["Items"]) > limit or "LastEvaluatedKey" in response
+    return (items if oldest_first else items[::-1]), more
+
+
+def get_summary(chat_id):
+    """
+    Retrieve a chat's rolling summary item, or None if it has none yet.
+
+    The item has the summary as `message` and the timestamp of the last
+    summarized message as `summarized_until`.
+    """
+    return get_message(chat_id, SUMMARY_TIMESTAMP)
+
+
+def store_summary(chat_id, summary, summarized_until):
+    """
+    Store a chat's rolling summary, kept as an item of type "summary".
+    """
+    item = {
+        "ChatID": str(chat_id),
+        "timestamp": SUMMARY_TIMESTAMP,
+        "message": summary,
+        "type": "summary",
+        "summarized_until": iso_to_epoch(summarized_until),
+    }
+    response = get_table().put_item(Item=encode_item(item))
+    logging.info(f"Summary stored for {chat_id} until {summarized_until}")
+    return response
+
+
+def set_audio_file_url(chat_id, timestamp, audio_file_url):
+    """
+    Attach an audio file (S3 key) to an already stored message.
+    """
+    # The update must not be overwritten by the message's queued put
+    message_writer.flush(str(chat_id))
+    response = get_table().update_item(
+        Key={"ChatID": str(chat_id), "timestamp": iso_to_epoch(timestamp)},
+        UpdateExpression="SET AudioFileURL = :url",
+        ExpressionAttributeValues={":url": audio_file_url},
+    )
+    conversation_cache.update_message(
+        str(chat_id), Decimal(iso_to_epoch(timestamp)), AudioFileURL=audio_file_url
+    )
+    logging.info(f"Audio stored for {chat_id} @ {timestamp}: {audio_file_url}")
+    return response
+
+
+def get_message(chat_id, timestamp):
+    """
+    Retrieve a single chat message from DynamoDB, or None if it doesn't exist.
+    """
+    message_writer.flush(str(chat_id))
+    response = get_table().get_item(
+        Key={"ChatID": str(chat_id), "timestamp": iso_to_epoch(timestamp)}
+    )
+    return decode_item(response.get("Item"))
+
+
+async def astore_message(
+    chat_id,
+    timestamp,
+    message,
+    message_type="user",
+    audio_file_url=None,
+    durable=False,
+):
+    """
+    Async variant of `store_message`, run on the blocking I/O pool.
+    """
+    return await run_blocking(
+        store_message, chat_id, timestamp, message, message_type, audio_file_url, durable
     )
-    store_message(
-        "9000",
-        "2024-03-18T12:00:02Z",
-        "Hi Shawn, how are you doing?!",
-        "ai",
-        "https://google.ca",
+
+
+async def aflush_messages(chat_id=None, timeout=None):
+    """
+    Async variant of `flush_messages`, run on the blocking I/O pool.
+    """
+    return await run_blocking(flush_messages, chat_id, timeout)
+
+
+async def aget_all_messages_for_chat(chat_id):
+    """
+    Async variant of `get_all_messages_for_chat`, run on the blocking I/O pool.
+    """
+    return await run_blocking(get_all_messages_for_chat, chat_id)
+
+
+async def aget_recent_messages_for_chat(
+    chat_id,
+    model_name="gpt-3.5-turbo",
+    token_budget=HISTORY_TOKEN_BUDGET,
+    page_size=HISTORY_PAGE_SIZE,
+):
+    """
+    Async variant of `get_recent_messages_for_chat`, run on the blocking I/O pool.
+    """
+    return await run_blocking(
+        get_recent_messages_for_chat, chat_id, model_name, token_budget, page_size
     )
-    store_message(
-        "9000", "2024-03-18T12:00:04Z", "I'm doing well. What's your name?", "user"
+
+
+async def aset_audio_file_url(chat_id, timestamp, audio_file_url):
+    """
+    Async variant of `set_audio_file_url`, run on the blocking I/O pool.
+    """
+    return await run_blocking(set_audio_file_url, chat_id, timestamp, audio_file_url)
+
+
+async def aget_message(chat_id, timestamp):
+    """
+    Async variant of `get_message`, run on the blocking I/O pool.
+    """
+    return await run_blocking(get_message, chat_id, timestamp)
+
+
+async def aget_messages_after(chat_id, after_timestamp, limit, oldest_first=False):
+    """
+    Async variant of `get_messages_after`, run on the blocking I/O pool.
+    """
+    return await run_blocking(
+        get_messages_after, chat_id, after_timestamp, limit, oldest_first
     )
-    store_message(
-        "9000",
-        "2024-03-18T12:00:10Z",
-        "My name is Bobby, as you said.",
-        "ai",
-        "https://google.ca",
+
+
+async def aget_messages_page(chat_id, before=None, after=None, limit=MESSAGES_PAGE_MAX):
+    """
+    Async variant of `get_messages_page`, run on the blocking I/O pool.
+    """
+    return await run_blocking(get_messages_page, chat_id, before, after, limit)
+
+
+async def aget_summary(chat_id):
+    """
+    Async variant of `get_summary`, run on the blocking I/O pool.
+    """
+    return await run_blocking(get_summary, chat_id)
+
+
+async def astore_summary(chat_id, summary, summarized_until):
+    """
+    Async variant of `store_summary`, run on the blocking I/O pool.
+    """
+    return await run_blocking(store_summary, chat_id, summary, summarized_until)
+
+
+# Insert a sample conversation
+if __name__ == "__main__":
+    # For testing
+    store_messages(
+        [
+            {
+                "chat_id": "9000",
+                "timestamp": "2024-03-18T12:00:00Z",
+                "message": "Hi, your name is Bobby. I'm Shawn.",
+                "message_type": "user",
+            },
+            {
+                "chat_id": "9000",
+                "timestamp": "2024-03-18T12:00:02Z",
+                "message": "Hi Shawn, how are you doing?!",
+                "message_type": "ai",
+                "audio_file_url": "https://google.ca",
+            },
+            {
+                "chat_id": "9000",
+                "timestamp": "2024-03-18T12:00:04Z",
+                "message": "I'm doing well. What's your name?",
+                "message_type": "user",
+            },
+            {
+                "chat_id": "9000",
+                "timestamp": "2024-03-18T12:00:10Z",
+                "message": "My name is Bobby, as you said.",
+                "message_type": "ai",
+                "audio_file_url": "https://google.ca",
+            },
+        ]
     )